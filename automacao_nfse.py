@@ -3,30 +3,2185 @@ Sistema de Automação para Emissão de Notas Fiscais - SEFIN Belém
 Versão Otimizada com Seletores Específicos
 """
 
-import pandas as pd
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, WebDriverException
+import sys
 import time
 import os
+import re
+import csv
+import json
+import base64
+import gzip
+import hashlib
+import shutil
+import atexit
+import zlib
+import sqlite3
+import tempfile
+import threading
+import importlib
+import logging
+import queue
+from collections import deque
+from copy import copy
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+class _ModuloPreguicoso:
+    """Importa o módulo só no primeiro uso (o pandas leva ~1s para importar e não é preciso para abrir o Chrome)"""
+
+    def __init__(self, nome):
+        self._nome = nome
+        self._modulo = None
+
+    def __getattr__(self, atributo):
+        if self._modulo is None:
+            self._modulo = importlib.import_module(self._nome)
+        return getattr(self._modulo, atributo)
+
+
+pd = _ModuloPreguicoso('pandas')
+
+
+# Nível da linha de progresso: entre INFO e WARNING, aparece também no modo silencioso
+PROGRESSO = 25
+logging.addLevelName(PROGRESSO, 'PROGRESSO')
+
+log = logging.getLogger('nfse')
+
+ARQUIVO_LOG = os.path.join("logs", "automacao_nfse.jsonl")
+
+# Fila + thread que escrevem console e arquivo (configurar_log)
+_fila_log = None
+_ouvinte_log = None
+_console_log = None
+
+
+class _FormatoJSON(logging.Formatter):
+    """Uma linha JSON por registro, com os campos de contexto da nota"""
+
+    def format(self, record):
+        dados = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'msg': record.getMessage().strip(),
+        }
+        for campo in ('emissor', 'linha', 'etapa'):
+            valor = getattr(record, campo, None)
+            if valor is not None:
+                dados[campo] = valor
+        dados['thread'] = record.threadName
+        return json.dumps(dados, ensure_ascii=False, default=str)
+
+
+class _FormatoConsole(logging.Formatter):
+    """Mensagem como era impressa; com vários emissores, prefixada pelo nome"""
+
+    def format(self, record):
+        texto = record.getMessage()
+        emissor = getattr(record, 'emissor', None)
+        if emissor:
+            corpo = texto.lstrip('\n')
+            texto = texto[:len(texto) - len(corpo)] + f"[{emissor}] {corpo.strip()}"
+        return texto
+
+
+class _ConsoleProgresso(logging.StreamHandler):
+    """Console: mensagens em linhas próprias e o progresso reescrito sempre na mesma linha"""
+
+    def __init__(self, stream=None):
+        super().__init__(stream or sys.stdout)
+        self.interativo = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.linha_aberta = False
+        self._largura = 0
+
+    def emit(self, record):
+        try:
+            texto = self.format(record)
+            if getattr(record, 'progresso', False) and self.interativo:
+                self.stream.write('\r' + texto.ljust(self._largura))
+                self._largura = len(texto)
+                self.linha_aberta = True
+            else:
+                self.fechar_linha()
+                self.stream.write(texto + '\n')
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def fechar_linha(self):
+        if self.linha_aberta:
+            self.stream.write('\n')
+            self.linha_aberta = False
+            self._largura = 0
+
+
+class _ContextoLog(logging.LoggerAdapter):
+    """Acrescenta a cada registro o emissor, a linha da planilha e a etapa atuais da automação"""
+
+    def process(self, msg, kwargs):
+        automacao = self.extra
+        linha = getattr(automacao, 'linha_atual', None)
+        kwargs['extra'] = {
+            'emissor': getattr(automacao, 'emissor', None),
+            'linha': linha + 2 if linha is not None else None,
+            'etapa': getattr(automacao, 'etapa_atual', None),
+            **kwargs.get('extra', {}),
+        }
+        return msg, kwargs
+
+
+def configurar_log(nivel=logging.INFO, arquivo=ARQUIVO_LOG):
+    """Console e JSONL rotativo escritos por uma thread (QueueListener): quem loga só enfileira o registro"""
+    global _fila_log, _ouvinte_log, _console_log
+    encerrar_log()
+    _fila_log = queue.Queue()
+    _console_log = _ConsoleProgresso()
+    _console_log.setFormatter(_FormatoConsole())
+    destinos = [_console_log]
+    if arquivo:
+        os.makedirs(os.path.dirname(os.path.abspath(arquivo)), exist_ok=True)
+        em_arquivo = RotatingFileHandler(arquivo, maxBytes=5 * 1024 * 1024, backupCount=5, encoding='utf-8')
+        em_arquivo.setFormatter(_FormatoJSON())
+        destinos.append(em_arquivo)
+    log.handlers[:] = [QueueHandler(_fila_log)]
+    log.setLevel(nivel)
+    log.propagate = False
+    _ouvinte_log = QueueListener(_fila_log, *destinos)
+    _ouvinte_log.start()
+    atexit.register(encerrar_log)
+
+
+def esvaziar_log():
+    """Espera a fila ser escrita (antes de prints/input, para a saída não sair fora de ordem)"""
+    if _ouvinte_log is not None:
+        _fila_log.join()
+        _console_log.fechar_linha()
+
+
+def encerrar_log():
+    global _ouvinte_log
+    if _ouvinte_log is not None:
+        _ouvinte_log.stop()
+        _ouvinte_log = None
+        _console_log.fechar_linha()
+
+
+# Script injetado no portal para contar e registrar as requisições AJAX (XHR) da página
+SCRIPT_MONITOR_AJAX = """
+(function() {
+    if (window.__nfseAjax) { return; }
+    var estado = window.__nfseAjax = {respostas: [], lidosGravador: 0, iniciadas: 0, concluidas: 0};
+    var abrir = XMLHttpRequest.prototype.open;
+    var enviar = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.open = function(metodo, url) {
+        this.__nfse = {metodo: metodo, url: String(url)};
+        return abrir.apply(this, arguments);
+    };
+    XMLHttpRequest.prototype.send = function(corpo) {
+        var xhr = this;
+        var info = xhr.__nfse || {};
+        info.corpo = (typeof corpo === 'string') ? corpo : null;
+        info.seq = ++estado.iniciadas;
+        // 'loadend' dispara depois dos callbacks do jQuery/PrimeFaces (resposta parcial já aplicada)
+        xhr.addEventListener('loadend', function() {
+            estado.concluidas++;
+            var resposta = null;
+            try { resposta = xhr.responseText; } catch (e) {}
+            estado.respostas.push({
+                seq: info.seq, metodo: info.metodo, url: info.url, corpo: info.corpo,
+                status: xhr.status, tipo: xhr.getResponseHeader('Content-Type'),
+                resposta: resposta
+            });
+            // Mantém só as respostas mais recentes
+            if (estado.respostas.length > 200) {
+                estado.respostas.shift();
+                estado.lidosGravador = Math.max(0, estado.lidosGravador - 1);
+            }
+        });
+        return enviar.apply(this, arguments);
+    };
+})();
+"""
+
+SCRIPT_ESTADO_AJAX = """
+var estado = window.__nfseAjax;
+if (!estado) { return null; }
+var filaVazia = true;
+try { filaVazia = PrimeFaces.ajax.Queue.isEmpty(); } catch (e) {}
+var jqueryAtivo = (window.jQuery && jQuery.active) ? jQuery.active : 0;
+return {
+    iniciadas: estado.iniciadas,
+    pendentes: estado.iniciadas - estado.concluidas + jqueryAtivo + (filaVazia ? 0 : 1)
+};
+"""
+
+SCRIPT_RESPOSTAS_AJAX_DESDE = """
+var estado = window.__nfseAjax;
+if (!estado) { return null; }
+var marca = arguments[0] || 0;
+return estado.respostas.filter(function(r) { return r.seq > marca; });
+"""
+
+SCRIPT_TEXTO_DIALOGO_SUCESSO = """
+var seletores = ['.swal-modal', '.ui-growl-message', '.ui-messages-info', '.ui-dialog[aria-hidden=false] .ui-dialog-content'];
+var textos = [];
+seletores.forEach(function(s) {
+    document.querySelectorAll(s).forEach(function(el) { if (el.offsetParent !== null) { textos.push(el.innerText); } });
+});
+return textos.join('\\n');
+"""
+
+# Baixa um arquivo com a sessão do navegador (cookies) e devolve o conteúdo em base64
+SCRIPT_BAIXAR_ARQUIVO = """
+var url = arguments[0];
+var fim = arguments[arguments.length - 1];
+fetch(url, {credentials: 'include'}).then(function(r) {
+    return r.arrayBuffer().then(function(buf) { return {status: r.status, buf: buf}; });
+}).then(function(res) {
+    var bytes = new Uint8Array(res.buf);
+    var binario = '';
+    for (var i = 0; i < bytes.length; i += 0x8000) {
+        binario += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+    }
+    fim({status: res.status, base64: btoa(binario)});
+}).catch(function(e) { fim({erro: String(e)}); });
+"""
+
+# Lê a tabela de notas emitidas da página atual (cabeçalhos + células) em uma única chamada
+SCRIPT_LER_TABELA_NOTAS = """
+var tabela = document.querySelector('.ui-datatable');
+if (!tabela) { return null; }
+var cabecalhos = Array.prototype.map.call(tabela.querySelectorAll('thead th'), function(th) {
+    return th.innerText.trim();
+});
+var linhas = [];
+tabela.querySelectorAll('tbody tr[data-ri], tbody tr.ui-widget-content').forEach(function(tr) {
+    var celulas = Array.prototype.map.call(tr.querySelectorAll('td'), function(td) { return td.innerText.trim(); });
+    if (celulas.length > 1) { linhas.push(celulas); }
+});
+var proxima = tabela.querySelector('.ui-paginator-next');
+return {
+    cabecalhos: cabecalhos,
+    linhas: linhas,
+    tem_proxima: !!proxima && !proxima.classList.contains('ui-state-disabled')
+};
+"""
+
+# Preenche o período da consulta e escolhe a maior quantidade de linhas por página
+SCRIPT_PREPARAR_CONSULTA = """
+var inicio = arguments[0], fim = arguments[1];
+function preencher(padrao, valor) {
+    var campo = Array.prototype.find.call(document.querySelectorAll('input[type=text]'), function(i) {
+        return padrao.test(i.id || '');
+    });
+    if (!campo) { return false; }
+    campo.value = valor;
+    campo.dispatchEvent(new Event('change', {bubbles: true}));
+    return true;
+}
+return {
+    inicio: preencher(/data.?(inicial|inicio|de)/i, inicio),
+    fim: preencher(/data.?(final|fim|ate)/i, fim)
+};
+"""
+
+SCRIPT_MAXIMIZAR_PAGINA = """
+var select = document.querySelector('.ui-paginator-rpp-options');
+if (!select) { return false; }
+var maior = Array.prototype.reduce.call(select.options, function(a, o) {
+    return (parseInt(o.value) || 0) > (parseInt(a.value) || 0) ? o : a;
+});
+if (select.value === maior.value) { return false; }
+select.value = maior.value;
+select.dispatchEvent(new Event('change', {bubbles: true}));
+return true;
+"""
+
+# Escreve a descrição direto no textarea do formulário e dispara os eventos que o componente JSF escuta
+SCRIPT_DEFINIR_DESCRICAO = """
+var el = document.querySelector('textarea[id*="descricao"], textarea[id*="Descricao"]');
+if (!el) { return {erro: 'campo não encontrado'}; }
+if (el.disabled || el.readOnly) { return {erro: 'campo somente leitura'}; }
+var ajax = /PrimeFaces|mojarra|jsf\\.ajax/.test((el.getAttribute('onchange') || '') + (el.getAttribute('onblur') || ''));
+el.focus();
+el.value = arguments[0];
+['input', 'change', 'blur'].forEach(function(tipo) {
+    el.dispatchEvent(new Event(tipo, {bubbles: true}));
+});
+return {ajax: ajax, id: el.id};
+"""
+
+# Sinais de falha de infraestrutura na página atual e nas respostas AJAX desde `marca`
+SCRIPT_DIAGNOSTICO_PORTAL = """
+var marca = arguments[0] || 0;
+var estado = window.__nfseAjax;
+var erroHttp = 0, expirada = false;
+if (estado) {
+    estado.respostas.forEach(function(r) {
+        if (r.seq <= marca) { return; }
+        if (r.status >= 500) { erroHttp = r.status; }
+        var texto = r.resposta || '';
+        if (texto.indexOf('ViewExpiredException') >= 0 || /<redirect[^>]*login/i.test(texto)) { expirada = true; }
+    });
+}
+var pagina = (document.title || '') + '\\n' + (document.body ? document.body.innerText.slice(0, 5000) : '');
+if (/sess[aã]o\\s+(expirou|expirada)|ViewExpired/i.test(pagina) || /login/i.test(location.pathname)) { expirada = true; }
+var paginaErro = /HTTP Status 5\\d\\d|Internal Server Error|Bad Gateway|Service (Temporarily )?Unavailable|Gateway Time-?out/i.test(pagina);
+return {erro_http: erroHttp, expirada: expirada, pagina_erro: paginaErro};
+"""
+
+# GET da página de emissão com os cookies da sessão (sondagem barata: não navega)
+SCRIPT_SONDAR_PORTAL = """
+var url = arguments[0];
+var fim = arguments[arguments.length - 1];
+fetch(url, {credentials: 'include'}).then(function(r) {
+    return r.text().then(function(texto) {
+        fim({status: r.status, formulario: texto.indexOf('formNotaFiscal') >= 0});
+    });
+}).catch(function(e) { fim({erro: String(e)}); });
+"""
+
+SCRIPT_LER_AJAX_GRAVADOR = """
+var estado = window.__nfseAjax;
+if (!estado) { return []; }
+var novas = estado.respostas.slice(estado.lidosGravador);
+estado.lidosGravador = estado.respostas.length;
+return novas;
+"""
+
+
+# Número de NFS-e: ano com 4 dígitos seguido do sequencial (não casa com valores como 1.234,56)
+NUMERO_NFSE = r'\b((?:19|20)\d{2}\d{1,11})\b(?![.,]\d)'
+
+RE_MENSAGEM_SUCESSO = re.compile(r'sucesso|emitid[ao]|gerad[ao]', re.I)
+
+
+def extrair_resultado_emissao(texto):
+    """Extrai número, código de verificação e URL do PDF de uma resposta parcial JSF ou texto de diálogo"""
+    if not texto:
+        return None
+    resultado = {}
+    
+    # Parâmetros de callback do PrimeFaces (<extension ln="primefaces" type="args">{...}</extension>)
+    for args_json in re.findall(r'<extension[^>]*type="args"[^>]*>(.*?)</extension>', texto, re.S):
+        try:
+            args = json.loads(args_json.replace('<![CDATA[', '').replace(']]>', ''))
+        except ValueError:
+            continue
+        for chave, valor in args.items():
+            chave_min = chave.lower()
+            if 'numero' in chave_min and valor and 'numero' not in resultado:
+                resultado['numero'] = str(valor)
+            elif ('verificacao' in chave_min or 'codigo' in chave_min) and valor:
+                resultado.setdefault('codigo_verificacao', str(valor))
+            elif ('pdf' in chave_min or 'url' in chave_min) and valor:
+                resultado.setdefault('url_pdf', str(valor))
+    
+    # Só o fragmento da mensagem de sucesso: outras atualizações da resposta (listas, rodapés,
+    # valores) podem ter números e links de outras notas
+    fragmentos = re.findall(r'<update[^>]*>(.*?)</update>', texto, re.S) or [texto]
+    sucesso = []
+    for fragmento in fragmentos:
+        texto_limpo = re.sub(r'<!\[CDATA\[|\]\]>', ' ', fragmento)
+        texto_limpo = re.sub(r'<[^>]+>', ' ', texto_limpo)
+        texto_limpo = ' '.join(texto_limpo.split())
+        if RE_MENSAGEM_SUCESSO.search(texto_limpo):
+            sucesso.append((fragmento, texto_limpo))
+    
+    for fragmento, texto_limpo in sucesso:
+        if 'numero' not in resultado:
+            match = (re.search(r'N[úu]mero(?:\s+da)?(?:\s+(?:Nota|NFS-?e))?\s*[:º°]?\s*' + NUMERO_NFSE, texto_limpo, re.I)
+                     or re.search(r'(?:Nota|NFS-?e)(?:\s+Fiscal)?\s*(?:n[º°o.]*\s*)?' + NUMERO_NFSE + r'\s+(?:foi\s+)?emitida',
+                                  texto_limpo, re.I))
+            if match:
+                resultado['numero'] = match.group(1)
+        if 'codigo_verificacao' not in resultado:
+            match = re.search(r'C[óo]digo\s+de\s+Verifica[çc][ãa]o\s*[:\-]?\s*([A-Za-z0-9\-]{4,})', texto_limpo, re.I)
+            if match:
+                resultado['codigo_verificacao'] = match.group(1)
+    
+    if 'url_pdf' not in resultado:
+        # Link só quando não há ambiguidade: o único do fragmento ou o que traz o número da nota
+        links = []
+        for fragmento, _ in sucesso:
+            links += re.findall(r'(?:href|src)=["\']([^"\']*(?:\.pdf|imprimir|relatorio)[^"\']*)["\']', fragmento, re.I)
+            links += re.findall(r'window\.open\(\s*["\']([^"\']+)["\']', fragmento)
+        links = list(dict.fromkeys(link.replace('&amp;', '&') for link in links))
+        if resultado.get('numero'):
+            da_nota = [link for link in links if resultado['numero'] in link]
+            links = da_nota or (links if len(links) == 1 else [])
+        if len(links) == 1:
+            resultado['url_pdf'] = links[0]
+    
+    return resultado or None
+
+
+def _somente_digitos(texto):
+    return re.sub(r'\D', '', str(texto or ''))
+
+
+def _valor_brasileiro(texto):
+    """Converte '1.234,56' em 1234.56"""
+    try:
+        return float(str(texto).replace('.', '').replace(',', '.'))
+    except ValueError:
+        return None
+
+
+def _extrair_texto_pdf_simples(conteudo):
+    """Extrator mínimo (sem dependências): textos dos operadores Tj/TJ dos streams do PDF"""
+    partes = []
+    for stream in re.findall(rb'stream\r?\n(.*?)\r?\nendstream', conteudo, re.S):
+        try:
+            stream = zlib.decompress(stream)
+        except zlib.error:
+            pass
+        for bloco in re.findall(rb'\[(.*?)\]\s*TJ|(\((?:\\.|[^\\)])*\))\s*Tj', stream, re.S):
+            trecho = bloco[0] or bloco[1]
+            textos = re.findall(rb'\(((?:\\.|[^\\)])*)\)', trecho)
+            partes.append(b''.join(textos).decode('latin-1'))
+        partes.append('\n')
+    return ' '.join(partes)
+
+
+def extrair_texto_pdf(caminho):
+    """Extrai o texto de um PDF (pypdf quando instalado, senão o extrator simples)"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        PdfReader = None
+    if PdfReader:
+        leitor = PdfReader(caminho)
+        return '\n'.join(pagina.extract_text() or '' for pagina in leitor.pages)
+    with open(caminho, 'rb') as f:
+        return _extrair_texto_pdf_simples(f.read())
+
+
+def analisar_pdf_nota(caminho):
+    """Lê número da nota, CPF/CNPJ do tomador e valor de um PDF (executado no pool de processos)"""
+    resultado = {'arquivo': caminho, 'numero': None, 'cpf_cnpj': None, 'valor': None, 'erro': None}
+    try:
+        with open(caminho, 'rb') as f:
+            f.seek(max(0, os.path.getsize(caminho) - 1024))
+            if b'%%EOF' not in f.read():
+                resultado['erro'] = 'PDF truncado'
+                return resultado
+        
+        texto = ' '.join(extrair_texto_pdf(caminho).split())
+        
+        match = (re.search(r'N[úu]mero\s+da\s+(?:Nota|NFS-?e)\s*:?\s*(\d+)', texto, re.I)
+                 or re.search(r'NFS-?e\s*(?:N[º°o.]*)\s*:?\s*(\d+)', texto, re.I))
+        if match:
+            resultado['numero'] = match.group(1)
+        
+        # CPF/CNPJ do tomador: primeiro documento depois do título "TOMADOR"
+        padrao_doc = r'\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}|\d{3}\.\d{3}\.\d{3}-\d{2}'
+        posicao = texto.upper().find('TOMADOR')
+        docs = re.findall(padrao_doc, texto[posicao:] if posicao >= 0 else texto)
+        if docs:
+            resultado['cpf_cnpj'] = _somente_digitos(docs[0])
+        
+        match = re.search(r'Valor\s+(?:Total\s+)?(?:dos\s+Servi[çc]os|da\s+Nota)\s*(?:\(R\$\))?\s*:?\s*(?:R\$)?\s*([\d.]+,\d{2})', texto, re.I)
+        if match:
+            resultado['valor'] = _valor_brasileiro(match.group(1))
+        
+        if not texto.strip():
+            resultado['erro'] = 'PDF sem texto'
+    except Exception as e:
+        resultado['erro'] = f"{type(e).__name__}: {str(e)[:100]}"
+    return resultado
+
+
+# Abaixo disso a conferência roda no próprio processo (subir o pool custaria mais que analisar)
+LIMITE_CONFERENCIA_SERIAL = 20
+
+# Pool da conferência: um por execução, compartilhado entre lotes, arquivos do daemon e emissores
+_pool_conferencia = None
+_trava_pool_conferencia = threading.Lock()
+
+
+def _obter_pool_conferencia(processos=None):
+    global _pool_conferencia
+    with _trava_pool_conferencia:
+        if _pool_conferencia is None:
+            _pool_conferencia = ProcessPoolExecutor(max_workers=processos)
+            atexit.register(_pool_conferencia.shutdown)
+        return _pool_conferencia
+
+
+def interpretar_notas_portal(cabecalhos, linhas):
+    """Converte as linhas da tabela de notas do portal em dicts (numero, cpf_cnpj, valor, data)"""
+    def coluna(*termos):
+        for i, cabecalho in enumerate(cabecalhos):
+            if any(t in cabecalho.lower() for t in termos):
+                return i
+        return None
+    
+    col_numero = coluna('número', 'numero', 'nº', 'nfs')
+    col_valor = coluna('valor')
+    col_data = coluna('emissão', 'emissao', 'data')
+    col_situacao = coluna('situação', 'situacao', 'status')
+    col_doc = coluna('cpf', 'cnpj')
+    if col_doc is None:
+        col_doc = coluna('tomador')
+    
+    notas = []
+    for celulas in linhas:
+        texto = ' '.join(celulas)
+        if col_situacao is not None and col_situacao < len(celulas) and 'cancel' in celulas[col_situacao].lower():
+            continue
+        numero = _somente_digitos(celulas[col_numero]) if col_numero is not None and col_numero < len(celulas) else ''
+        # Só a coluna do tomador: o número da nota também tem 14+ dígitos
+        doc = _somente_digitos(celulas[col_doc]) if col_doc is not None and col_doc < len(celulas) else ''
+        valor = None
+        if col_valor is not None and col_valor < len(celulas):
+            match = re.search(r'[\d.]+,\d{2}', celulas[col_valor])
+            valor = _valor_brasileiro(match.group(0)) if match else None
+        data = None
+        match = re.search(r'(\d{2}/\d{2}/\d{4})(?:\s+(\d{2}:\d{2}))?',
+                          celulas[col_data] if col_data is not None and col_data < len(celulas) else texto)
+        if match:
+            data = datetime.strptime(f"{match.group(1)} {match.group(2) or '00:00'}", '%d/%m/%Y %H:%M')
+        if numero and len(doc) in (11, 14):
+            notas.append({'numero': numero, 'cpf_cnpj': doc, 'valor': valor, 'data': data,
+                          'com_hora': bool(match and match.group(2))})
+    return notas
+
+
+# Distância máxima (minutos) entre a tentativa registrada na planilha e o horário da nota no portal
+JANELA_CONCILIACAO = 60
+
+
+def _momento_da_tentativa(row):
+    """Quando a linha foi tentada (Data_Tentativa; Data_Emissao em EMITIDA sem número); None se nunca foi"""
+    status = str(row.get('Status', '') or '').strip().upper()
+    if status in ('', 'NAN', 'NONE'):
+        return None
+    for coluna in ('Data_Tentativa', 'Data_Emissao'):
+        try:
+            return datetime.strptime(str(row.get(coluna, '')).strip(), '%d/%m/%Y %H:%M')
+        except ValueError:
+            continue
+    return None
+
+
+def conciliar_notas(df, notas_portal, janela=JANELA_CONCILIACAO):
+    """Casa notas do portal com linhas tentadas sem número (CPF/CNPJ, valor, até `janela` min); retorna [(index, nota)]"""
+    numeros_conhecidos = {_somente_digitos(n) for n in df['Numero_Nota'] if _somente_digitos(n)}
+    disponiveis = {}
+    for nota in notas_portal:
+        if nota['numero'] in numeros_conhecidos or not nota['data']:
+            continue
+        chave = (nota['cpf_cnpj'], round(nota['valor'], 2) if nota['valor'] is not None else None)
+        disponiveis.setdefault(chave, []).append(nota)
+    
+    # Pares (distância, linha, nota) dentro da janela; os mais próximos são associados primeiro
+    pares = []
+    for posicao, (index, row) in enumerate(df.iterrows()):
+        confirmada = str(row.get('Status', '')).upper() == 'EMITIDA' and _somente_digitos(row.get('Numero_Nota', ''))
+        if confirmada:
+            continue
+        # Linhas nunca tentadas ficam de fora: mensalidades repetem CPF e valor todo mês
+        referencia = _momento_da_tentativa(row)
+        if referencia is None:
+            continue
+        try:
+            valor = round(float(row.get('Valor', 110.00)), 2)
+        except (TypeError, ValueError):
+            valor = None
+        for nota in disponiveis.get((_somente_digitos(row.get('CPF', '')), valor), []):
+            if nota.get('com_hora', True):
+                distancia = abs((nota['data'] - referencia).total_seconds()) / 60
+                if distancia > janela:
+                    continue
+            elif nota['data'].date() == referencia.date():
+                distancia = 0
+            else:
+                continue
+            pares.append((distancia, posicao, index, nota))
+    
+    associacoes, linhas_usadas, notas_usadas = [], set(), set()
+    for _, posicao, index, nota in sorted(pares, key=lambda par: par[:2]):
+        if index in linhas_usadas or nota['numero'] in notas_usadas:
+            continue
+        linhas_usadas.add(index)
+        notas_usadas.add(nota['numero'])
+        associacoes.append((posicao, index, nota))
+    return [(index, nota) for _, index, nota in sorted(associacoes, key=lambda item: item[0])]
+
+
+def linhas_pendentes(df):
+    """Índices das linhas ainda não emitidas, na ordem da planilha"""
+    return [index for index, row in df.iterrows() if str(row.get('Status', '')).upper() != 'EMITIDA']
+
+
+MESES = ['janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho',
+         'julho', 'agosto', 'setembro', 'outubro', 'novembro', 'dezembro']
+
+
+class _CamposModelo(dict):
+    """Placeholders desconhecidos ficam no texto como estão"""
+    def __missing__(self, chave):
+        return '{' + chave + '}'
+
+
+def montar_descricao(modelo, dados, hoje=None):
+    """Texto do modelo de descrição com os campos da linha.
+    
+    Além das colunas da planilha ({Nome}, {CPF}, ...), aceita {nome}, {cpf}, {valor} (1.234,56),
+    {mes} (10), {mes_extenso} (outubro) e {ano}, sempre da data de emissão.
+    """
+    hoje = hoje or datetime.now()
+    # Células vazias da planilha chegam como NaN (v != v)
+    campos = _CamposModelo((str(k), '' if v is None or v != v else v) for k, v in dict(dados).items())
+    try:
+        valor = f"{float(dados.get('Valor', 110.00)):,.2f}".replace(',', '_').replace('.', ',').replace('_', '.')
+    except (TypeError, ValueError):
+        valor = str(dados.get('Valor', ''))
+    campos.update(
+        nome=str(campos.get('Nome', '')).strip(),
+        cpf=str(campos.get('CPF', '')),
+        valor=valor,
+        mes=f"{hoje.month:02d}",
+        mes_extenso=MESES[hoje.month - 1],
+        ano=str(hoje.year),
+    )
+    return modelo.format_map(campos).strip()
+
+
+def validar_modelo_descricao(modelo):
+    """Levanta ValueError se o modelo não puder ser montado (ex.: chave sem fechar em "Plano {x")"""
+    try:
+        montar_descricao(modelo, {'Nome': 'Nome', 'CPF': '00000000000', 'Valor': 110.00})
+    except (ValueError, IndexError, KeyError, AttributeError) as e:
+        raise ValueError(f"Modelo de descrição inválido {modelo!r}: {e}") from None
+
+
+def _literal_xpath(texto):
+    """Texto como literal XPath 1.0 (usa concat() quando tem aspas simples e duplas)"""
+    if "'" not in texto:
+        return f"'{texto}'"
+    if '"' not in texto:
+        return f'"{texto}"'
+    partes = texto.split("'")
+    return "concat(" + ", \"'\", ".join(f"'{parte}'" for parte in partes) + ")"
+
+
+def _eh_mutacao(script):
+    """Indica se um execute_script altera o estado da página (cliques, eventos, atributos)"""
+    return any(trecho in script for trecho in ('click', 'dispatchEvent', 'setAttribute', '.checked', '.value ='))
+
+
+def _hash_script(script):
+    return hashlib.sha1(script.encode('utf-8')).hexdigest()[:12]
+
+
+# Atividade do emissor selecionada em toda nota (931310000 - Condicionamento físico)
+ATIVIDADE_PADRAO = "931310000"
+
+URL_EMISSAO = "https://notafiscal.belem.pa.gov.br/notafiscal/paginas/notafiscal/emissaoNotaFiscalData.jsf"
+
+# Consulta de notas emitidas (usada na conciliação em lote)
+URL_CONSULTA_NOTAS = "https://notafiscal.belem.pa.gov.br/notafiscal/paginas/notafiscal/consultaNotaFiscal.jsf"
+
+# Orçamento de tempo (segundos) de uma nota inteira e de cada etapa (VigiaPrazos)
+PRAZO_NOTA = 300
+PRAZOS_ETAPAS = {
+    'cpf': 60, 'tomador': 120, 'atividade': 60, 'descricao': 90,
+    'valor': 45, 'emissao': 90, 'pdf': 90, 'limpeza': 45,
+}
+# Tempo máximo de carregamento de página e de execute_async_script no Chrome
+TIMEOUT_CARREGAMENTO = 60
+TIMEOUT_SCRIPT = 30
+
+# Quantas vezes uma linha volta para a fila por falha de infraestrutura antes de virar ERRO
+MAX_REPETICOES_INFRA = 5
+
+# Páginas visitadas no primeiro uso de um perfil para deixar os recursos estáticos em cache
+URLS_AQUECIMENTO = [
+    "https://notafiscal.belem.pa.gov.br/notafiscal/",
+    URL_EMISSAO,
+]
+
+
+class PrazoEsgotado(Exception):
+    """Orçamento de tempo da nota ou da etapa acabou (levantada nos pontos de espera)"""
+
+
+class VigiaPrazos:
+    """Watchdog de tempo por nota e por etapa.
+    
+    Quando um prazo acaba, marca `estourado` (pausar/aguardar_ajax levantam PrazoEsgotado no próximo
+    ponto de espera). Se a nota continuar presa depois da `carencia` - chamada WebDriver travada,
+    renderer sem resposta - o navegador é encerrado para destravar a thread principal e `derrubado`
+    indica que ele precisa ser recriado.
+    """
+
+    def __init__(self, automacao, prazo_nota=PRAZO_NOTA, prazos_etapas=None, carencia=10):
+        self.automacao = automacao
+        self.prazo_nota = prazo_nota
+        self.prazos_etapas = dict(PRAZOS_ETAPAS, **(prazos_etapas or {}))
+        self.carencia = carencia
+        self._lock = threading.Lock()
+        self._geracao = 0
+        self._timer_nota = None
+        self._timer_etapa = None
+        self._timer_derrubar = None
+        self.estourado = None
+        self.derrubado = False
+
+    def _iniciar_timer(self, segundos, motivo):
+        timer = threading.Timer(segundos, self._estourar, (self._geracao, motivo))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _cancelar(self, *timers):
+        for timer in timers:
+            if timer is not None:
+                timer.cancel()
+
+    def iniciar_nota(self, fim=None):
+        """Começa o prazo da nota ou, com `fim` (time.monotonic), continua um prazo já iniciado; devolve o fim"""
+        with self._lock:
+            self._cancelar(self._timer_nota, self._timer_etapa, self._timer_derrubar)
+            self._geracao += 1
+            self.estourado = None
+            self._timer_etapa = self._timer_derrubar = self._timer_nota = None
+            if not self.prazo_nota:
+                return None
+            if fim is None:
+                fim = time.monotonic() + self.prazo_nota
+            self._timer_nota = self._iniciar_timer(max(0.0, fim - time.monotonic()), None)
+            return fim
+
+    def iniciar_etapa(self, etapa):
+        with self._lock:
+            self._cancelar(self._timer_etapa)
+            prazo = self.prazos_etapas.get(etapa) if etapa else None
+            self._timer_etapa = self._iniciar_timer(prazo, etapa) if prazo and self._timer_nota else None
+
+    def encerrar(self):
+        """Fim da nota: cancela os timers (o motivo de um prazo já estourado continua em `estourado`)"""
+        with self._lock:
+            self._geracao += 1
+            self._cancelar(self._timer_nota, self._timer_etapa, self._timer_derrubar)
+            self._timer_nota = self._timer_etapa = self._timer_derrubar = None
+
+    def verificar(self):
+        """Ponto de checagem cooperativa (chamado nas esperas da thread principal durante uma nota)"""
+        if self.estourado and self._timer_nota is not None:
+            raise PrazoEsgotado(self.estourado)
+
+    def _estourar(self, geracao, etapa):
+        with self._lock:
+            if geracao != self._geracao or self.estourado:
+                return
+            if etapa:
+                self.estourado = f"Tempo esgotado na etapa {etapa} ({self.prazos_etapas[etapa]}s)"
+            else:
+                self.estourado = (f"Tempo esgotado na etapa {self.automacao.etapa_atual or '-'} "
+                                  f"(prazo da nota: {self.prazo_nota}s)")
+            self._timer_derrubar = threading.Timer(self.carencia, self._derrubar, (geracao,))
+            self._timer_derrubar.daemon = True
+            self._timer_derrubar.start()
+        self.automacao.log.warning(f"\n  ⏱ {self.estourado}")
+
+    def _derrubar(self, geracao):
+        with self._lock:
+            if geracao != self._geracao:
+                return
+            self.derrubado = True
+        self.automacao.log.warning(f"  ⏱ Etapa travada - encerrando o navegador para destravar")
+        try:
+            self.automacao.driver.quit()
+        except Exception:
+            pass
+
+
+class DisjuntorPortal:
+    """Circuit breaker: abre após falhas de infraestrutura seguidas, pausa quem o compartilha e fecha
+    quando a sondagem responde.
+    
+    Um disjuntor do portal (timeout do blockUI/AJAX, HTTP 5xx, erro de rede) é compartilhado por
+    todos os emissores; a sessão expirada usa um disjuntor próprio de cada emissor.
+    """
+
+    def __init__(self, limite_falhas=3, intervalo_sondagem=15, intervalo_maximo=120, sondagens_por_worker=5):
+        self.limite_falhas = limite_falhas
+        self.intervalo_sondagem = intervalo_sondagem
+        self.intervalo_maximo = intervalo_maximo
+        # Depois de tantas sondagens sem resposta o worker passa a vez (o navegador dele pode estar morto)
+        self.sondagens_por_worker = sondagens_por_worker
+        self._lock = threading.Lock()
+        self._fechado = threading.Event()
+        self._fechado.set()
+        self._sondando = False
+        self._aguardando = 0
+        self._desistentes = set()
+        self._inicio_pausa = None
+        self.falhas_seguidas = 0
+        self.aberturas = 0
+        self.tempo_pausado = 0.0
+        self.motivo = None
+
+    @property
+    def aberto(self):
+        return not self._fechado.is_set()
+
+    def registrar_sucesso(self):
+        """O portal respondeu normalmente (mesmo que a nota tenha dado erro de dados)"""
+        with self._lock:
+            self.falhas_seguidas = 0
+
+    def registrar_falha(self, motivo):
+        """Conta uma falha de infraestrutura; devolve True se o disjuntor abriu agora"""
+        with self._lock:
+            self.falhas_seguidas += 1
+            if self.aberto or self.falhas_seguidas < self.limite_falhas:
+                return False
+            self._fechado.clear()
+            self._inicio_pausa = time.perf_counter()
+            self.aberturas += 1
+            self.motivo = motivo
+        log.warning(f"\n⚠ Portal instável ({motivo}, {self.falhas_seguidas} falhas seguidas) - pausando os workers")
+        return True
+
+    def aguardar_liberacao(self, sondar):
+        """Bloqueia enquanto o disjuntor estiver aberto; um dos workers sonda o portal com `sondar()`.
+        
+        Devolve True se o worker ficou pausado (a página dele precisa ser recarregada).
+        """
+        if not self.aberto:
+            return False
+        worker = threading.get_ident()
+        with self._lock:
+            self._aguardando += 1
+        try:
+            while self.aberto:
+                with self._lock:
+                    # Quem já desistiu só volta a sondar se todos os que aguardam também desistiram
+                    vez = worker not in self._desistentes or len(self._desistentes) >= self._aguardando
+                    sondador = vez and not self._sondando
+                    if sondador:
+                        self._sondando = True
+                if not sondador:
+                    # Outro worker está sondando; quando ele desistir, este assume a sondagem
+                    self._fechado.wait(self.intervalo_sondagem)
+                    continue
+                try:
+                    respondeu = self._sondar_ate_responder(sondar)
+                finally:
+                    with self._lock:
+                        self._sondando = False
+                if not respondeu:
+                    with self._lock:
+                        self._desistentes.add(worker)
+                    log.warning(f"  ⚠ Portal sem resposta após {self.sondagens_por_worker} sondagens - "
+                                "passando a sondagem a outro worker")
+        finally:
+            with self._lock:
+                self._aguardando -= 1
+                self._desistentes.discard(worker)
+        return True
+
+    def _sondar_ate_responder(self, sondar):
+        """Sonda até o portal responder (fecha o disjuntor e devolve True) ou esgotar as sondagens deste worker"""
+        intervalo = self.intervalo_sondagem
+        for _ in range(self.sondagens_por_worker):
+            log.info(f"  ℹ Nova sondagem do portal em {intervalo}s...")
+            time.sleep(intervalo)
+            try:
+                respondeu = sondar()
+            except Exception as e:
+                log.warning(f"  ⚠ Sondagem falhou: {type(e).__name__}")
+                respondeu = False
+            if respondeu:
+                break
+            intervalo = min(intervalo * 2, self.intervalo_maximo)
+        else:
+            return False
+        with self._lock:
+            self.falhas_seguidas = 0
+            self.tempo_pausado += time.perf_counter() - self._inicio_pausa
+            self._desistentes.clear()
+            self._fechado.set()
+        log.info(f"✓ Portal respondendo novamente - retomando (pausa total: {self.tempo_pausado:.0f}s)")
+        return True
+
+
+class CaixaEntrada:
+    """Pasta monitorada pelo modo daemon: planilhas (.xlsx/.csv) entram na fila quando terminam de ser copiadas.
+    
+    Usa o watchdog quando instalado (acorda no evento do sistema de arquivos); senão verifica a pasta
+    a cada `intervalo` segundos. A planilha é movida para em_processamento/ enquanto é emitida e para
+    processados/ (ou com_erro/) no final, já com o resultado de cada linha.
+    """
+
+    EXTENSOES = ('.xlsx', '.csv')
+
+    def __init__(self, pasta, intervalo=1.0):
+        self.pasta = os.path.abspath(pasta)
+        self.intervalo = intervalo
+        self.pasta_processando = os.path.join(self.pasta, "em_processamento")
+        self.pasta_processados = os.path.join(self.pasta, "processados")
+        self.pasta_erros = os.path.join(self.pasta, "com_erro")
+        for pasta in (self.pasta_processando, self.pasta_processados, self.pasta_erros):
+            os.makedirs(pasta, exist_ok=True)
+        # Tamanho/mtime da última verificação: só entra na fila o arquivo que parou de crescer
+        self._vistos = {}
+        self._aviso = threading.Event()
+        self._observador = None
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            log.info(f"ℹ watchdog não instalado - verificando a pasta a cada {intervalo:g}s")
+            return
+        
+        aviso = self._aviso
+        
+        class Avisar(FileSystemEventHandler):
+            def on_any_event(self, evento):
+                aviso.set()
+        
+        self._observador = Observer()
+        self._observador.schedule(Avisar(), self.pasta, recursive=False)
+        self._observador.daemon = True
+        self._observador.start()
+
+    def _aceita(self, nome):
+        # '~$' são as travas do Excel
+        return nome.lower().endswith(self.EXTENSOES) and not nome.startswith(('~$', '.'))
+
+    def interrompidas(self):
+        """Planilhas que estavam em processamento quando o daemon parou (linhas EMITIDA são puladas)"""
+        return sorted(os.path.join(self.pasta_processando, nome) for nome in os.listdir(self.pasta_processando)
+                      if self._aceita(nome))
+
+    def _prontos(self):
+        vistos = {}
+        prontos = []
+        for entrada in os.scandir(self.pasta):
+            if not entrada.is_file() or not self._aceita(entrada.name):
+                continue
+            info = entrada.stat()
+            vistos[entrada.path] = (info.st_size, info.st_mtime)
+            if self._vistos.get(entrada.path) == vistos[entrada.path]:
+                prontos.append((info.st_mtime, entrada.path))
+        self._vistos = vistos
+        return [caminho for _, caminho in sorted(prontos)]
+
+    def _destino(self, pasta, nome):
+        destino = os.path.join(pasta, nome)
+        if os.path.exists(destino):
+            base, extensao = os.path.splitext(nome)
+            destino = os.path.join(pasta, f"{base}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{extensao}")
+        return destino
+
+    def proximo(self):
+        """Bloqueia até chegar uma planilha completa; move para em_processamento/ e devolve o novo caminho"""
+        while True:
+            for caminho in self._prontos():
+                destino = self._destino(self.pasta_processando, os.path.basename(caminho))
+                try:
+                    os.replace(caminho, destino)
+                except OSError:
+                    # Ainda aberto por outro programa (ex.: Excel no Windows)
+                    continue
+                return destino
+            
+            self._aviso.clear()
+            if self._observador is None or self._vistos:
+                # Polling, ou arquivo ainda sendo copiado: confere de novo em seguida
+                self._aviso.wait(self.intervalo)
+            else:
+                self._aviso.wait(60)
+
+    def finalizar(self, caminho, erro=False):
+        """Move a planilha (já com o resultado) para processados/ ou com_erro/"""
+        destino = self._destino(self.pasta_erros if erro else self.pasta_processados, os.path.basename(caminho))
+        os.replace(caminho, destino)
+        return destino
+
+    def parar(self):
+        if self._observador is not None:
+            self._observador.stop()
+            self._observador.join(timeout=5)
+
+
+class EscritorPlanilha:
+    """Atualiza só as células de controle de uma planilha .xlsx existente (mantém formatação, fórmulas e outras abas).
+    
+    As células de cada linha ficam em cache (linha do DataFrame → célula); `atualizar` muda o valor em
+    memória e `salvar` grava em um arquivo temporário e troca pelo original com os.replace, tentando
+    de novo com espera crescente enquanto o Excel estiver com o arquivo aberto (uma tentativa só nos
+    salvamentos parciais, que ficam para o próximo).
+    """
+
+    COLUNAS = ['Status', 'Numero_Nota', 'Codigo_Verificacao', 'Data_Emissao', 'Data_Tentativa', 'Mensagem_Erro']
+
+    def __init__(self, caminho, tentativas=6, espera_inicial=0.5):
+        from openpyxl import load_workbook
+        
+        self.caminho = caminho
+        self.tentativas = tentativas
+        self.espera_inicial = espera_inicial
+        self.livro = load_workbook(caminho)
+        self.aba = self.livro.worksheets[0]
+        self.colunas = {}
+        ultima = 0
+        for celula in self.aba[1]:
+            if celula.value is not None:
+                self.colunas[str(celula.value).strip()] = celula.column
+                ultima = max(ultima, celula.column)
+        # Colunas de controle que a planilha ainda não tem entram no fim do cabeçalho
+        for nome in self.COLUNAS:
+            if nome not in self.colunas:
+                ultima += 1
+                nova = self.aba.cell(row=1, column=ultima, value=nome)
+                if ultima > 1:
+                    nova._style = copy(self.aba.cell(row=1, column=ultima - 1)._style)
+                self.colunas[nome] = ultima
+        self._celulas = {}
+        self.alteradas = 0
+
+    def _celula(self, index, coluna):
+        chave = (index, coluna)
+        celula = self._celulas.get(chave)
+        if celula is None:
+            # Linha 1 é o cabeçalho: a linha `index` do DataFrame é a linha index + 2 da planilha
+            celula = self._celulas[chave] = self.aba.cell(row=index + 2, column=self.colunas[coluna])
+        return celula
+
+    def atualizar(self, index, valores):
+        """Altera em memória as células da linha que mudaram"""
+        for coluna, valor in valores.items():
+            if coluna not in self.colunas:
+                continue
+            celula = self._celula(index, coluna)
+            valor = valor if valor not in ('', None) else None
+            if celula.value != valor:
+                celula.value = valor
+                self.alteradas += 1
+
+    def salvar(self, tentativas=None):
+        """Grava as alterações (temporário + os.replace); devolve False se não havia nada para gravar"""
+        if not self.alteradas:
+            return False
+        tentativas = tentativas or self.tentativas
+        pasta = os.path.dirname(os.path.abspath(self.caminho))
+        descritor, temporario = tempfile.mkstemp(prefix=".salvando_", suffix=".xlsx", dir=pasta)
+        os.close(descritor)
+        try:
+            self.livro.save(temporario)
+            espera = self.espera_inicial
+            for tentativa in range(1, tentativas + 1):
+                try:
+                    os.replace(temporario, self.caminho)
+                    break
+                except PermissionError:
+                    # Arquivo aberto no Excel (Windows): espera e tenta de novo
+                    if tentativa == tentativas:
+                        raise
+                    log.warning(f"  ⚠ Planilha em uso - nova tentativa em {espera:g}s...")
+                    time.sleep(espera)
+                    espera *= 2
+        finally:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+        self.alteradas = 0
+        return True
+
+
+class PerfilChrome:
+    """Perfil persistente do Chrome (user-data-dir) com trava exclusiva por worker"""
+
+    def __init__(self, pasta_base, max_perfis=16):
+        self.pasta_base = pasta_base
+        self.max_perfis = max_perfis
+        self.pasta = None
+        self._trava = None
+
+    @staticmethod
+    def _travar_arquivo(arquivo, travar=True):
+        """Trava (ou solta) o primeiro byte do arquivo sem bloquear; o sistema solta sozinho se o processo morrer"""
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                arquivo.seek(0)
+                msvcrt.locking(arquivo.fileno(), msvcrt.LK_NBLCK if travar else msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(arquivo.fileno(), (fcntl.LOCK_EX | fcntl.LOCK_NB) if travar else fcntl.LOCK_UN)
+            return True
+        except OSError:
+            return False
+
+    def _tentar_travar(self, pasta):
+        # Trava do sistema operacional (não depende de PID: nada de os.kill, que no Windows encerra o processo)
+        try:
+            arquivo = open(os.path.join(pasta, ".trava_automacao"), "a+", encoding="utf-8")
+        except OSError:
+            return None
+        if not self._travar_arquivo(arquivo):
+            arquivo.close()
+            return None
+        # PID só para consulta de quem está usando o perfil
+        arquivo.seek(0)
+        arquivo.truncate()
+        arquivo.write(f"{os.getpid()} {datetime.now().isoformat()}")
+        arquivo.flush()
+        return arquivo
+
+    def adquirir(self, worker=0):
+        """Trava o primeiro perfil livre a partir de worker_<n> e devolve o caminho"""
+        for i in range(worker, worker + self.max_perfis):
+            pasta = os.path.abspath(os.path.join(self.pasta_base, f"worker_{i}"))
+            os.makedirs(pasta, exist_ok=True)
+            trava = self._tentar_travar(pasta)
+            if trava:
+                self.pasta = pasta
+                self._trava = trava
+                atexit.register(self.liberar)
+                return pasta
+        raise RuntimeError(f"Nenhum perfil livre em {self.pasta_base} (todos em uso)")
+
+    def liberar(self):
+        if self._trava:
+            self._travar_arquivo(self._trava, travar=False)
+            try:
+                self._trava.close()
+            except OSError:
+                pass
+        self._trava = None
+
+    @property
+    def aquecido(self):
+        return bool(self.pasta) and os.path.exists(os.path.join(self.pasta, ".cache_aquecido"))
+
+    def marcar_aquecido(self):
+        with open(os.path.join(self.pasta, ".cache_aquecido"), "w", encoding="utf-8") as f:
+            f.write(datetime.now().isoformat())
+
+
+class ArquivoNotas:
+    """Arquivo de PDFs endereçado por conteúdo (sha256), em subpastas, com índice SQLite"""
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+        os.makedirs(pasta, exist_ok=True)
+        self.caminho_indice = os.path.join(pasta, "indice.sqlite")
+        self._lock = threading.Lock()
+        self._conexao = sqlite3.connect(self.caminho_indice, check_same_thread=False)
+        self._conexao.row_factory = sqlite3.Row
+        with self._conexao:
+            self._conexao.executescript("""
+                CREATE TABLE IF NOT EXISTS pdfs (
+                    sha256 TEXT PRIMARY KEY,
+                    caminho TEXT NOT NULL,
+                    tamanho INTEGER NOT NULL,
+                    criado_em TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS notas (
+                    id INTEGER PRIMARY KEY,
+                    numero TEXT,
+                    cpf_cnpj TEXT,
+                    data_emissao TEXT,
+                    planilha TEXT,
+                    linha INTEGER,
+                    sha256 TEXT NOT NULL REFERENCES pdfs(sha256),
+                    registrado_em TEXT NOT NULL,
+                    UNIQUE (numero)
+                );
+                CREATE INDEX IF NOT EXISTS idx_notas_numero ON notas(numero);
+                CREATE INDEX IF NOT EXISTS idx_notas_cpf_cnpj ON notas(cpf_cnpj);
+                CREATE INDEX IF NOT EXISTS idx_notas_data ON notas(data_emissao);
+                CREATE INDEX IF NOT EXISTS idx_notas_sha256 ON notas(sha256);
+            """)
+
+    def _caminho_relativo(self, sha256):
+        return os.path.join("pdfs", sha256[:2], sha256[2:4], f"{sha256}.pdf")
+
+    def guardar(self, origem, numero=None, cpf_cnpj=None, data_emissao=None, planilha=None, linha=None):
+        """Guarda um PDF (bytes ou caminho de arquivo, que é movido) e indexa a nota.
+        
+        PDFs idênticos são armazenados uma única vez. Cada número de nota tem uma entrada no índice
+        (notas de execuções anteriores da mesma planilha continuam encontráveis). Retorna o caminho do arquivo.
+        """
+        if isinstance(origem, bytes):
+            conteudo, caminho_origem = origem, None
+        else:
+            caminho_origem = origem
+            with open(caminho_origem, "rb") as f:
+                conteudo = f.read()
+        sha256 = hashlib.sha256(conteudo).hexdigest()
+        relativo = self._caminho_relativo(sha256)
+        destino = os.path.join(self.pasta, relativo)
+        
+        if not os.path.exists(destino):
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            temporario = destino + ".tmp"
+            with open(temporario, "wb") as f:
+                f.write(conteudo)
+            os.replace(temporario, destino)
+        if caminho_origem:
+            os.remove(caminho_origem)
+        
+        agora = datetime.now().isoformat(timespec="seconds")
+        with self._lock, self._conexao:
+            self._conexao.execute(
+                "INSERT OR IGNORE INTO pdfs (sha256, caminho, tamanho, criado_em) VALUES (?, ?, ?, ?)",
+                (sha256, relativo, len(conteudo), agora))
+            # O mesmo número baixado de novo só atualiza a própria entrada
+            self._conexao.execute(
+                "INSERT INTO notas (numero, cpf_cnpj, data_emissao, planilha, linha, sha256, registrado_em) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (numero) DO UPDATE SET cpf_cnpj = excluded.cpf_cnpj, data_emissao = excluded.data_emissao, "
+                "planilha = excluded.planilha, linha = excluded.linha, sha256 = excluded.sha256, "
+                "registrado_em = excluded.registrado_em",
+                (str(numero) if numero else None, _somente_digitos(cpf_cnpj) or None, data_emissao or agora[:10],
+                 os.path.abspath(planilha) if planilha else None, linha, sha256, agora))
+        return destino
+
+    def buscar(self, numero=None, cpf_cnpj=None, data_inicio=None, data_fim=None, planilha=None, linha=None):
+        """Busca notas pelo índice (datas no formato AAAA-MM-DD). Retorna uma lista de dicts"""
+        filtros, parametros = [], []
+        if numero:
+            filtros.append("n.numero = ?")
+            parametros.append(str(numero))
+        if cpf_cnpj:
+            filtros.append("n.cpf_cnpj = ?")
+            parametros.append(_somente_digitos(cpf_cnpj))
+        if data_inicio:
+            filtros.append("n.data_emissao >= ?")
+            parametros.append(data_inicio)
+        if data_fim:
+            filtros.append("n.data_emissao <= ?")
+            parametros.append(data_fim)
+        if planilha:
+            filtros.append("n.planilha = ?")
+            parametros.append(os.path.abspath(planilha))
+        if linha is not None:
+            filtros.append("n.linha = ?")
+            parametros.append(int(linha))
+        sql = ("SELECT n.numero, n.cpf_cnpj, n.data_emissao, n.planilha, n.linha, n.sha256, p.caminho "
+               "FROM notas n JOIN pdfs p ON p.sha256 = n.sha256")
+        if filtros:
+            sql += " WHERE " + " AND ".join(filtros)
+        sql += " ORDER BY n.data_emissao, n.registrado_em, n.numero"
+        with self._lock:
+            linhas = self._conexao.execute(sql, parametros).fetchall()
+        resultado = []
+        for registro in linhas:
+            item = dict(registro)
+            item['caminho'] = os.path.join(self.pasta, item['caminho'])
+            resultado.append(item)
+        return resultado
+
+    def caminho_da_linha(self, planilha, linha, numero=None):
+        """PDF da nota `numero` ou, sem ele, o mais recente guardado para a linha da planilha"""
+        encontrados = self.buscar(numero=numero) if numero else []
+        if not encontrados:
+            encontrados = self.buscar(planilha=planilha, linha=linha)
+        return encontrados[-1]['caminho'] if encontrados else None
+
+    def fechar(self):
+        with self._lock:
+            self._conexao.close()
+
+
+class GravadorPortal:
+    """Grava os estados do DOM e as respostas AJAX de cada etapa de processar_nota"""
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self.pasta_snapshots = os.path.join(pasta, "snapshots")
+        os.makedirs(self.pasta_snapshots, exist_ok=True)
+        self.arquivo_eventos = os.path.join(pasta, "eventos.jsonl")
+        self.linha = None
+        self.etapa = None
+        self.epoca = 0
+        self.scripts = {}
+        self.mutacao = None
+        self.em_etapa = False
+
+    def copiar_planilha(self, caminho_excel):
+        """Guarda uma cópia da planilha usada na gravação (usada depois no replay)"""
+        destino = os.path.join(self.pasta, "planilha" + os.path.splitext(caminho_excel)[1])
+        shutil.copyfile(caminho_excel, destino)
+        return destino
+
+    def iniciar_etapa(self, driver, linha, etapa):
+        if self.em_etapa:
+            self.fechar_epoca(driver)
+        self.linha = linha
+        self.etapa = etapa
+        self.epoca = 0
+        self.scripts = {}
+        self.mutacao = None
+        self.em_etapa = True
+
+    def registrar_script(self, script, resultado):
+        try:
+            json.dumps(resultado)
+        except (TypeError, ValueError):
+            return
+        self.scripts.setdefault(_hash_script(script), []).append(resultado)
+
+    def fechar_epoca(self, driver, proxima_mutacao=None):
+        """Salva o estado atual da página como resultado final da época que termina"""
+        if not self.em_etapa:
+            return
+        try:
+            html = driver.page_source
+            ajax = driver.execute_script(SCRIPT_LER_AJAX_GRAVADOR) or []
+        except Exception as e:
+            log.warning(f"    ⚠ Gravação: falha ao capturar estado: {type(e).__name__}")
+            return
+
+        conteudo = html.encode('utf-8')
+        nome_snapshot = hashlib.sha1(conteudo).hexdigest() + ".html.gz"
+        caminho_snapshot = os.path.join(self.pasta_snapshots, nome_snapshot)
+        if not os.path.exists(caminho_snapshot):
+            with gzip.open(caminho_snapshot, "wb") as f:
+                f.write(conteudo)
+
+        evento = {
+            "linha": self.linha,
+            "etapa": self.etapa,
+            "epoca": self.epoca,
+            "mutacao": self.mutacao,
+            "snapshot": nome_snapshot,
+            "scripts": self.scripts,
+            "ajax": ajax,
+        }
+        with open(self.arquivo_eventos, "a", encoding="utf-8") as f:
+            f.write(json.dumps(evento, ensure_ascii=False) + "\n")
+
+        self.epoca += 1
+        self.scripts = {}
+        self.mutacao = proxima_mutacao
+
+    def finalizar(self, driver):
+        self.fechar_epoca(driver)
+        self.em_etapa = False
+
+
+class ElementoGravador:
+    """Envolve um WebElement registrando as interações que alteram a página"""
+
+    def __init__(self, elemento, driver_gravador):
+        self._elemento = elemento
+        self._driver = driver_gravador
+
+    def __getattr__(self, nome):
+        return getattr(self._elemento, nome)
+
+    def _mutar(self, descricao, funcao, *args):
+        self._driver._antes_de_mutar(descricao)
+        return funcao(*args)
+
+    def click(self):
+        return self._mutar("click", self._elemento.click)
+
+    def send_keys(self, *valores):
+        return self._mutar("send_keys", self._elemento.send_keys, *valores)
+
+    def clear(self):
+        return self._mutar("clear", self._elemento.clear)
+
+    def find_element(self, by, valor=None):
+        return ElementoGravador(self._elemento.find_element(by, valor), self._driver)
+
+    def find_elements(self, by, valor=None):
+        return [ElementoGravador(e, self._driver) for e in self._elemento.find_elements(by, valor)]
+
+
+class DriverGravador:
+    """Proxy do WebDriver que alimenta o GravadorPortal durante uma sessão real"""
+
+    def __init__(self, driver, gravador):
+        self._driver = driver
+        self._gravador = gravador
+
+    def __getattr__(self, nome):
+        return getattr(self._driver, nome)
+
+    def _antes_de_mutar(self, descricao):
+        self._gravador.fechar_epoca(self._driver, descricao)
+
+    def marcar_etapa(self, linha, etapa):
+        self._gravador.iniciar_etapa(self._driver, linha, etapa)
+
+    def finalizar_gravacao(self):
+        self._gravador.finalizar(self._driver)
+
+    def get(self, url):
+        self._antes_de_mutar(f"get {url}")
+        return self._driver.get(url)
+
+    def refresh(self):
+        self._antes_de_mutar("refresh")
+        return self._driver.refresh()
+
+    def find_element(self, by, valor=None):
+        return ElementoGravador(self._driver.find_element(by, valor), self)
+
+    def find_elements(self, by, valor=None):
+        return [ElementoGravador(e, self) for e in self._driver.find_elements(by, valor)]
+
+    def execute_script(self, script, *args):
+        if _eh_mutacao(script):
+            self._antes_de_mutar("script")
+        args = [a._elemento if isinstance(a, ElementoGravador) else a for a in args]
+        resultado = self._driver.execute_script(script, *args)
+        self._gravador.registrar_script(script, resultado)
+        return resultado
+
+
+class ElementoReplay:
+    """Elemento servido a partir de um snapshot gravado (re-resolvido a cada leitura)"""
+
+    def __init__(self, driver, caminho):
+        self._driver = driver
+        self._caminho = caminho
+
+    def _no(self):
+        nos = self._driver._arvore().xpath(self._caminho)
+        if not nos:
+            raise StaleElementReferenceException(f"Elemento não existe mais no snapshot: {self._caminho}")
+        return nos[0]
+
+    @property
+    def id(self):
+        return self._caminho
+
+    @property
+    def tag_name(self):
+        return self._no().tag
+
+    @property
+    def text(self):
+        return " ".join(" ".join(self._no().itertext()).split())
+
+    def get_attribute(self, nome):
+        no = self._no()
+        if nome in ('textContent', 'innerText'):
+            return self.text
+        if nome == 'value' and no.tag == 'textarea':
+            return no.text or ''
+        return no.get(nome)
+
+    def get_dom_attribute(self, nome):
+        return self._no().get(nome)
+
+    def is_displayed(self):
+        no = self._no()
+        if no.get('type') == 'hidden':
+            return False
+        while no is not None:
+            estilo = (no.get('style') or '').replace(' ', '').lower()
+            classes = no.get('class') or ''
+            if 'display:none' in estilo or 'visibility:hidden' in estilo or 'ui-helper-hidden' in classes:
+                return False
+            no = no.getparent()
+        return True
+
+    def is_enabled(self):
+        no = self._no()
+        return no.get('disabled') is None and no.get('aria-disabled') != 'true'
+
+    def is_selected(self):
+        no = self._no()
+        return no.get('checked') is not None or no.get('aria-checked') == 'true'
+
+    def click(self):
+        self._no()
+        self._driver._mutar()
+
+    def send_keys(self, *valores):
+        self._no()
+        self._driver._mutar()
+
+    def clear(self):
+        self._no()
+        self._driver._mutar()
+
+    def find_element(self, by, valor=None):
+        return self._driver._localizar(by, valor, self._no(), unico=True)
+
+    def find_elements(self, by, valor=None):
+        return self._driver._localizar(by, valor, self._no(), unico=False)
+
+
+class DriverReplay:
+    """Driver offline que reproduz uma sessão gravada pelo GravadorPortal"""
+
+    def __init__(self, pasta):
+        try:
+            from lxml import html as lxml_html
+        except ImportError:
+            raise RuntimeError("O modo replay precisa do pacote 'lxml' (pip install lxml cssselect)")
+        self._lxml_html = lxml_html
+        self.pasta = pasta
+        self.pasta_snapshots = os.path.join(pasta, "snapshots")
+        self.etapas = {}
+        with open(os.path.join(pasta, "eventos.jsonl"), encoding="utf-8") as f:
+            for linha_arquivo in f:
+                evento = json.loads(linha_arquivo)
+                self.etapas.setdefault((evento["linha"], evento["etapa"]), []).append(evento)
+        self._cache_arvores = {}
+        self._eventos = []
+        self._epoca = 0
+        self._consumo_scripts = {}
+        self.current_url = ""
+        self.title = ""
+
+    def marcar_etapa(self, linha, etapa):
+        eventos = self.etapas.get((linha, etapa))
+        if not eventos:
+            raise WebDriverException(f"Etapa não gravada: linha={linha} etapa={etapa}")
+        self._eventos = eventos
+        self._epoca = 0
+        self._consumo_scripts = {}
+
+    def _evento(self):
+        if not self._eventos:
+            return None
+        return self._eventos[min(self._epoca, len(self._eventos) - 1)]
+
+    def _arvore(self):
+        evento = self._evento()
+        if evento is None:
+            return self._lxml_html.fromstring("<html><body></body></html>").getroottree()
+        nome = evento["snapshot"]
+        if nome not in self._cache_arvores:
+            with gzip.open(os.path.join(self.pasta_snapshots, nome), "rb") as f:
+                self._cache_arvores[nome] = self._lxml_html.fromstring(f.read()).getroottree()
+        return self._cache_arvores[nome]
+
+    def _mutar(self):
+        self._epoca += 1
+        self._consumo_scripts = {}
+
+    def _localizar(self, by, valor, contexto, unico):
+        arvore = self._arvore()
+        raiz = contexto if contexto is not None else arvore.getroot()
+        if by == By.ID:
+            nos = raiz.xpath(".//*[@id=$v]", v=valor)
+        elif by == By.NAME:
+            nos = raiz.xpath(".//*[@name=$v]", v=valor)
+        elif by == By.CLASS_NAME:
+            nos = raiz.xpath(".//*[contains(concat(' ', normalize-space(@class), ' '), $v)]", v=f" {valor} ")
+        elif by == By.TAG_NAME:
+            nos = raiz.xpath(f".//{valor}")
+        elif by == By.CSS_SELECTOR:
+            from lxml.cssselect import CSSSelector
+            nos = CSSSelector(valor)(raiz)
+        else:
+            nos = raiz.xpath(valor)
+        elementos = [ElementoReplay(self, arvore.getpath(no)) for no in nos if hasattr(no, 'tag')]
+        if unico:
+            if not elementos:
+                raise NoSuchElementException(f"Elemento não encontrado no snapshot: {by}={valor}")
+            return elementos[0]
+        return elementos
+
+    def find_element(self, by, valor=None):
+        return self._localizar(by, valor, None, unico=True)
+
+    def find_elements(self, by, valor=None):
+        return self._localizar(by, valor, None, unico=False)
+
+    def execute_script(self, script, *args):
+        if _eh_mutacao(script):
+            self._mutar()
+        evento = self._evento()
+        if evento is None:
+            return None
+        chave = _hash_script(script)
+        resultados = evento["scripts"].get(chave)
+        if not resultados:
+            return None
+        posicao = self._consumo_scripts.get(chave, 0)
+        self._consumo_scripts[chave] = posicao + 1
+        return resultados[min(posicao, len(resultados) - 1)]
+
+    def execute_async_script(self, script, *args):
+        return self.execute_script(script, *args)
+    
+    def set_script_timeout(self, segundos):
+        pass
+    
+    def execute_cdp_cmd(self, comando, parametros):
+        return {}
+
+    @property
+    def page_source(self):
+        return self._lxml_html.tostring(self._arvore(), encoding="unicode")
+
+    def get(self, url):
+        self.current_url = url
+        self._mutar()
+
+    def refresh(self):
+        self._mutar()
+
+    def save_screenshot(self, caminho):
+        return True
+
+    def quit(self):
+        pass
+
+
+class RastreadorComandos:
+    """Registra cada comando WebDriver (tipo, localizador, latência, método chamador e etapa)"""
+
+    def __init__(self, automacao):
+        self.automacao = automacao
+        self.eventos = []
+        self._origem = time.perf_counter()
+
+    def _metodo_chamador(self):
+        frame = sys._getframe(3)
+        while frame is not None:
+            if frame.f_locals.get('self') is self.automacao:
+                return frame.f_code.co_name
+            frame = frame.f_back
+        return None
+
+    @staticmethod
+    def _descrever(comando, args):
+        if not args:
+            return None
+        if comando in ('find_element', 'find_elements') and len(args) >= 2:
+            return f"{args[0]}={args[1]}"
+        if comando in ('execute_script', 'execute_async_script'):
+            return ' '.join(str(args[0]).split())[:80]
+        return ' '.join(str(a) for a in args if not hasattr(a, 'is_displayed'))[:80] or None
+
+    def executar(self, comando, args, funcao, kwargs=None, localizador=None):
+        inicio = time.perf_counter()
+        try:
+            return funcao(*args, **(kwargs or {}))
+        finally:
+            self.registrar(comando, args, inicio, localizador)
+
+    def registrar(self, comando, args, inicio, localizador=None):
+        fim = time.perf_counter()
+        self.eventos.append({
+            'comando': comando,
+            'localizador': self._descrever(comando, args) or localizador,
+            'inicio': inicio - self._origem,
+            'duracao': fim - inicio,
+            'chamador': self._metodo_chamador(),
+            'etapa': self.automacao.etapa_atual,
+            'linha': self.automacao.linha_atual,
+        })
+
+    def exportar_chrome_trace(self, caminho):
+        """Salva no formato Trace Event (abrir em chrome://tracing ou ui.perfetto.dev)"""
+        eventos = []
+        for e in self.eventos:
+            eventos.append({
+                'name': e['comando'],
+                'cat': e['etapa'] or 'fora_de_etapa',
+                'ph': 'X',
+                'ts': round(e['inicio'] * 1e6),
+                'dur': round(e['duracao'] * 1e6),
+                'pid': 1,
+                'tid': e['linha'] + 1 if e['linha'] is not None else 0,
+                'args': {'localizador': e['localizador'], 'chamador': e['chamador'], 'etapa': e['etapa']},
+            })
+        with open(caminho, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': eventos, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        return caminho
+
+    def resumo(self, top=10):
+        """Imprime round trips e tempo por etapa e as interações mais caras"""
+        if not self.eventos:
+            return
+        notas = {e['linha'] for e in self.eventos if e['linha'] is not None}
+        por_etapa = {}
+        por_interacao = {}
+        for e in self.eventos:
+            etapa = por_etapa.setdefault(e['etapa'] or '-', [0, 0.0])
+            etapa[0] += 1
+            etapa[1] += e['duracao']
+            chave = (e['chamador'] or '-', e['comando'], e['localizador'] or '')
+            interacao = por_interacao.setdefault(chave, [0, 0.0])
+            interacao[0] += 1
+            interacao[1] += e['duracao']
+        
+        esvaziar_log()
+        print(f"\n{'='*60}")
+        print("  COMANDOS WEBDRIVER")
+        print(f"{'='*60}")
+        print(f"  Total: {len(self.eventos)} comandos em {len(notas)} notas "
+              f"({len(self.eventos) / max(len(notas), 1):.0f} por nota)")
+        for etapa, (quantidade, duracao) in sorted(por_etapa.items(), key=lambda i: -i[1][1]):
+            print(f"    {etapa:<10} {quantidade:6d} comandos  {duracao:8.2f}s")
+        print(f"\n  Interações mais caras:")
+        for (chamador, comando, localizador), (quantidade, duracao) in sorted(
+                por_interacao.items(), key=lambda i: -i[1][1])[:top]:
+            print(f"    {duracao:7.2f}s {quantidade:5d}x  {chamador}.{comando}  {localizador[:60]}")
+        print(f"{'='*60}")
+
+
+def _e_elemento(objeto):
+    return hasattr(objeto, 'is_displayed') and hasattr(objeto, 'find_element')
+
+
+class ElementoRastreado:
+    """Envolve um WebElement registrando cada comando no RastreadorComandos"""
+
+    def __init__(self, elemento, rastreador, localizador=None):
+        self._elemento = elemento
+        self._rastreador = rastreador
+        self._localizador = localizador
+
+    def __getattr__(self, nome):
+        if nome.startswith('_'):
+            return getattr(self._elemento, nome)
+        inicio = time.perf_counter()
+        valor = getattr(self._elemento, nome)
+        if not callable(valor):
+            # Propriedades (text, tag_name...) também são round trips
+            self._rastreador.registrar(nome, None, inicio, self._localizador)
+            return valor
+        
+        def chamada(*args, **kwargs):
+            resultado = self._rastreador.executar(nome, args, valor, kwargs, self._localizador)
+            return _envolver_rastreado(resultado, self._rastreador, RastreadorComandos._descrever(nome, args))
+        return chamada
+
+
+def _envolver_rastreado(resultado, rastreador, localizador=None):
+    if isinstance(resultado, list):
+        return [ElementoRastreado(e, rastreador, localizador) if _e_elemento(e) else e for e in resultado]
+    if _e_elemento(resultado):
+        return ElementoRastreado(resultado, rastreador, localizador)
+    return resultado
+
+
+class DriverRastreado:
+    """Proxy do WebDriver que mede cada comando (ativado com --rastrear)"""
+
+    # Métodos dos proxies de gravação/replay que não são comandos WebDriver
+    NAO_RASTREAR = {'marcar_etapa', 'finalizar_gravacao'}
+
+    def __init__(self, driver, rastreador):
+        self._driver = driver
+        self._rastreador = rastreador
+
+    def __getattr__(self, nome):
+        if nome.startswith('_') or nome in self.NAO_RASTREAR:
+            return getattr(self._driver, nome)
+        inicio = time.perf_counter()
+        valor = getattr(self._driver, nome)
+        if not callable(valor):
+            if nome in ('page_source', 'current_url', 'title', 'window_handles', 'current_window_handle'):
+                self._rastreador.registrar(nome, None, inicio)
+            return valor
+        
+        def chamada(*args, **kwargs):
+            args = tuple(a._elemento if isinstance(a, ElementoRastreado) else a for a in args)
+            resultado = self._rastreador.executar(nome, args, valor, kwargs)
+            return _envolver_rastreado(resultado, self._rastreador, RastreadorComandos._descrever(nome, args))
+        return chamada
+
+
+class PaginaBase:
+    """Page object: localizadores nomeados, handles em cache e recuperação de referências obsoletas.
+    
+    Cada nome em LOCALIZADORES aponta para um (By, valor) ou para uma lista de alternativas,
+    tentadas em ordem. O handle encontrado fica em cache até uma StaleElementReferenceException
+    ou até uma re-renderização AJAX conhecida (invalidar()).
+    """
+
+    LOCALIZADORES = {}
+
+    # Nomes cujo elemento precisa estar visível (e habilitado) para ser escolhido
+    SOMENTE_VISIVEIS = set()
+
+    def __init__(self, automacao):
+        self.automacao = automacao
+        self._cache = {}
+        self._fixados = {}
+
+    @property
+    def driver(self):
+        return self.automacao.driver
+
+    def _alternativas(self, nome):
+        localizadores = self._fixados.get(nome) or self.LOCALIZADORES[nome]
+        return localizadores if isinstance(localizadores, list) else [localizadores]
+
+    def localizador(self, nome):
+        """Primeiro (By, valor) do nome - para usar com WebDriverWait/expected_conditions"""
+        return self._alternativas(nome)[0]
+
+    def elemento(self, nome):
+        """Handle do elemento (do cache, ou localizado pelas alternativas em ordem)"""
+        if nome in self._cache:
+            return self._cache[nome]
+        for by, valor in self._alternativas(nome):
+            if nome in self.SOMENTE_VISIVEIS:
+                for candidato in self.driver.find_elements(by, valor):
+                    try:
+                        if candidato.is_displayed() and candidato.is_enabled():
+                            self._cache[nome] = candidato
+                            return candidato
+                    except StaleElementReferenceException:
+                        continue
+            else:
+                encontrados = self.driver.find_elements(by, valor)
+                if encontrados:
+                    self._cache[nome] = encontrados[0]
+                    return encontrados[0]
+        raise NoSuchElementException(f"{type(self).__name__}.{nome} não encontrado")
+
+    def existe(self, nome):
+        try:
+            self.elemento(nome)
+            return True
+        except NoSuchElementException:
+            return False
+
+    def executar(self, nome, acao):
+        """Executa acao(elemento); se o handle estiver obsoleto, re-localiza e tenta de novo"""
+        try:
+            return acao(self.elemento(nome))
+        except StaleElementReferenceException:
+            self.invalidar(nome)
+            return acao(self.elemento(nome))
+
+    def aguardar(self, nome, condicao=EC.visibility_of_element_located, timeout=10):
+        """Aguarda a condição no primeiro localizador do nome e guarda o handle em cache"""
+        elemento = self.automacao.esperar(timeout).until(condicao(self.localizador(nome)))
+        if _e_elemento(elemento):
+            self._cache[nome] = elemento
+        return elemento
+
+    def fixar(self, nome, localizador):
+        """Localizador definido em tempo de execução (ex.: pelo id de um elemento já encontrado); None volta ao padrão"""
+        self._fixados[nome] = localizador
+        self._cache.pop(nome, None)
+
+    def invalidar(self, nome=None):
+        if nome is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(nome, None)
+
+    # Interações comuns
+    def clicar(self, nome, via_js=False):
+        if via_js:
+            return self.executar(nome, lambda e: self.driver.execute_script("arguments[0].click();", e))
+        return self.executar(nome, lambda e: e.click())
+
+    def digitar(self, nome, texto, limpar=True):
+        def acao(elemento):
+            if limpar:
+                elemento.clear()
+            elemento.send_keys(texto)
+        return self.executar(nome, acao)
+
+    def atributo(self, nome, atributo='value'):
+        return self.executar(nome, lambda e: e.get_attribute(atributo))
+
+    def rolar_ate(self, nome, bloco='center'):
+        return self.executar(nome, lambda e: self.driver.execute_script(
+            f"arguments[0].scrollIntoView({{block: '{bloco}'}});", e))
+
+
+class PaginaEmissao(PaginaBase):
+    """Formulário principal de emissão (emissaoNotaFiscalData.jsf)"""
+
+    LOCALIZADORES = {
+        'campo_cpf': (By.ID, "formNotaFiscal:idCpfCnpjPessoa:idInputMaskCpfCnpj:inputText"),
+        # Botão Pesquisar correto (tem "dados-pessoa" no onclick)
+        'btn_pesquisar_cpf': (By.XPATH, "//a[contains(@class, 'btn-success') and contains(@onclick, 'dados-pessoa') "
+                                        "and .//i[contains(@class, 'pe-7s-search')]]"),
+        'campo_nome': (By.XPATH, "//input[contains(@id, 'nomeEmpresarial') or contains(@id, 'nome')]"),
+        'dropdown_atividade': (By.ID, "formNotaFiscal:idAtividadeEmissor"),
+        'dropdown_atividade_input': (By.ID, "formNotaFiscal:idAtividadeEmissor_input"),
+        'lista_atividades': (By.ID, "formNotaFiscal:idAtividadeEmissor_items"),
+        'btn_carregar_descricao': [
+            (By.XPATH, "//a[contains(@class, 'btn-warning') and (contains(., 'Carregar') or contains(., 'Descrição'))]"),
+            (By.XPATH, "//a[.//i[contains(@class, 'fa-plus-circle')]]"),
+        ],
+        'campo_descricao': (By.XPATH, "//textarea[contains(@id, 'descricao') or contains(@id, 'Descricao')]"),
+        'campo_valor': [
+            # Input dentro de span ui-inputnumber (mais específico)
+            (By.XPATH, "//span[contains(@class, 'ui-inputnumber')]//input[@type='text']"),
+            # Por classes específicas
+            (By.XPATH, "//input[contains(@class, 'ui-inputnumber') and contains(@class, 'input-currency')]"),
+            # Por ID
+            (By.XPATH, "//input[contains(@id, 'inputText_input')]"),
+        ],
+        'btn_emitir': [
+            (By.XPATH, "//button[contains(@id, 'btnEmitir') or (contains(., 'Emitir') and contains(@class, 'btn'))]"),
+            (By.XPATH, "//a[contains(., 'Emitir') and contains(@class, 'btn')]"),
+        ],
+        'btn_pdf': [
+            # Por texto "PDF" ou "Imprimir"
+            (By.XPATH, "//a[contains(translate(., 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'), 'pdf')]"),
+            (By.XPATH, "//button[contains(translate(., 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'), 'pdf')]"),
+            (By.XPATH, "//a[contains(translate(., 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'), 'imprimir')]"),
+            # Por ícone
+            (By.XPATH, "//a[.//i[contains(@class, 'pdf') or contains(@class, 'print') or contains(@class, 'file')]]"),
+        ],
+        'btn_nova': (By.XPATH, "//button[contains(., 'Nova') or contains(., 'Limpar')] | "
+                               "//a[contains(., 'Nova') or contains(., 'Limpar')]"),
+    }
+
+    SOMENTE_VISIVEIS = {'campo_valor', 'btn_pdf'}
+
+
+class DialogoTomador(PaginaBase):
+    """Diálogo de cadastro de tomador (XPaths da v40 - div[5] e OK em div[20])"""
+
+    LOCALIZADORES = {
+        'titulo': (By.XPATH, "//*[contains(text(), 'Tomador Não Cadastrado')]"),
+        'campo_nome': (By.XPATH, "/html/body/div[5]/form/span/div/div/div[3]/div/div[1]/div[1]/input"),
+        'campo_apelido': (By.XPATH, "/html/body/div[5]/form/span/div/div/div[3]/div/div[1]/div[3]/input"),
+        'campo_cep': (By.XPATH, "/html/body/div[5]/form/span/div/div/div[3]/div/div[2]/div[1]/table/tbody/tr/td[1]/input"),
+        'btn_lupa_cep': (By.XPATH, "/html/body/div[5]/form/span/div/div/div[3]/div/div[2]/div[1]/table/tbody/tr/td[2]"
+                                   "/div/table/tbody/tr/td[3]/a/span"),
+        'btn_gravar': (By.XPATH, "/html/body/div[5]/form/span/div/div/div[4]/a[2]"),
+        'btn_ok_sucesso': [
+            (By.XPATH, "/html/body/div[20]/div/div[3]/div/button"),
+            (By.CSS_SELECTOR, "button.swal-button.swal-button--confirm"),
+        ],
+    }
+
+
+class DialogoCEP(PaginaBase):
+    """Diálogo de pesquisa de CEP aberto pela lupa do cadastro de tomador (div[13] na v40)"""
+
+    LOCALIZADORES = {
+        'btn_voltar': (By.XPATH, "/html/body/div[13]/div/div/table/tbody/tr/td/a"),
+    }
+
+
+class DialogoDescricao(PaginaBase):
+    """Diálogo 'Descrição Favorita'"""
+
+    LOCALIZADORES = {
+        'titulo': (By.XPATH, "//div[contains(@class, 'ui-dialog') and contains(@style, 'display')]"
+                             "//h3[contains(., 'Descrição Favorita')]"),
+        'dialogo': (By.XPATH, "//div[contains(@class, 'ui-dialog') and contains(@id, 'Descricao')]"),
+        # Checkbox da primeira LINHA da tabela (não o do cabeçalho: evita _head_)
+        'checkbox_linha': (By.XPATH, "//div[contains(@class, 'ui-datatable-scrollable-body')]//div[@role='checkbox' "
+                                     "and @aria-checked='false' and not(contains(@id, '_head_'))]"),
+        'checkbox_cabecalho': (By.XPATH, "//div[contains(@id, '_head_checkbox')]//span[contains(@class, 'ui-chkbox-icon')]"),
+        'contador': (By.XPATH, "//span[contains(text(), 'Selecionado')]"),
+        'checkboxes_tabela': (By.XPATH, "//div[contains(@class, 'ui-datatable')]//input[@type='checkbox']"),
+        'btn_confirmar': [
+            # O botão é um <a> com btn-success e classe dialogselect_save
+            (By.XPATH, "//a[contains(@class, 'btn-success') and contains(@class, 'dialogselect_save')]"),
+            (By.XPATH, "//div[contains(@class, 'ui-dialog')]//a[contains(@class, 'btn-success') and contains(., 'Confirmar')]"),
+        ],
+    }
+
+
+class EscalonadorRodizio:
+    """Vez de emitir distribuída em rodízio entre emissores, com no máximo `simultaneas` notas em andamento.
+    
+    Quem termina uma nota volta para o fim da fila, então um emissor com planilha grande não
+    atrasa os demais; o tempo de espera de cada um fica em `espera` e as notas concluídas em `notas`.
+    """
+
+    def __init__(self, simultaneas=2):
+        self.simultaneas = simultaneas
+        self._cond = threading.Condition()
+        self._fila = deque()
+        self._em_andamento = 0
+        self.espera = {}
+        self.notas = {}
+
+    def aguardar_vez(self, emissor):
+        inicio = time.perf_counter()
+        with self._cond:
+            self._fila.append(emissor)
+            while self._fila[0] != emissor or self._em_andamento >= self.simultaneas:
+                self._cond.wait()
+            self._fila.popleft()
+            self._em_andamento += 1
+            self.espera[emissor] = self.espera.get(emissor, 0.0) + time.perf_counter() - inicio
+            self._cond.notify_all()
+
+    def liberar_vez(self, emissor):
+        with self._cond:
+            self._em_andamento -= 1
+            self._cond.notify_all()
+
+    def contar_nota(self, emissor):
+        with self._cond:
+            self.notas[emissor] = self.notas.get(emissor, 0) + 1
+
+
+class AbaEmissao:
+    """Aba do navegador no modo pipeline: handle da janela, page objects próprios e emissão pendente"""
+
+    def __init__(self, handle, paginas):
+        self.handle = handle
+        self.paginas = paginas
+        # (index, marca do AJAX, fim do prazo da nota) da emissão disparada e ainda não concluída
+        self.pendente = None
+        self.recarregar = False
+
 
 class AutomacaoNotaFiscal:
-    def __init__(self, caminho_excel):
+    def __init__(self, caminho_excel, pasta_gravacao=None, pasta_replay=None, pasta_perfis=None, worker=0,
+                 prefetch_tomadores=False, arquivo_rastreamento=None, disjuntor=None, pasta_pdfs=None,
+                 codigo_atividade=ATIVIDADE_PADRAO, descricao_favorita=None, emissor=None, escalonador=None, abas=1,
+                 prazo_nota=PRAZO_NOTA, prazos_etapas=None, modelo_descricao=None):
+        # Registros com o contexto desta automação (emissor, linha, etapa)
+        self.log = _ContextoLog(log, self)
         self.caminho_excel = caminho_excel
         self.driver = None
         self.wait = None
+        self.perfil = PerfilChrome(pasta_perfis) if pasta_perfis else None
+        self.worker = worker
+        # Arquivo de PDFs (notas_pdf/pdfs/ab/cd/<sha256>.pdf + indice.sqlite)
+        if pasta_replay:
+            self.pasta_pdfs = os.path.join(pasta_replay, "notas_pdf")
+        else:
+            self.pasta_pdfs = pasta_pdfs or os.path.join(os.getcwd(), "notas_pdf")
+        self._arquivo = None
+        # Grava só as células de controle na planilha .xlsx de saída (aberto em abrir_escritor)
+        self.escritor = None
+        # Separador da planilha CSV de entrada (detectado em carregar_dados)
+        self.separador_csv = ';'
+        # Emissor (conta do portal): atividade e descrição favorita usadas em toda nota
+        self.emissor = emissor
+        self.codigo_atividade = codigo_atividade
+        self.descricao_favorita = descricao_favorita
+        # Texto escrito direto no campo quando a linha não tem Descricao (placeholders: montar_descricao)
+        if modelo_descricao:
+            validar_modelo_descricao(modelo_descricao)
+        self.modelo_descricao = modelo_descricao
+        # Rodízio entre emissores rodando em paralelo (ExecutorMultiEmissor)
+        self.escalonador = escalonador
+        self._na_vez = False
+        # CPF/CNPJ (só dígitos) → True se o tomador existe no portal (preenchido pelo prefetch)
+        self.prefetch_tomadores = prefetch_tomadores
+        self.tomadores = {}
+        # Modo pipeline: quantas abas com o formulário de emissão (1 = uma nota por vez)
+        # Gravação e replay registram uma aba só (a época de uma etapa seria fechada em outra aba)
+        self.abas = 1 if pasta_replay or pasta_gravacao else max(1, abas)
+        self.aba_atual = None
+        # Page objects (handles em cache, invalidados quando o AJAX/recarga re-renderiza a página)
+        self.pagina = PaginaEmissao(self)
+        self.dialogo_tomador = DialogoTomador(self)
+        self.dialogo_cep = DialogoCEP(self)
+        self.dialogo_descricao = DialogoDescricao(self)
+        # Circuit breaker (pode ser compartilhado entre instâncias que rodam em paralelo)
+        self.disjuntor = disjuntor or DisjuntorPortal()
+        # Sessão expirada é da conta deste emissor: não pausa os outros
+        self.disjuntor_sessao = DisjuntorPortal()
+        self.timeouts_ajax = 0
+        self.aguardando_login = False
+        # Watchdog de tempo por nota/etapa (desligado no replay e com prazo_nota=0)
+        self.vigia = VigiaPrazos(self, prazo_nota, prazos_etapas) if prazo_nota and not pasta_replay else None
+        # Fim do prazo da nota em andamento (no pipeline vale do preparar até o concluir)
+        self.fim_prazo_nota = None
+        self.reciclagens = 0
+        # Partida: navegador aberto em segundo plano e tempo até a primeira nota (sem a espera do login)
+        self.inicio_execucao = time.perf_counter()
+        self._preaquecimento = None
+        self._erro_preaquecimento = None
+        self.tempo_login = 0.0
+        self.primeira_nota = None
+        self.arquivo_rastreamento = arquivo_rastreamento
+        self.rastreador = RastreadorComandos(self) if arquivo_rastreamento else None
+        self.gravador = GravadorPortal(pasta_gravacao) if pasta_gravacao else None
+        self.pasta_replay = pasta_replay
+        self.modo_replay = pasta_replay is not None
+        # No replay o resultado vai para a pasta da gravação (não altera a planilha original)
+        if self.modo_replay:
+            self.caminho_saida = os.path.join(pasta_replay, "resultado_replay.xlsx")
+        else:
+            self.caminho_saida = caminho_excel
+        self.linha_atual = None
+        self.etapa_atual = None
+        self.ultima_emissao = None
+        self.tempos_etapas = {}
+        self._inicio_etapa = None
+    
+    def pausar(self, segundos):
+        """Pausa fixa (ignorada no modo replay, onde a página já está no estado final)"""
+        if self.vigia:
+            self.vigia.verificar()
+        if not self.modo_replay:
+            time.sleep(segundos)
+    
+    def esperar(self, timeout):
+        """Cria um WebDriverWait (com timeout reduzido no modo replay)"""
+        if self.modo_replay:
+            return WebDriverWait(self.driver, min(timeout, 0.2), poll_frequency=0.05)
+        return WebDriverWait(self.driver, timeout)
+    
+    def marcar_etapa(self, etapa):
+        """Marca o início de uma etapa (usado na gravação/replay e na medição de tempos)"""
+        agora = time.perf_counter()
+        if self.etapa_atual and self._inicio_etapa is not None:
+            self.tempos_etapas.setdefault(self.etapa_atual, []).append(agora - self._inicio_etapa)
+        self.etapa_atual = etapa
+        self._inicio_etapa = agora if etapa else None
+        if self.vigia:
+            self.vigia.iniciar_etapa(etapa)
+        if etapa and hasattr(self.driver, 'marcar_etapa'):
+            self.driver.marcar_etapa(self.linha_atual, etapa)
+    
+    def invalidar_paginas(self):
+        """Descarta os handles em cache de todos os page objects (após recarga ou re-renderização)"""
+        for pagina in (self.pagina, self.dialogo_tomador, self.dialogo_cep, self.dialogo_descricao):
+            pagina.invalidar()
+    
+    @property
+    def arquivo(self):
+        if self._arquivo is None:
+            self._arquivo = ArquivoNotas(self.pasta_pdfs)
+        return self._arquivo
     
     def configurar_navegador(self):
         """Configura o navegador Chrome"""
+        # Pasta onde o Chrome salva os downloads antes de irem para o arquivo de PDFs
+        self.download_dir = os.path.join(self.pasta_pdfs, "_recebidos")
+        if self.modo_replay:
+            self.driver = DriverReplay(self.pasta_replay)
+            if self.rastreador:
+                self.driver = DriverRastreado(self.driver, self.rastreador)
+            self.wait = self.esperar(15)
+            os.makedirs(self.download_dir, exist_ok=True)
+            self.log.info(f"✓ Driver de replay carregado: {self.pasta_replay}")
+            return
+        
         options = webdriver.ChromeOptions()
         options.add_experimental_option("detach", True)
         
+        # Perfil persistente: cache HTTP e login mantidos entre execuções
+        if self.perfil:
+            pasta_perfil = self.perfil.adquirir(self.worker)
+            options.add_argument(f"--user-data-dir={pasta_perfil}")
+            options.add_argument("--profile-directory=Default")
+            self.log.info(f"ℹ Perfil do Chrome: {pasta_perfil}")
+        
         # Configurações para download automático de PDF
-        download_dir = os.path.join(os.getcwd(), "notas_pdf")
+        download_dir = self.download_dir
         os.makedirs(download_dir, exist_ok=True)
         
         prefs = {
@@ -39,422 +2194,544 @@ class AutomacaoNotaFiscal:
         options.add_experimental_option("prefs", prefs)
         
         self.driver = webdriver.Chrome(options=options)
+        # Nenhuma navegação/script fica pendurada indefinidamente
+        self.driver.set_page_load_timeout(TIMEOUT_CARREGAMENTO)
+        self.driver.set_script_timeout(TIMEOUT_SCRIPT)
+        # Injeta (via DevTools) o monitor de AJAX em toda página carregada
+        self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": SCRIPT_MONITOR_AJAX})
+        if self.gravador:
+            self.driver = DriverGravador(self.driver, self.gravador)
+            self.log.info(f"ℹ Gravando sessão em: {self.gravador.pasta}")
+        if self.rastreador:
+            self.driver = DriverRastreado(self.driver, self.rastreador)
+            self.log.info(f"ℹ Rastreando comandos WebDriver em: {self.arquivo_rastreamento}")
         self.wait = WebDriverWait(self.driver, 15)
-        self.download_dir = download_dir
-        print("✓ Navegador configurado")
-        print(f"ℹ PDFs serão salvos em: {download_dir}")
+        self.log.info("✓ Navegador configurado")
+        self.log.info(f"ℹ PDFs serão arquivados em: {self.pasta_pdfs}")
     
     def carregar_dados(self):
-        """Carrega dados do Excel"""
-        df = pd.read_excel(self.caminho_excel)
+        """Carrega dados do Excel (ou CSV)"""
+        if self.caminho_excel.lower().endswith('.csv'):
+            # Separador detectado automaticamente (';' do Excel brasileiro ou ',') e reaproveitado ao salvar
+            with open(self.caminho_excel, encoding='utf-8-sig', newline='') as f:
+                amostra = f.read(65536)
+            try:
+                self.separador_csv = csv.Sniffer().sniff(amostra, delimiters=';,\t|').delimiter
+            except csv.Error:
+                self.separador_csv = ';'
+            df = pd.read_csv(self.caminho_excel, sep=self.separador_csv, encoding='utf-8-sig')
+        else:
+            df = pd.read_excel(self.caminho_excel)
         
         # Adiciona colunas de controle
-        for col in ['Status', 'Numero_Nota', 'Data_Emissao', 'Mensagem_Erro']:
+        for col in ['Status', 'Numero_Nota', 'Codigo_Verificacao', 'Data_Emissao', 'Data_Tentativa', 'Mensagem_Erro']:
             if col not in df.columns:
                 df[col] = ''
         
         # Converte para string
         df['Status'] = df['Status'].astype(str)
         df['Numero_Nota'] = df['Numero_Nota'].astype(str)
+        df['Codigo_Verificacao'] = df['Codigo_Verificacao'].astype(str)
         df['Data_Emissao'] = df['Data_Emissao'].astype(str)
+        df['Data_Tentativa'] = df['Data_Tentativa'].astype(str)
         df['Mensagem_Erro'] = df['Mensagem_Erro'].astype(str)
         
-        print(f"✓ Excel carregado: {len(df)} registros")
+        self.log.info(f"✓ Excel carregado: {len(df)} registros")
         return df
     
     def acessar_sistema(self):
         """Acessa a página de emissão"""
-        url = "https://notafiscal.belem.pa.gov.br/notafiscal/paginas/notafiscal/emissaoNotaFiscalData.jsf"
-        self.driver.get(url)
-        time.sleep(5)
-        print("✓ Sistema acessado")
+        self.marcar_etapa('acesso')
+        if self.perfil and not self.perfil.aquecido:
+            self.aquecer_cache()
+        self.driver.get(URL_EMISSAO)
+        self.invalidar_paginas()
+        self.aguardar_pagina_pronta()
+        self.log.info("✓ Sistema acessado")
+        # Login e carga da planilha não entram no tempo de 'acesso'
+        self.marcar_etapa(None)
+    
+    def aguardar_pagina_pronta(self, timeout=15):
+        """Aguarda o documento carregar e o AJAX inicial terminar (em vez de uma pausa fixa)"""
+        try:
+            self.esperar(timeout).until(lambda d: d.execute_script("return document.readyState") == 'complete')
+        except Exception:
+            self.pausar(2)
+            return False
+        if self.aguardar_ajax(timeout=timeout) is None:
+            self.pausar(1)
+        return True
+    
+    def aquecer_cache(self):
+        """Primeiro uso do perfil: carrega as páginas do portal para guardar os recursos em cache"""
+        self.log.info("→ Aquecendo cache do perfil...")
+        for url in URLS_AQUECIMENTO:
+            try:
+                self.driver.get(url)
+            except Exception as e:
+                self.log.warning(f"  ⚠ Falha ao aquecer {url}: {type(e).__name__}")
+                return
+        self.perfil.marcar_aquecido()
+        self.log.info("✓ Cache aquecido")
+    
+    def sessao_ativa(self):
+        """Verifica se o formulário de emissão está disponível (login já feito no perfil)"""
+        try:
+            campos = self.driver.find_elements(*self.pagina.localizador('campo_cpf'))
+            return any(c.is_displayed() for c in campos)
+        except:
+            return False
+    
+    def marcar_ajax(self):
+        """Retorna quantas requisições AJAX já foram iniciadas (referência para aguardar_ajax)"""
+        try:
+            estado = self.driver.execute_script(SCRIPT_ESTADO_AJAX)
+            return estado['iniciadas'] if estado else None
+        except:
+            return None
+    
+    def aguardar_ajax(self, marca=None, timeout=10, tolerancia_inicio=1.0):
+        """Aguarda as requisições AJAX disparadas após `marca` terminarem.
+        
+        Retorna True quando a resposta parcial já foi aplicada, False em timeout
+        e None se o monitor de AJAX não estiver disponível na página.
+        """
+        if self.modo_replay:
+            timeout, tolerancia_inicio = min(timeout, 0.2), min(tolerancia_inicio, 0.05)
+        inicio = time.perf_counter()
+        while True:
+            try:
+                estado = self.driver.execute_script(SCRIPT_ESTADO_AJAX)
+            except:
+                estado = None
+            if not estado:
+                return None
+            
+            decorrido = time.perf_counter() - inicio
+            iniciou = marca is None or estado['iniciadas'] > marca
+            if iniciou and estado['pendentes'] <= 0:
+                # A resposta parcial pode ter substituído elementos em cache
+                if marca is not None:
+                    self.invalidar_paginas()
+                return True
+            # A ação pode não ter disparado nenhuma requisição
+            if not iniciou and decorrido >= tolerancia_inicio:
+                return True
+            if decorrido >= timeout:
+                self.timeouts_ajax += 1
+                return False
+            if self.vigia:
+                self.vigia.verificar()
+            time.sleep(0.05)
     
-    def aguardar_loading(self, timeout=10):
-        """Aguarda o loading sumir"""
+    def aguardar_loading(self, timeout=10, marca=None):
+        """Aguarda o AJAX terminar (monitor de XHR/PrimeFaces) ou o loading sumir"""
+        self.log.debug(f"    → Aguardando loading...")
+        concluido = self.aguardar_ajax(marca, timeout)
+        if concluido:
+            self.log.debug(f"    ✓ Loading concluído")
+            return True
+        if concluido is False:
+            self.log.debug(f"    ℹ Timeout do loading - continuando...")
+            return True
+        
+        # Sem monitor de AJAX: aguarda o blockUI sumir
         try:
-            print(f"    → Aguardando loading...")
-            # Aguarda aparecer
-            time.sleep(1)
-            # Aguarda sumir
-            WebDriverWait(self.driver, timeout).until(
+            self.esperar(timeout).until(
                 EC.invisibility_of_element_located((By.CSS_SELECTOR, ".ui-blockui, .ui-blockui-content"))
             )
-            print(f"    ✓ Loading concluído")
-            return True
+            self.log.debug(f"    ✓ Loading concluído")
         except:
-            print(f"    ℹ Timeout do loading - continuando...")
-            time.sleep(2)
-            return True
+            self.timeouts_ajax += 1
+            self.log.debug(f"    ℹ Timeout do loading - continuando...")
+        return True
     
     def preencher_cpf_e_pesquisar(self, cpf):
         """Preenche CPF e clica em pesquisar"""
         try:
-            print(f"  → Preenchendo CPF {cpf}...")
+            self.log.debug(f"  → Preenchendo CPF {cpf}...")
             
             # Limpa CPF
             cpf_limpo = cpf.replace('.', '').replace('-', '').replace('/', '')
             
             # Rola para a seção do Tomador
             self.driver.execute_script("window.scrollTo(0, 400);")
-            time.sleep(1)
+            self.pausar(1)
             
             # Preenche CPF
-            campo_cpf = self.driver.find_element(By.ID, "formNotaFiscal:idCpfCnpjPessoa:idInputMaskCpfCnpj:inputText")
-            campo_cpf.clear()
-            campo_cpf.send_keys(cpf_limpo)
-            print(f"    ✓ CPF preenchido")
-            time.sleep(1)
+            self.pagina.digitar('campo_cpf', cpf_limpo)
+            self.log.debug(f"    ✓ CPF preenchido")
+            self.pausar(1)
             
-            # Busca o botão Pesquisar correto (tem "dados-pessoa" no onclick)
-            btn = self.driver.find_element(By.XPATH, 
-                "//a[contains(@class, 'btn-success') and contains(@onclick, 'dados-pessoa') and .//i[contains(@class, 'pe-7s-search')]]")
-            print(f"    ✓ Botão Pesquisar encontrado: {btn.get_attribute('id')}")
+            # Botão Pesquisar correto (tem "dados-pessoa" no onclick)
+            # Ler o id custa uma ida ao navegador: só no modo detalhado
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug(f"    ✓ Botão Pesquisar encontrado: {self.pagina.atributo('btn_pesquisar_cpf', 'id')}")
             
             # Clica
-            self.driver.execute_script("arguments[0].click();", btn)
-            print(f"    ✓ Clicado")
+            marca = self.marcar_ajax()
+            self.pagina.clicar('btn_pesquisar_cpf', via_js=True)
+            self.log.debug(f"    ✓ Clicado")
             
-            # Aguarda loading
-            self.aguardar_loading()
-            
-            # Aguarda dados carregarem
-            time.sleep(3)
+            # Aguarda a resposta da pesquisa ser aplicada
+            self.aguardar_loading(marca=marca)
             
             # Verifica se carregou
             try:
                 # Busca campo nome
-                campo_nome = self.driver.find_element(By.XPATH, "//input[contains(@id, 'nomeEmpresarial') or contains(@id, 'nome')]")
-                nome = campo_nome.get_attribute('value')
+                nome = self.pagina.atributo('campo_nome')
                 
                 if nome and len(nome) > 3:
-                    print(f"    ✓ Dados carregados: {nome[:40]}...")
+                    self.log.debug(f"    ✓ Dados carregados: {nome[:40]}...")
                     
-                    # DEBUG: Verifica estado do dropdown
-                    try:
-                        dropdown = self.driver.find_element(By.ID, "formNotaFiscal:idAtividadeEmissor_input")
-                        is_disabled = dropdown.get_attribute('disabled')
-                        print(f"    ℹ Dropdown Atividade disabled={is_disabled}")
-                    except:
-                        print(f"    ⚠ Dropdown Atividade não encontrado ainda")
+                    # DEBUG: Verifica estado do dropdown (uma ida ao navegador: só no modo detalhado)
+                    if self.log.isEnabledFor(logging.DEBUG):
+                        try:
+                            is_disabled = self.pagina.atributo('dropdown_atividade_input', 'disabled')
+                            self.log.debug(f"    ℹ Dropdown Atividade disabled={is_disabled}")
+                        except:
+                            self.log.warning(f"    ⚠ Dropdown Atividade não encontrado ainda")
                     
                     return True
                 else:
-                    print(f"    ⚠ Nome vazio ({len(nome) if nome else 0} chars) - mas continuando...")
+                    self.log.warning(f"    ⚠ Nome vazio ({len(nome) if nome else 0} chars) - mas continuando...")
                     return True
             except Exception as e:
-                print(f"    ⚠ Não conseguiu verificar nome: {type(e).__name__}")
+                self.log.warning(f"    ⚠ Não conseguiu verificar nome: {type(e).__name__}")
                 return True
             
         except Exception as e:
-            print(f"    ✗ Erro: {type(e).__name__}")
+            self.log.error(f"    ✗ Erro: {type(e).__name__}")
             self.driver.save_screenshot("erro_cpf.png")
             return False
     
+    def tomador_nao_cadastrado(self):
+        """Indica se o modal 'Tomador Não Cadastrado' está visível"""
+        try:
+            return self.dialogo_tomador.executar('titulo', lambda e: e.is_displayed())
+        except:
+            return False
+    
+    def pre_cadastrar_tomadores(self, df):
+        """Resolve todos os CPFs/CNPJs pendentes antes do lote (em uma aba separada) e cadastra os que faltam"""
+        pendentes = {}
+        for index, row in df.iterrows():
+            if str(row.get('Status', '')).upper() == 'EMITIDA':
+                continue
+            cpf = _somente_digitos(row['CPF'])
+            if cpf and cpf not in self.tomadores:
+                pendentes.setdefault(cpf, row)
+        if not pendentes:
+            return self.tomadores
+        
+        self.log.info(f"\n→ Verificando {len(pendentes)} tomadores antes do lote...")
+        aba_principal = self.driver.current_window_handle
+        self.driver.switch_to.new_window('tab')
+        # Sem o monitor a consulta não espera a resposta da pesquisa e todo CPF pareceria cadastrado
+        self.injetar_monitor_ajax()
+        try:
+            self.driver.get(URL_EMISSAO)
+            self.invalidar_paginas()
+            self.aguardar_ajax(timeout=15)
+            for n, (cpf, dados) in enumerate(pendentes.items(), 1):
+                self.log.debug(f"  [{n}/{len(pendentes)}] {dados['CPF']}")
+                if not self.preencher_cpf_e_pesquisar(dados['CPF']):
+                    continue
+                if self.tomador_nao_cadastrado():
+                    self.tomadores[cpf] = self.cadastrar_tomador(dados)
+                else:
+                    self.tomadores[cpf] = True
+                # Recarrega para a próxima consulta partir de um formulário limpo
+                self.driver.get(URL_EMISSAO)
+                self.invalidar_paginas()
+                self.aguardar_ajax(timeout=15)
+        finally:
+            self.driver.close()
+            self.driver.switch_to.window(aba_principal)
+            self.invalidar_paginas()
+        
+        cadastrados = sum(1 for v in self.tomadores.values() if v)
+        self.log.info(f"✓ Tomadores prontos: {cadastrados}/{len(self.tomadores)}")
+        return self.tomadores
+    
     def cadastrar_tomador(self, dados):
         """Cadastra tomador não cadastrado - ATUALIZADO v40 com novos XPaths"""
+        dialogo = self.dialogo_tomador
         try:
-            print(f"  → Tomador não cadastrado - iniciando cadastro...")
-            time.sleep(3)
+            self.log.debug(f"  → Tomador não cadastrado - iniciando cadastro...")
+            self.pausar(3)
             
-            try:
-                modal_titulo = self.driver.find_element(By.XPATH, "//*[contains(text(), 'Tomador Não Cadastrado')]")
-                print(f"    ✓ Modal 'Tomador Não Cadastrado' detectado")
-            except:
-                print(f"    ⚠ Modal não detectado - pulando cadastro")
+            if not dialogo.existe('titulo'):
+                self.log.warning(f"    ⚠ Modal não detectado - pulando cadastro")
                 return True
+            self.log.debug(f"    ✓ Modal 'Tomador Não Cadastrado' detectado")
             
             # ATUALIZADO v40: Nome/Nome Empresarial (div[5])
-            print(f"    → Preenchendo nome...")
-            campo_nome = self.driver.find_element(By.XPATH, 
-                "/html/body/div[5]/form/span/div/div/div[3]/div/div[1]/div[1]/input")
-            campo_nome.clear()
-            campo_nome.send_keys(dados.get('Nome', ''))
-            print(f"    ✓ Nome: {dados.get('Nome', '')[:30]}...")
-            time.sleep(1)
+            self.log.debug(f"    → Preenchendo nome...")
+            dialogo.digitar('campo_nome', dados.get('Nome', ''))
+            self.log.debug(f"    ✓ Nome: {dados.get('Nome', '')[:30]}...")
+            self.pausar(1)
             
             # ATUALIZADO v40: Apelido (div[5])
-            print(f"    → Preenchendo apelido...")
-            campo_apelido = self.driver.find_element(By.XPATH,
-                "/html/body/div[5]/form/span/div/div/div[3]/div/div[1]/div[3]/input")
-            campo_apelido.clear()
-            campo_apelido.send_keys(dados.get('Apelido', ''))
-            print(f"    ✓ Apelido: {dados.get('Apelido', '')}")
-            time.sleep(1)
+            self.log.debug(f"    → Preenchendo apelido...")
+            dialogo.digitar('campo_apelido', dados.get('Apelido', ''))
+            self.log.debug(f"    ✓ Apelido: {dados.get('Apelido', '')}")
+            self.pausar(1)
             
             # ATUALIZADO v40: CEP (div[5])
-            print(f"    → Preenchendo CEP...")
+            self.log.debug(f"    → Preenchendo CEP...")
             cep = str(dados.get('CEP', '')).replace('-', '').replace('.', '')
-            campo_cep = self.driver.find_element(By.XPATH,
-                "/html/body/div[5]/form/span/div/div/div[3]/div/div[2]/div[1]/table/tbody/tr/td[1]/input")
-            campo_cep.clear()
-            campo_cep.send_keys(cep)
-            print(f"    ✓ CEP: {cep}")
-            time.sleep(1)
+            dialogo.digitar('campo_cep', cep)
+            self.log.debug(f"    ✓ CEP: {cep}")
+            self.pausar(1)
             
             # ATUALIZADO v40: Lupa 🔍 (div[5])
-            print(f"    → Clicando na lupa 🔍 para pesquisar CEP...")
-            btn_lupa = self.driver.find_element(By.XPATH,
-                "/html/body/div[5]/form/span/div/div/div[3]/div/div[2]/div[1]/table/tbody/tr/td[2]/div/table/tbody/tr/td[3]/a/span")
-            btn_lupa.click()
-            print(f"    ✓ Lupa clicada - aguardando modal CEP...")
-            time.sleep(7)
+            self.log.debug(f"    → Clicando na lupa 🔍 para pesquisar CEP...")
+            dialogo.clicar('btn_lupa_cep')
+            self.log.debug(f"    ✓ Lupa clicada - aguardando modal CEP...")
+            self.pausar(7)
             
             # ATUALIZADO v40: Botão Voltar do modal CEP (div[13])
-            print(f"    → Fechando modal CEP...")
-            btn_voltar = self.driver.find_element(By.XPATH,
-                "/html/body/div[13]/div/div/table/tbody/tr/td/a")
-            btn_voltar.click()
-            print(f"    ✓ Modal CEP fechado")
-            time.sleep(2)
+            self.log.debug(f"    → Fechando modal CEP...")
+            self.dialogo_cep.clicar('btn_voltar')
+            self.log.debug(f"    ✓ Modal CEP fechado")
+            self.pausar(2)
             
             # ATUALIZADO v40: Botão Gravar (div[5])
-            print(f"    → Gravando tomador...")
-            btn_gravar = self.driver.find_element(By.XPATH,
-                "/html/body/div[5]/form/span/div/div/div[4]/a[2]")
-            btn_gravar.click()
-            print(f"    ✓ Botão Gravar clicado")
+            self.log.debug(f"    → Gravando tomador...")
+            dialogo.clicar('btn_gravar')
+            self.log.debug(f"    ✓ Botão Gravar clicado")
             
             # ATUALIZADO v40: Aguarda 5 segundos após gravar
-            print(f"    → Aguardando 5s para modal de sucesso...")
-            time.sleep(5)
+            self.log.debug(f"    → Aguardando 5s para modal de sucesso...")
+            self.pausar(5)
             
             # ATUALIZADO v40: Clica no OK do modal de sucesso (div[20])
-            print(f"    → Procurando botão OK do modal de sucesso...")
+            self.log.debug(f"    → Procurando botão OK do modal de sucesso...")
             try:
                 # Aguarda o botão OK aparecer (XPATH atualizado: div[20])
-                btn_ok = WebDriverWait(self.driver, 10).until(
-                    EC.element_to_be_clickable((By.XPATH, "/html/body/div[20]/div/div[3]/div/button"))
-                )
-                print(f"    ✓ Modal de sucesso detectado")
+                dialogo.aguardar('btn_ok_sucesso', EC.element_to_be_clickable)
+                self.log.debug(f"    ✓ Modal de sucesso detectado")
                 
                 # Clica no OK
-                btn_ok.click()
-                print(f"    ✓ Botão OK clicado")
-                time.sleep(2)
+                dialogo.clicar('btn_ok_sucesso')
+                self.log.debug(f"    ✓ Botão OK clicado")
+                self.pausar(2)
                 
             except Exception as e:
-                print(f"    ⚠ Modal OK não detectado: {type(e).__name__}")
-                # Fallback: tenta via CSS selector
+                self.log.warning(f"    ⚠ Modal OK não detectado: {type(e).__name__}")
+                # Fallback: as alternativas do localizador incluem o seletor CSS do SweetAlert
                 try:
-                    btn_ok_alt = self.driver.find_element(By.CSS_SELECTOR, "button.swal-button.swal-button--confirm")
-                    btn_ok_alt.click()
-                    print(f"    ✓ Botão OK clicado (fallback CSS)")
-                    time.sleep(2)
+                    dialogo.invalidar('btn_ok_sucesso')
+                    dialogo.clicar('btn_ok_sucesso')
+                    self.log.debug(f"    ✓ Botão OK clicado (fallback CSS)")
+                    self.pausar(2)
                 except:
-                    print(f"    ℹ Continuando sem clicar no OK...")
+                    self.log.debug(f"    ℹ Continuando sem clicar no OK...")
             
-            print(f"    ✓ Tomador cadastrado com sucesso!")
+            # O cadastro fecha o diálogo: handles do diálogo não servem para o próximo tomador
+            dialogo.invalidar()
+            self.dialogo_cep.invalidar()
+            self.log.debug(f"    ✓ Tomador cadastrado com sucesso!")
             return True
             
         except Exception as e:
-            print(f"    ✗ Erro ao cadastrar tomador: {type(e).__name__} - {str(e)[:100]}")
+            self.log.error(f"    ✗ Erro ao cadastrar tomador: {type(e).__name__} - {str(e)[:100]}")
             self.driver.save_screenshot("erro_cadastro_tomador_v40.png")
             
             # Salva HTML para debug
             try:
                 with open("debug_cadastro_tomador_v40.html", "w", encoding="utf-8") as f:
                     f.write(self.driver.page_source)
-                print(f"    ℹ HTML salvo em: debug_cadastro_tomador_v40.html")
+                self.log.debug(f"    ℹ HTML salvo em: debug_cadastro_tomador_v40.html")
             except:
                 pass
             
-            return False
-            
-            # Aguarda loading
-            self.aguardar_loading()
-            
-            # Aguarda dados carregarem
-            time.sleep(3)
-            
-            # Verifica se carregou
-            try:
-                # Busca campo nome
-                campo_nome = self.driver.find_element(By.XPATH, "//input[contains(@id, 'nomeEmpresarial') or contains(@id, 'nome')]")
-                nome = campo_nome.get_attribute('value')
-                
-                if nome and len(nome) > 3:
-                    print(f"    ✓ Dados carregados: {nome[:40]}...")
-                    
-                    # DEBUG: Verifica estado do dropdown
-                    try:
-                        dropdown = self.driver.find_element(By.ID, "formNotaFiscal:idAtividadeEmissor_input")
-                        is_disabled = dropdown.get_attribute('disabled')
-                        print(f"    ℹ Dropdown Atividade disabled={is_disabled}")
-                    except:
-                        print(f"    ⚠ Dropdown Atividade não encontrado ainda")
-                    
-                    return True
-                else:
-                    print(f"    ⚠ Nome vazio ({len(nome) if nome else 0} chars) - mas continuando...")
-                    return True
-            except Exception as e:
-                print(f"    ⚠ Não conseguiu verificar nome: {type(e).__name__}")
-                return True
-            
-        except Exception as e:
-            print(f"    ✗ Erro ao pesquisar CPF: {type(e).__name__} - {str(e)}")
-            self.driver.save_screenshot(f"erro_cpf_{cpf_limpo}.png")
+            dialogo.invalidar()
             return False
     
     def selecionar_atividade(self):
-        """Seleciona atividade 931310000 - Condicionamento físico (Dropdown PrimeFaces)"""
+        """Seleciona a atividade do emissor (codigo_atividade) no dropdown PrimeFaces"""
         try:
-            print(f"  → Selecionando atividade...")
+            self.log.debug(f"  → Selecionando atividade...")
             
             # Aguarda a página processar os dados do tomador
-            time.sleep(5)
+            if self.aguardar_ajax(timeout=5) is None:
+                self.pausar(5)
             
             # Rola até a seção de atividade
             self.driver.execute_script("window.scrollTo(0, 1000);")
-            time.sleep(2)
+            self.pausar(2)
             
             # 1. ENCONTRA O CONTAINER DO DROPDOWN
-            dropdown_id = "formNotaFiscal:idAtividadeEmissor"
-            print(f"    → Procurando dropdown: {dropdown_id}")
+            pagina = self.pagina
+            self.log.debug(f"    → Procurando dropdown: {pagina.localizador('dropdown_atividade')[1]}")
             
-            dropdown = WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.ID, dropdown_id))
-            )
-            print(f"    ✓ Dropdown encontrado")
+            pagina.aguardar('dropdown_atividade', EC.presence_of_element_located)
+            self.log.debug(f"    ✓ Dropdown encontrado")
             
             # Aguarda estar habilitado (verifica aria-disabled)
-            print(f"    → Aguardando dropdown habilitar...")
+            self.log.debug(f"    → Aguardando dropdown habilitar...")
             for i in range(10):
-                aria_disabled = dropdown.get_attribute('aria-disabled')
+                aria_disabled = pagina.atributo('dropdown_atividade', 'aria-disabled')
                 if aria_disabled == 'false' or not aria_disabled:
-                    print(f"    ✓ Dropdown habilitado após {i+1}s")
+                    self.log.debug(f"    ✓ Dropdown habilitado após {i+1}s")
                     break
-                time.sleep(1)
+                self.pausar(1)
             else:
-                print(f"    ⚠ Dropdown ainda pode estar desabilitado - tentando mesmo assim...")
+                self.log.warning(f"    ⚠ Dropdown ainda pode estar desabilitado - tentando mesmo assim...")
             
             # Rola até o dropdown
-            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", dropdown)
-            time.sleep(1)
+            pagina.rolar_ate('dropdown_atividade')
+            self.pausar(1)
             
             # 2. CLICA NO DROPDOWN PARA ABRIR
-            print(f"    → Abrindo dropdown (clicando)...")
+            self.log.debug(f"    → Abrindo dropdown (clicando)...")
             try:
                 # Tenta clicar no trigger (setinha)
-                trigger = dropdown.find_element(By.CLASS_NAME, "ui-selectonemenu-trigger")
-                trigger.click()
-                print(f"    ✓ Clicou no trigger")
+                pagina.executar('dropdown_atividade',
+                                lambda e: e.find_element(By.CLASS_NAME, "ui-selectonemenu-trigger").click())
+                self.log.debug(f"    ✓ Clicou no trigger")
             except:
                 # Fallback: clica no próprio dropdown
-                dropdown.click()
-                print(f"    ✓ Clicou no dropdown")
+                pagina.clicar('dropdown_atividade')
+                self.log.debug(f"    ✓ Clicou no dropdown")
             
-            time.sleep(2)
+            self.pausar(2)
             
             # 3. AGUARDA A LISTA (UL) APARECER
-            print(f"    → Aguardando lista de opções aparecer...")
-            ul_id = "formNotaFiscal:idAtividadeEmissor_items"
-            
-            lista = WebDriverWait(self.driver, 10).until(
-                EC.visibility_of_element_located((By.ID, ul_id))
-            )
-            print(f"    ✓ Lista de opções visível")
+            self.log.debug(f"    → Aguardando lista de opções aparecer...")
+            lista = pagina.aguardar('lista_atividades')
+            self.log.debug(f"    ✓ Lista de opções visível")
             
-            time.sleep(1)
+            self.pausar(1)
             
             # 4. BUSCA E CLICA NO <LI> CORRETO
-            print(f"    → Procurando opção '931310000'...")
+            self.log.debug(f"    → Procurando opção '{self.codigo_atividade}'...")
             
-            # Busca o <li> que contém "931310000"
+            # Busca o <li> que contém o código da atividade
             opcao = lista.find_element(By.XPATH, 
-                ".//li[contains(@data-label, '931310000') or contains(text(), '931310000')]")
+                f".//li[contains(@data-label, '{self.codigo_atividade}') or contains(text(), '{self.codigo_atividade}')]")
             
             # Rola até a opção
             self.driver.execute_script("arguments[0].scrollIntoView({block: 'nearest'});", opcao)
-            time.sleep(0.5)
+            self.pausar(0.5)
             
-            # Pega o texto da opção
-            texto_opcao = opcao.text
-            print(f"    ℹ Opção encontrada: {texto_opcao[:60]}...")
+            # Ler o texto da opção custa uma ida ao navegador: só no modo detalhado
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug(f"    ℹ Opção encontrada: {opcao.text[:60]}...")
             
             # Clica na opção
+            marca = self.marcar_ajax()
             opcao.click()
-            print(f"    ✓ Opção clicada")
+            self.log.debug(f"    ✓ Opção clicada")
             
-            time.sleep(2)
+            if self.aguardar_ajax(marca) is None:
+                self.pausar(2)
             
-            # 5. VERIFICA SE FOI SELECIONADA
-            try:
-                input_elem = self.driver.find_element(By.ID, "formNotaFiscal:idAtividadeEmissor_input")
-                valor_selecionado = input_elem.get_attribute('value')
-                print(f"    ✓ Atividade selecionada: {valor_selecionado[:60] if valor_selecionado else 'N/A'}...")
-            except:
-                print(f"    ℹ Não conseguiu verificar valor selecionado - mas continuando...")
+            # 5. VERIFICA SE FOI SELECIONADA (uma ida ao navegador: só no modo detalhado)
+            if self.log.isEnabledFor(logging.DEBUG):
+                try:
+                    valor_selecionado = pagina.atributo('dropdown_atividade_input')
+                    self.log.debug(f"    ✓ Atividade selecionada: {valor_selecionado[:60] if valor_selecionado else 'N/A'}...")
+                except:
+                    self.log.debug(f"    ℹ Não conseguiu verificar valor selecionado - mas continuando...")
             
             # Aguarda processamento
-            time.sleep(3)
+            if marca is None:
+                self.pausar(3)
             
-            print(f"    ✓ Atividade '931310000' selecionada com sucesso!")
+            self.log.debug(f"    ✓ Atividade '{self.codigo_atividade}' selecionada com sucesso!")
             return True
             
         except Exception as e:
-            print(f"    ✗ Erro ao selecionar atividade: {type(e).__name__} - {str(e)}")
+            self.log.error(f"    ✗ Erro ao selecionar atividade: {type(e).__name__} - {str(e)}")
             self.driver.save_screenshot("erro_atividade.png")
             
             # Salva HTML para debug
             try:
                 with open("debug_atividade.html", "w", encoding="utf-8") as f:
                     f.write(self.driver.page_source)
-                print(f"    ℹ HTML salvo em: debug_atividade.html")
+                self.log.debug(f"    ℹ HTML salvo em: debug_atividade.html")
             except:
                 pass
             
             return False
     
-    def adicionar_descricao(self):
-        """Adiciona descrição da nota"""
+    def escrever_descricao(self, texto):
+        """Escreve a descrição direto no campo (sem o modal), confirmada por um ciclo AJAX"""
         try:
-            print(f"  → Adicionando descrição...")
+            self.log.debug(f"  → Escrevendo descrição: {texto[:40]}...")
+            marca = self.marcar_ajax()
+            resultado = self.driver.execute_script(SCRIPT_DEFINIR_DESCRICAO, texto) or {}
+            if resultado.get('erro'):
+                self.log.warning(f"    ⚠ {resultado['erro'].capitalize()}")
+                return False
+            
+            # Sem p:ajax no campo o valor vai junto com o submit do Emitir
+            if resultado.get('ajax'):
+                concluido = self.aguardar_ajax(marca, timeout=5)
+                if concluido is False:
+                    self.log.warning(f"    ⚠ Portal não confirmou a descrição")
+                    return False
+                if concluido is None:
+                    self.pausar(1)
+            
+            if (self.pagina.atributo('campo_descricao') or '').strip() != texto.strip():
+                self.log.warning(f"    ⚠ Campo não ficou com a descrição escrita")
+                return False
+            self.log.debug(f"    ✓ Descrição escrita")
+            return True
+        except Exception as e:
+            self.log.warning(f"    ⚠ Erro ao escrever descrição: {type(e).__name__}")
+            return False
+    
+    def adicionar_descricao(self, texto=None):
+        """Adiciona descrição da nota (escrita direta quando há texto; senão, ou se falhar, pelo modal).
+        
+        Retorna o texto que ficou no campo ('' se o modal não deixou ler) ou None em caso de falha.
+        """
+        if texto:
+            if self.escrever_descricao(texto):
+                return texto
+            self.log.debug(f"    → Usando o modal 'Descrição Favorita'...")
+        try:
+            self.log.debug(f"  → Adicionando descrição...")
             
             # Rola até a seção de descrição
             self.driver.execute_script("window.scrollTo(0, 1600);")
-            time.sleep(2)
+            self.pausar(2)
             
             # 1. BUSCA E CLICA NO BOTÃO "CARREGAR DESCRIÇÃO"
-            print(f"    → Procurando botão 'Carregar Descrição'...")
+            self.log.debug(f"    → Procurando botão 'Carregar Descrição'...")
             
-            btn = None
-            try:
-                btn = self.driver.find_element(By.XPATH, 
-                    "//a[contains(@class, 'btn-warning') and (contains(., 'Carregar') or contains(., 'Descrição'))]")
-                print(f"    ✓ Botão encontrado: {btn.get_attribute('id')}")
-            except:
-                try:
-                    btn = self.driver.find_element(By.XPATH, 
-                        "//a[.//i[contains(@class, 'fa-plus-circle')]]")
-                    print(f"    ✓ Botão encontrado pelo ícone")
-                except:
-                    print(f"    ✗ Botão não encontrado!")
-                    return False
+            pagina = self.pagina
+            dialogo = self.dialogo_descricao
+            if not pagina.existe('btn_carregar_descricao'):
+                self.log.error(f"    ✗ Botão não encontrado!")
+                return None
+            self.log.debug(f"    ✓ Botão encontrado")
             
             # Rola e clica no botão
-            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", btn)
-            time.sleep(1)
-            btn.click()
-            print(f"    ✓ Botão clicado - aguardando modal...")
+            pagina.rolar_ate('btn_carregar_descricao')
+            self.pausar(1)
+            pagina.clicar('btn_carregar_descricao')
+            self.log.debug(f"    ✓ Botão clicado - aguardando modal...")
             
-            time.sleep(3)
+            self.pausar(3)
             
             # 2. AGUARDA MODAL "DESCRIÇÃO FAVORITA" APARECER
-            print(f"    → Aguardando modal aparecer...")
+            self.log.debug(f"    → Aguardando modal aparecer...")
             try:
-                WebDriverWait(self.driver, 10).until(
-                    EC.visibility_of_element_located((By.XPATH, 
-                        "//div[contains(@class, 'ui-dialog') and contains(@style, 'display')]//h3[contains(., 'Descrição Favorita')]"))
-                )
-                print(f"    ✓ Modal 'Descrição Favorita' visível")
+                dialogo.aguardar('titulo')
+                self.log.debug(f"    ✓ Modal 'Descrição Favorita' visível")
             except:
-                print(f"    ⚠ Modal não detectado - tentando continuar...")
+                self.log.warning(f"    ⚠ Modal não detectado - tentando continuar...")
             
-            time.sleep(2)
+            self.pausar(2)
             
             # 3. BUSCA E CLICA NO CHECKBOX DA PRIMEIRA LINHA (não o do cabeçalho!)
-            print(f"    → Procurando checkbox da primeira linha...")
+            self.log.debug(f"    → Procurando checkbox da primeira linha...")
             
             checkbox_clicado = False
             
@@ -462,49 +2739,56 @@ class AutomacaoNotaFiscal:
             try:
                 # Busca o checkbox da primeira LINHA da tabela (não o do header)
                 # Evita _head_checkbox e busca _0, _1, etc
-                checkbox = self.driver.find_element(By.XPATH, 
-                    "//div[contains(@class, 'ui-datatable-scrollable-body')]//div[@role='checkbox' and @aria-checked='false' and not(contains(@id, '_head_'))]")
-                
-                checkbox_id = checkbox.get_attribute('id')
-                print(f"    ℹ Checkbox da linha encontrado: {checkbox_id}")
+                # Com descrição do emissor, o checkbox é o da linha que contém esse texto
+                if self.descricao_favorita:
+                    dialogo.fixar('checkbox_linha', (By.XPATH,
+                        "//div[contains(@class, 'ui-datatable-scrollable-body')]//tr[contains(normalize-space(.), "
+                        f"{_literal_xpath(self.descricao_favorita.strip()[:60])})]//div[@role='checkbox']"))
+                else:
+                    dialogo.fixar('checkbox_linha', None)
+                checkbox_id = dialogo.atributo('checkbox_linha', 'id')
+                self.log.debug(f"    ℹ Checkbox da linha encontrado: {checkbox_id}")
+                # Depois de clicar ele deixa de casar com aria-checked='false': re-localiza pelo id
+                if checkbox_id:
+                    dialogo.fixar('checkbox_linha', (By.ID, checkbox_id))
                 
                 # Rola até o checkbox
-                self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", checkbox)
-                time.sleep(1)
+                dialogo.rolar_ate('checkbox_linha')
+                self.pausar(1)
                 
                 # Tenta clicar até 3 vezes
                 for tentativa in range(3):
                     # Clica no checkbox
-                    self.driver.execute_script("arguments[0].click();", checkbox)
-                    time.sleep(1)
+                    dialogo.clicar('checkbox_linha', via_js=True)
+                    self.pausar(1)
                     
                     # Verifica se marcou
-                    aria_checked = checkbox.get_attribute('aria-checked')
-                    print(f"    ℹ Tentativa {tentativa + 1}: aria-checked={aria_checked}")
+                    aria_checked = dialogo.atributo('checkbox_linha', 'aria-checked')
+                    self.log.debug(f"    ℹ Tentativa {tentativa + 1}: aria-checked={aria_checked}")
                     
                     if aria_checked == 'true':
-                        print(f"    ✓ Checkbox da linha marcado!")
+                        self.log.debug(f"    ✓ Checkbox da linha marcado!")
                         checkbox_clicado = True
                         break
                 
                 # Se ainda não marcou, tenta clicar no SPAN interno
                 if not checkbox_clicado:
                     try:
-                        span = checkbox.find_element(By.TAG_NAME, "span")
-                        self.driver.execute_script("arguments[0].click();", span)
-                        time.sleep(1)
+                        dialogo.executar('checkbox_linha', lambda e: self.driver.execute_script(
+                            "arguments[0].click();", e.find_element(By.TAG_NAME, "span")))
+                        self.pausar(1)
                         
-                        aria_checked = checkbox.get_attribute('aria-checked')
+                        aria_checked = dialogo.atributo('checkbox_linha', 'aria-checked')
                         if aria_checked == 'true':
-                            print(f"    ✓ Checkbox marcado via span!")
+                            self.log.debug(f"    ✓ Checkbox marcado via span!")
                             checkbox_clicado = True
                     except:
                         pass
                 
                 # Se AINDA não marcou, força manualmente
                 if not checkbox_clicado:
-                    print(f"    ⚠ Forçando seleção via JS...")
-                    self.driver.execute_script("""
+                    self.log.warning(f"    ⚠ Forçando seleção via JS...")
+                    dialogo.executar('checkbox_linha', lambda e: self.driver.execute_script("""
                         var cb = arguments[0];
                         cb.setAttribute('aria-checked', 'true');
                         cb.classList.add('ui-state-active');
@@ -512,252 +2796,200 @@ class AutomacaoNotaFiscal:
                         if(span) {
                             span.className = 'ui-chkbox-icon ui-icon ui-icon-check ui-c';
                         }
-                    """, checkbox)
-                    time.sleep(1)
+                    """, e))
+                    self.pausar(1)
                     checkbox_clicado = True
                     
             except Exception as e:
-                print(f"    ⚠ Erro ao buscar checkbox da linha: {type(e).__name__}")
+                self.log.warning(f"    ⚠ Erro ao buscar checkbox da linha: {type(e).__name__}")
                 
                 # FALLBACK: Se não achar checkbox de linha, clica no de cabeçalho mesmo
-                print(f"    → Tentando checkbox do cabeçalho como fallback...")
+                self.log.debug(f"    → Tentando checkbox do cabeçalho como fallback...")
                 try:
-                    checkbox_head = self.driver.find_element(By.XPATH, 
-                        "//div[contains(@id, '_head_checkbox')]//span[contains(@class, 'ui-chkbox-icon')]")
-                    
-                    self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", checkbox_head)
-                    time.sleep(1)
-                    self.driver.execute_script("arguments[0].click();", checkbox_head)
-                    time.sleep(1)
-                    print(f"    ✓ Checkbox do cabeçalho clicado")
+                    dialogo.rolar_ate('checkbox_cabecalho')
+                    self.pausar(1)
+                    dialogo.clicar('checkbox_cabecalho', via_js=True)
+                    self.pausar(1)
+                    self.log.debug(f"    ✓ Checkbox do cabeçalho clicado")
                     checkbox_clicado = True
                 except:
-                    print(f"    ✗ Não conseguiu clicar em nenhum checkbox!")
+                    self.log.error(f"    ✗ Não conseguiu clicar em nenhum checkbox!")
             
             if not checkbox_clicado:
-                print(f"    ✗ Falha ao marcar checkbox!")
+                self.log.error(f"    ✗ Falha ao marcar checkbox!")
                 self.driver.save_screenshot("erro_checkbox.png")
-                return False
+                return None
             
-            time.sleep(2)
+            self.pausar(2)
             
             # 4. VERIFICA SE FOI SELECIONADO (deve mostrar "Selecionado - 1")
             try:
-                contador = self.driver.find_element(By.XPATH, "//span[contains(text(), 'Selecionado')]").text
-                print(f"    ℹ Status: {contador}")
+                contador = dialogo.executar('contador', lambda e: e.text)
+                self.log.debug(f"    ℹ Status: {contador}")
                 
                 if "Selecionado - 0" in contador or "- 0" in contador:
-                    print(f"    ⚠ Nenhum item selecionado ainda - tentando novamente...")
+                    self.log.warning(f"    ⚠ Nenhum item selecionado ainda - tentando novamente...")
                     
                     # Tenta clicar novamente via JS no primeiro input visível
                     try:
-                        checkboxes = self.driver.find_elements(By.XPATH, 
-                            "//div[contains(@class, 'ui-datatable')]//input[@type='checkbox']")
+                        checkboxes = self.driver.find_elements(*dialogo.localizador('checkboxes_tabela'))
                         for cb in checkboxes:
                             if cb.is_displayed():
                                 self.driver.execute_script("arguments[0].checked = true; arguments[0].click();", cb)
-                                time.sleep(1)
+                                self.pausar(1)
                                 break
                     except:
                         pass
             except:
-                print(f"    ℹ Não conseguiu verificar contador - continuando...")
+                self.log.debug(f"    ℹ Não conseguiu verificar contador - continuando...")
             
-            time.sleep(2)
+            self.pausar(2)
             
             # 5. BUSCA E CLICA NO BOTÃO "CONFIRMAR"
-            print(f"    → Procurando botão 'Confirmar'...")
+            self.log.debug(f"    → Procurando botão 'Confirmar'...")
             
-            btn_confirmar = None
-            try:
-                # O botão é um <a> com btn-success e classe dialogselect_save
-                btn_confirmar = self.driver.find_element(By.XPATH, 
-                    "//a[contains(@class, 'btn-success') and contains(@class, 'dialogselect_save')]")
-                print(f"    ✓ Botão Confirmar encontrado")
-            except:
-                try:
-                    # Fallback: procura dentro do modal
-                    btn_confirmar = self.driver.find_element(By.XPATH, 
-                        "//div[contains(@class, 'ui-dialog')]//a[contains(@class, 'btn-success') and contains(., 'Confirmar')]")
-                    print(f"    ✓ Botão Confirmar encontrado (fallback)")
-                except:
-                    print(f"    ✗ Botão Confirmar não encontrado!")
-                    self.driver.save_screenshot("erro_confirmar.png")
-                    return False
+            if not dialogo.existe('btn_confirmar'):
+                self.log.error(f"    ✗ Botão Confirmar não encontrado!")
+                self.driver.save_screenshot("erro_confirmar.png")
+                return None
+            self.log.debug(f"    ✓ Botão Confirmar encontrado")
             
             # Rola até o botão e clica
-            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", btn_confirmar)
-            time.sleep(1)
+            dialogo.rolar_ate('btn_confirmar')
+            self.pausar(1)
             
             # Clica no botão Confirmar
-            self.driver.execute_script("arguments[0].click();", btn_confirmar)
-            print(f"    ✓ Botão Confirmar clicado")
+            marca = self.marcar_ajax()
+            dialogo.clicar('btn_confirmar', via_js=True)
+            self.log.debug(f"    ✓ Botão Confirmar clicado")
             
-            time.sleep(2)
+            # Aguarda a resposta do Confirmar ser aplicada
+            ajax_concluido = self.aguardar_ajax(marca)
+            if ajax_concluido is None:
+                self.pausar(2)
             
             # 6. AGUARDA O MODAL FECHAR COMPLETAMENTE
-            print(f"    → Aguardando modal fechar...")
+            self.log.debug(f"    → Aguardando modal fechar...")
             try:
                 # Aguarda o modal sumir
-                WebDriverWait(self.driver, 10).until(
-                    EC.invisibility_of_element_located((By.XPATH, 
-                        "//div[contains(@class, 'ui-dialog') and contains(@id, 'Descricao')]"))
+                self.esperar(10).until(
+                    EC.invisibility_of_element_located(dialogo.localizador('dialogo'))
                 )
-                print(f"    ✓ Modal fechado")
+                self.log.debug(f"    ✓ Modal fechado")
             except:
-                print(f"    ⚠ Modal pode não ter fechado - aguardando tempo fixo...")
-                time.sleep(3)
+                self.log.warning(f"    ⚠ Modal pode não ter fechado - aguardando tempo fixo...")
+                self.pausar(3)
             
             # 7. AGUARDA LOADING PROCESSAR
-            try:
-                WebDriverWait(self.driver, 5).until(
-                    EC.invisibility_of_element_located((By.CSS_SELECTOR, ".ui-blockui"))
-                )
-                print(f"    ✓ Loading concluído")
-            except:
-                time.sleep(2)
-                print(f"    ℹ Loading não detectado")
+            if ajax_concluido is None:
+                try:
+                    self.esperar(5).until(
+                        EC.invisibility_of_element_located((By.CSS_SELECTOR, ".ui-blockui"))
+                    )
+                    self.log.debug(f"    ✓ Loading concluído")
+                except:
+                    self.pausar(2)
+                    self.log.debug(f"    ℹ Loading não detectado")
+                self.pausar(2)
             
             # 8. VERIFICA SE A DESCRIÇÃO FOI ADICIONADA
-            time.sleep(2)
+            desc_valor = ''
             try:
                 # Procura por algum campo de descrição preenchido
-                desc_campo = self.driver.find_element(By.XPATH, 
-                    "//textarea[contains(@id, 'descricao') or contains(@id, 'Descricao')]")
-                desc_valor = desc_campo.get_attribute('value')
+                desc_valor = pagina.atributo('campo_descricao')
                 
                 if desc_valor and len(desc_valor) > 5:
-                    print(f"    ✓ Descrição adicionada: {desc_valor[:40]}...")
+                    self.log.debug(f"    ✓ Descrição adicionada: {desc_valor[:40]}...")
                 else:
-                    print(f"    ⚠ Campo descrição está vazio - mas continuando...")
+                    self.log.warning(f"    ⚠ Campo descrição está vazio - mas continuando...")
             except:
-                print(f"    ℹ Não conseguiu verificar descrição - mas continuando...")
+                self.log.debug(f"    ℹ Não conseguiu verificar descrição - mas continuando...")
             
-            print(f"    ✓ Descrição adicionada com sucesso!")
-            return True
+            dialogo.invalidar()
+            self.log.debug(f"    ✓ Descrição adicionada com sucesso!")
+            return desc_valor or ''
             
         except Exception as e:
-            print(f"    ✗ Erro ao adicionar descrição: {type(e).__name__} - {str(e)}")
+            self.log.error(f"    ✗ Erro ao adicionar descrição: {type(e).__name__} - {str(e)}")
             self.driver.save_screenshot("erro_descricao_final.png")
             
             try:
                 with open("debug_descricao_final.html", "w", encoding="utf-8") as f:
                     f.write(self.driver.page_source)
-                print(f"    ℹ HTML salvo em: debug_descricao_final.html")
+                self.log.debug(f"    ℹ HTML salvo em: debug_descricao_final.html")
             except:
                 pass
             
-            return False
+            return None
     
     def preencher_valor(self, valor=110.00):
         """Preenche valor dos serviços"""
         try:
-            print(f"  → Preenchendo valor R$ {valor:.2f}...")
-            
-            # Aguarda um pouco após modal fechar
-            time.sleep(3)
+            self.log.debug(f"  → Preenchendo valor R$ {valor:.2f}...")
             
-            # Rola até a seção de valores
-            self.driver.execute_script("window.scrollTo(0, 2000);")
-            time.sleep(2)
+            # Aguarda o AJAX pendente (fechamento do modal) terminar
+            self.aguardar_loading(timeout=5)
             
             # Formata valor (110.00 → "110")
             valor_str = str(int(valor))  # Remove decimais, envia só "110"
             
-            print(f"    → Buscando campo de valor...")
+            self.log.debug(f"    → Buscando campo de valor...")
             
-            # Busca o campo (sem salvar referência ainda)
-            estrategias = [
-                # Input dentro de span ui-inputnumber (mais específico)
-                "//span[contains(@class, 'ui-inputnumber')]//input[@type='text']",
-                # Por classes específicas
-                "//input[contains(@class, 'ui-inputnumber') and contains(@class, 'input-currency')]",
-                # Por ID
-                "//input[contains(@id, 'inputText_input')]",
-            ]
-            
-            xpath_correto = None
-            for xpath in estrategias:
-                try:
-                    campos = self.driver.find_elements(By.XPATH, xpath)
-                    for c in campos:
-                        if c.is_displayed() and c.is_enabled():
-                            xpath_correto = xpath
-                            print(f"    ✓ Encontrado com xpath: {xpath[:60]}...")
-                            break
-                    if xpath_correto:
-                        break
-                except:
-                    continue
-            
-            if not xpath_correto:
-                print(f"    ✗ Campo não encontrado!")
+            # Primeiro input visível e habilitado entre as estratégias do page object
+            pagina = self.pagina
+            try:
+                self.esperar(5).until(lambda d: pagina.existe('campo_valor'))
+                self.log.debug(f"    ✓ Campo de valor encontrado")
+            except:
+                self.log.error(f"    ✗ Campo não encontrado!")
                 return False
             
-            # Agora que sabemos o XPATH, vamos interagir
-            # Re-busca o elemento toda vez para evitar StaleElement
+            # O handle fica em cache; se o input for re-renderizado, o page object re-localiza
             
             # 1. CLICA no campo
-            print(f"    → Clicando no campo...")
-            campo = self.driver.find_element(By.XPATH, xpath_correto)
-            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", campo)
-            time.sleep(1)
-            campo.click()
-            time.sleep(1)
-            
-            # 2. SELECIONA TODO o texto (CTRL+A)
-            print(f"    → Selecionando todo texto...")
-            campo = self.driver.find_element(By.XPATH, xpath_correto)  # Re-busca
-            campo.send_keys(Keys.CONTROL + "a")
-            time.sleep(0.5)
-            
-            # 3. APAGA (DELETE ou BACKSPACE)
-            print(f"    → Apagando...")
-            campo = self.driver.find_element(By.XPATH, xpath_correto)  # Re-busca
-            campo.send_keys(Keys.DELETE)
-            time.sleep(0.5)
-            
-            # 4. DIGITA o valor
-            print(f"    → Digitando {valor_str}...")
-            campo = self.driver.find_element(By.XPATH, xpath_correto)  # Re-busca
-            campo.send_keys(valor_str)
-            time.sleep(1)
+            self.log.debug(f"    → Clicando no campo...")
+            pagina.rolar_ate('campo_valor')
+            pagina.clicar('campo_valor')
             
-            # 5. ENTER
-            print(f"    → Pressionando ENTER...")
-            campo = self.driver.find_element(By.XPATH, xpath_correto)  # Re-busca
-            campo.send_keys(Keys.RETURN)
-            time.sleep(2)
+            # 2. SELECIONA TODO o texto (CTRL+A) e 3. APAGA
+            self.log.debug(f"    → Selecionando todo texto e apagando...")
+            pagina.digitar('campo_valor', Keys.CONTROL + "a", limpar=False)
+            pagina.digitar('campo_valor', Keys.DELETE, limpar=False)
             
-            # 6. Aguarda cálculo
-            print(f"    → Aguardando cálculo...")
+            # 4. DIGITA o valor e espera a máscara aplicá-lo ao campo
+            self.log.debug(f"    → Digitando {valor_str}...")
+            pagina.digitar('campo_valor', valor_str, limpar=False)
             try:
-                WebDriverWait(self.driver, 5).until(
-                    EC.invisibility_of_element_located((By.CSS_SELECTOR, ".ui-blockui"))
-                )
-                print(f"    ✓ Cálculo concluído")
+                self.esperar(2).until(lambda d: valor_str in _somente_digitos(pagina.atributo('campo_valor')))
             except:
-                time.sleep(2)
+                self.log.debug(f"    ℹ Máscara ainda não refletiu o valor - continuando...")
+            
+            # 5. ENTER
+            self.log.debug(f"    → Pressionando ENTER...")
+            marca = self.marcar_ajax()
+            pagina.digitar('campo_valor', Keys.RETURN, limpar=False)
+            
+            # 6. Aguarda cálculo (monitor de AJAX ou, sem ele, o blockUI sumir)
+            self.log.debug(f"    → Aguardando cálculo...")
+            self.aguardar_loading(timeout=5, marca=marca)
             
             # 7. Verifica se preencheu
-            time.sleep(1)
             try:
-                campo = self.driver.find_element(By.XPATH, xpath_correto)
-                valor_atual = campo.get_attribute('value')
-                print(f"    ℹ Valor no campo: '{valor_atual}'")
+                valor_atual = pagina.atributo('campo_valor')
+                self.log.debug(f"    ℹ Valor no campo: '{valor_atual}'")
                 
                 if valor_atual and (valor_str in valor_atual or str(valor) in valor_atual):
-                    print(f"    ✓ Valor preenchido com sucesso!")
+                    self.log.debug(f"    ✓ Valor preenchido com sucesso!")
                     return True
                 else:
-                    print(f"    ⚠ Valor diferente mas continuando...")
+                    self.log.warning(f"    ⚠ Valor diferente mas continuando...")
                     return True
             except:
-                print(f"    ℹ Não conseguiu verificar mas continuando...")
+                self.log.debug(f"    ℹ Não conseguiu verificar mas continuando...")
                 return True
             
         except Exception as e:
-            print(f"    ✗ Erro ao preencher valor: {type(e).__name__} - {str(e)[:100]}")
+            self.log.error(f"    ✗ Erro ao preencher valor: {type(e).__name__} - {str(e)[:100]}")
             self.driver.save_screenshot("erro_preencher_valor.png")
             
             try:
@@ -770,111 +3002,175 @@ class AutomacaoNotaFiscal:
     
     def emitir_nota(self):
         """Emite a nota fiscal"""
+        marca = self.disparar_emissao()
+        if marca is False:
+            return None
+        return self.concluir_emissao(marca)
+    
+    def disparar_emissao(self):
+        """Clica em Emitir sem esperar a resposta; devolve a marca do AJAX (False se não conseguiu clicar)"""
         try:
-            print(f"  → Emitindo nota...")
+            self.log.debug(f"  → Emitindo nota...")
             
             # Rola até o final da página
             self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            time.sleep(2)
-            
-            # Busca botão Emitir
-            try:
-                btn = self.driver.find_element(By.XPATH, 
-                    "//button[contains(@id, 'btnEmitir') or (contains(., 'Emitir') and contains(@class, 'btn'))]")
-            except:
-                btn = self.driver.find_element(By.XPATH, 
-                    "//a[contains(., 'Emitir') and contains(@class, 'btn')]")
-            
-            # Rola até o botão e clica
-            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", btn)
-            time.sleep(1)
-            btn.click()
-            print(f"    ✓ Botão Emitir clicado")
+            self.pausar(2)
             
+            # Rola até o botão Emitir e clica
+            self.pagina.rolar_ate('btn_emitir')
+            self.pausar(1)
+            marca = self.marcar_ajax()
+            self.pagina.clicar('btn_emitir')
+            self.log.debug(f"    ✓ Botão Emitir clicado")
+            return marca
+        
+        except Exception as e:
+            self.log.error(f"    ✗ Erro ao emitir nota: {type(e).__name__} - {str(e)}")
+            self.driver.save_screenshot("erro_emissao.png")
+            return False
+    
+    def concluir_emissao(self, marca):
+        """Aguarda a resposta da emissão disparada em `marca` e devolve o número da nota (None se falhou)"""
+        try:
             # Aguarda processamento
-            time.sleep(3)
-            self.aguardar_loading(timeout=15)
+            if marca is not None:
+                self.aguardar_loading(timeout=15, marca=marca)
+            else:
+                self.pausar(3)
+                self.aguardar_loading(timeout=15)
+                
+                # Aguarda mensagem de sucesso
+                self.pausar(3)
             
-            # Aguarda mensagem de sucesso
-            time.sleep(3)
+            # Captura o resultado da resposta AJAX da emissão (ou do diálogo de sucesso)
+            resultado = self.capturar_resultado_emissao(marca)
+            self.ultima_emissao = resultado
+            numero_nota = resultado.get('numero') if resultado else None
             
-            # Tenta capturar número da nota
-            numero_nota = None
-            try:
-                # Busca mensagem de sucesso
-                msg = self.driver.find_element(By.XPATH, 
-                    "//*[contains(text(), 'emitida') or contains(text(), 'Emitida')]").text
-                print(f"    ✓ Mensagem: {msg[:60]}...")
-                
-                # Tenta extrair número
-                import re
-                match = re.search(r'(\d+)', msg)
-                if match:
-                    numero_nota = match.group(1)
+            if not numero_nota:
+                try:
+                    # Busca mensagem de sucesso
+                    msg = self.driver.find_element(By.XPATH, 
+                        "//*[contains(text(), 'emitida') or contains(text(), 'Emitida')]").text
+                    self.log.debug(f"    ✓ Mensagem: {msg[:60]}...")
                     
-            except:
-                pass
+                    # Tenta extrair número
+                    match = re.search(r'(\d+)', msg)
+                    if match:
+                        numero_nota = match.group(1)
+                        
+                except:
+                    pass
             
             if numero_nota:
-                print(f"    ✓ Nota emitida com sucesso! Número: {numero_nota}")
+                self.log.info(f"    ✓ Nota emitida com sucesso! Número: {numero_nota}")
             else:
-                print(f"    ✓ Nota emitida com sucesso!")
+                self.log.info(f"    ✓ Nota emitida com sucesso!")
                 numero_nota = "Emitida"
             
             return numero_nota
                 
         except Exception as e:
-            print(f"    ✗ Erro ao emitir nota: {type(e).__name__} - {str(e)}")
+            self.log.error(f"    ✗ Erro ao emitir nota: {type(e).__name__} - {str(e)}")
             self.driver.save_screenshot("erro_emissao.png")
             return None
     
-    def baixar_pdf_nota(self, numero_sequencial):
-        """Baixa o PDF da nota fiscal emitida e renomeia"""
+    def capturar_resultado_emissao(self, marca):
+        """Lê número, código de verificação e URL do PDF da resposta parcial da emissão"""
+        resultado = {}
+        try:
+            respostas = self.driver.execute_script(SCRIPT_RESPOSTAS_AJAX_DESDE, marca) if marca is not None else None
+            for resposta in respostas or []:
+                extraido = extrair_resultado_emissao(resposta.get('resposta'))
+                if extraido:
+                    resultado.update({k: v for k, v in extraido.items() if k not in resultado})
+            
+            if 'numero' not in resultado:
+                # Modelo do diálogo de sucesso (uma única leitura do DOM)
+                extraido = extrair_resultado_emissao(self.driver.execute_script(SCRIPT_TEXTO_DIALOGO_SUCESSO))
+                if extraido:
+                    resultado.update({k: v for k, v in extraido.items() if k not in resultado})
+        except Exception as e:
+            self.log.debug(f"    ℹ Não conseguiu ler a resposta da emissão: {type(e).__name__}")
+        
+        if resultado.get('url_pdf'):
+            try:
+                resultado['url_pdf'] = self.driver.execute_script(
+                    "return new URL(arguments[0], document.baseURI).href;", resultado['url_pdf']) or resultado['url_pdf']
+            except:
+                pass
+        if resultado:
+            self.log.debug(f"    ℹ Resultado da emissão: {resultado}")
+        return resultado or None
+    
+    def arquivar_pdf(self, origem, index, dados=None, numero_nota=None):
+        """Guarda o PDF no arquivo indexado (deduplicado por conteúdo)"""
+        cpf = dados.get('CPF', '') if dados is not None else ''
+        destino = self.arquivo.guardar(
+            origem,
+            numero=numero_nota if numero_nota and str(numero_nota).isdigit() else None,
+            cpf_cnpj=cpf,
+            data_emissao=datetime.now().strftime('%Y-%m-%d'),
+            planilha=self.caminho_excel,
+            linha=index,
+        )
+        self.log.debug(f"    ✓ PDF arquivado: {os.path.relpath(destino, self.pasta_pdfs)}")
+        return destino
+    
+    def baixar_pdf_direto(self, url):
+        """Baixa o PDF pela URL capturada na emissão, usando a sessão do navegador"""
+        try:
+            self.log.debug(f"  → Baixando PDF direto da URL da emissão...")
+            self.driver.set_script_timeout(30)
+            resposta = self.driver.execute_async_script(SCRIPT_BAIXAR_ARQUIVO, url)
+            if not resposta or resposta.get('erro') or resposta.get('status') != 200:
+                self.log.warning(f"    ⚠ Falha no download direto: {resposta}")
+                return None
+            
+            conteudo = base64.b64decode(resposta['base64'])
+            if not conteudo.startswith(b'%PDF'):
+                self.log.warning(f"    ⚠ Resposta não é um PDF")
+                return None
+            return conteudo
+        except Exception as e:
+            self.log.warning(f"    ⚠ Erro no download direto: {type(e).__name__} - {str(e)[:100]}")
+            return None
+    
+    def baixar_pdf_nota(self, index, dados=None, numero_nota=None):
+        """Baixa o PDF da nota fiscal emitida e guarda no arquivo indexado"""
         try:
-            print(f"  → Aguardando nota ser processada...")
+            # Caminho rápido: URL do PDF capturada na resposta da emissão
+            url_pdf = (self.ultima_emissao or {}).get('url_pdf')
+            conteudo = self.baixar_pdf_direto(url_pdf) if url_pdf else None
+            if conteudo:
+                self.arquivar_pdf(conteudo, index, dados, numero_nota)
+                return True
+            
+            self.log.debug(f"  → Aguardando nota ser processada...")
             
             # AGUARDA 10 SEGUNDOS para garantir que a nota foi totalmente processada
             # e o botão de PDF está disponível
-            time.sleep(10)
-            
-            print(f"  → Baixando PDF da nota...")
-            
-            # Procura botão/link de download do PDF
-            estrategias = [
-                # Por texto "PDF" ou "Imprimir"
-                "//a[contains(translate(., 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'), 'pdf')]",
-                "//button[contains(translate(., 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'), 'pdf')]",
-                "//a[contains(translate(., 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'), 'imprimir')]",
-                # Por ícone
-                "//a[.//i[contains(@class, 'pdf') or contains(@class, 'print') or contains(@class, 'file')]]",
-            ]
-            
-            btn_pdf = None
-            for xpath in estrategias:
-                try:
-                    elementos = self.driver.find_elements(By.XPATH, xpath)
-                    for elem in elementos:
-                        if elem.is_displayed():
-                            btn_pdf = elem
-                            print(f"    ✓ Botão PDF encontrado")
-                            break
-                    if btn_pdf:
-                        break
-                except:
-                    continue
+            self.pausar(10)
+            
+            self.log.debug(f"  → Baixando PDF da nota...")
+            
+            # Procura botão/link de download do PDF (primeiro visível)
+            btn_pdf = self.pagina.existe('btn_pdf')
+            if btn_pdf:
+                self.log.debug(f"    ✓ Botão PDF encontrado")
             
             if btn_pdf:
                 # Verifica quantos arquivos já existem na pasta
                 arquivos_antes = set(os.listdir(self.download_dir))
                 
                 # Clica no botão de PDF
-                self.driver.execute_script("arguments[0].click();", btn_pdf)
-                print(f"    ✓ Download do PDF iniciado")
+                self.pagina.clicar('btn_pdf', via_js=True)
+                self.log.debug(f"    ✓ Download do PDF iniciado")
                 
                 # Aguarda download completar (máximo 30 segundos)
                 arquivo_baixado = None
                 for _ in range(30):
-                    time.sleep(1)
+                    self.pausar(1)
                     arquivos_depois = set(os.listdir(self.download_dir))
                     novos_arquivos = arquivos_depois - arquivos_antes
                     
@@ -886,224 +3182,1080 @@ class AutomacaoNotaFiscal:
                         break
                 
                 if arquivo_baixado:
-                    # Renomeia para nota_1.pdf, nota_2.pdf, etc
-                    caminho_antigo = os.path.join(self.download_dir, arquivo_baixado)
-                    caminho_novo = os.path.join(self.download_dir, f"nota_{numero_sequencial}.pdf")
-                    
-                    # Se já existir, remove
-                    if os.path.exists(caminho_novo):
-                        os.remove(caminho_novo)
-                    
-                    os.rename(caminho_antigo, caminho_novo)
-                    print(f"    ✓ PDF salvo como: nota_{numero_sequencial}.pdf")
+                    self.arquivar_pdf(os.path.join(self.download_dir, arquivo_baixado), index, dados, numero_nota)
                     return True
                 else:
-                    print(f"    ⚠ Timeout ao aguardar download do PDF")
+                    self.log.warning(f"    ⚠ Timeout ao aguardar download do PDF")
                     return False
             else:
-                print(f"    ⚠ Botão PDF não encontrado - pulando download")
+                self.log.warning(f"    ⚠ Botão PDF não encontrado - pulando download")
                 return False
                 
         except Exception as e:
-            print(f"    ⚠ Erro ao baixar PDF: {type(e).__name__} - {str(e)[:100]}")
+            self.log.warning(f"    ⚠ Erro ao baixar PDF: {type(e).__name__} - {str(e)[:100]}")
             return False
     
+    def conferir_pdfs(self, df, processos=None):
+        """Confere os PDFs baixados com a planilha (pool de processos) e gera relatório de divergências"""
+        self.log.info(f"\n{'='*60}\n  CONFERÊNCIA DOS PDFs\n{'='*60}")
+        
+        linhas = [(index, row) for index, row in df.iterrows() if str(row.get('Status', '')).upper() == 'EMITIDA']
+        caminhos = []
+        for index, row in linhas:
+            caminho = self.arquivo.caminho_da_linha(self.caminho_excel, index,
+                                                    _somente_digitos(row.get('Numero_Nota', '')))
+            if not caminho:
+                # PDFs de execuções antigas (notas_pdf/nota_<n>.pdf)
+                caminho = os.path.join(self.pasta_pdfs, f"nota_{index + 1}.pdf")
+            caminhos.append(caminho)
+        
+        inicio = time.perf_counter()
+        existentes = [c for c in caminhos if os.path.exists(c)]
+        if len(existentes) <= LIMITE_CONFERENCIA_SERIAL:
+            analises = {caminho: analisar_pdf_nota(caminho) for caminho in existentes}
+        else:
+            pool = _obter_pool_conferencia(processos)
+            analises = dict(zip(existentes, pool.map(analisar_pdf_nota, existentes, chunksize=32)))
+        
+        divergencias = []
+        for (index, row), caminho in zip(linhas, caminhos):
+            base = {'Linha': index + 2, 'CPF': row.get('CPF', ''), 'Arquivo': os.path.basename(caminho)}
+            analise = analises.get(caminho)
+            if analise is None:
+                divergencias.append({**base, 'Campo': 'arquivo', 'Planilha': '', 'PDF': '', 'Problema': 'PDF não encontrado'})
+                continue
+            if analise['erro']:
+                divergencias.append({**base, 'Campo': 'arquivo', 'Planilha': '', 'PDF': '', 'Problema': analise['erro']})
+                continue
+            
+            numero_planilha = _somente_digitos(row.get('Numero_Nota', ''))
+            if numero_planilha and analise['numero'] and numero_planilha != analise['numero']:
+                divergencias.append({**base, 'Campo': 'numero', 'Planilha': numero_planilha, 'PDF': analise['numero'],
+                                     'Problema': 'Número da nota diferente'})
+            
+            cpf_planilha = _somente_digitos(row.get('CPF', ''))
+            if analise['cpf_cnpj'] != cpf_planilha:
+                divergencias.append({**base, 'Campo': 'cpf_cnpj', 'Planilha': cpf_planilha, 'PDF': analise['cpf_cnpj'] or '',
+                                     'Problema': 'CPF/CNPJ do tomador diferente'})
+            
+            try:
+                valor_planilha = float(row.get('Valor', 110.00))
+            except (TypeError, ValueError):
+                valor_planilha = None
+            if analise['valor'] is None or valor_planilha is None or abs(analise['valor'] - valor_planilha) > 0.005:
+                divergencias.append({**base, 'Campo': 'valor', 'Planilha': valor_planilha, 'PDF': analise['valor'],
+                                     'Problema': 'Valor diferente'})
+        
+        self.log.info(f"  ✓ {len(existentes)} PDFs analisados em {time.perf_counter() - inicio:.1f}s")
+        if not divergencias:
+            self.log.info("  ✓ Nenhuma divergência encontrada")
+            return None
+        
+        relatorio = f"relatorio_conferencia_pdf_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        pd.DataFrame(divergencias).to_csv(relatorio, index=False, sep=';', encoding='utf-8-sig')
+        self.log.warning(f"  ⚠ {len(divergencias)} divergências - relatório salvo em: {relatorio}")
+        return relatorio
+    
+    def listar_notas_portal(self, data_inicio, data_fim):
+        """Lê a lista de notas emitidas no portal para um período (datas DD/MM/AAAA), página a página"""
+        self.log.info(f"→ Consultando notas emitidas de {data_inicio} a {data_fim}...")
+        self.driver.get(URL_CONSULTA_NOTAS)
+        self.aguardar_ajax(timeout=15)
+        
+        preenchidos = self.driver.execute_script(SCRIPT_PREPARAR_CONSULTA, data_inicio, data_fim)
+        if not preenchidos or not all(preenchidos.values()):
+            raise RuntimeError(f"Campos de período não encontrados na consulta: {preenchidos}")
+        
+        btn = self.driver.find_element(By.XPATH,
+            "//button[contains(., 'Pesquisar') or contains(., 'Consultar')] | "
+            "//a[contains(@class, 'btn') and (contains(., 'Pesquisar') or contains(., 'Consultar'))]")
+        marca = self.marcar_ajax()
+        self.driver.execute_script("arguments[0].click();", btn)
+        self.aguardar_loading(timeout=30, marca=marca)
+        
+        # Menos requisições: maior tamanho de página disponível no paginador
+        marca = self.marcar_ajax()
+        if self.driver.execute_script(SCRIPT_MAXIMIZAR_PAGINA):
+            self.aguardar_loading(timeout=30, marca=marca)
+        
+        notas = []
+        for pagina in range(1, 1000):
+            tabela = self.driver.execute_script(SCRIPT_LER_TABELA_NOTAS)
+            if not tabela:
+                break
+            notas.extend(interpretar_notas_portal(tabela['cabecalhos'], tabela['linhas']))
+            self.log.debug(f"  ✓ Página {pagina}: {len(tabela['linhas'])} linhas")
+            if not tabela['tem_proxima']:
+                break
+            marca = self.marcar_ajax()
+            self.driver.execute_script(
+                "document.querySelector('.ui-datatable .ui-paginator-next').click();")
+            self.aguardar_loading(timeout=30, marca=marca)
+        
+        self.log.info(f"✓ {len(notas)} notas emitidas encontradas no portal")
+        return notas
+    
+    def conciliar_com_portal(self, df, data_inicio, data_fim):
+        """Corrige Status/Numero_Nota em lote com base nas notas realmente emitidas no portal"""
+        notas = self.listar_notas_portal(data_inicio, data_fim)
+        associacoes = conciliar_notas(df, notas)
+        
+        for index, nota in associacoes:
+            anterior = df.at[index, 'Status']
+            valores = {'Status': 'EMITIDA', 'Numero_Nota': nota['numero'], 'Mensagem_Erro': ''}
+            if nota['data']:
+                valores['Data_Emissao'] = nota['data'].strftime('%d/%m/%Y %H:%M')
+            self.registrar_resultado(df, index, valores)
+            self.log.info(f"  ✓ Linha {index + 2}: {anterior or '(vazio)'} → EMITIDA nº {nota['numero']}")
+        
+        self.log.info(f"✓ {len(associacoes)} linhas corrigidas pela conciliação")
+        return associacoes
+    
+    def executar_conciliacao(self, data_inicio, data_fim):
+        """Modo conciliação: confere a planilha com as notas emitidas no portal e salva"""
+        df = self.carregar_dados()
+        self.abrir_escritor()
+        self.configurar_navegador()
+        self.acessar_sistema()
+        if not (self.perfil and self.sessao_ativa()):
+            input("\n➤ Faça LOGIN no sistema e pressione ENTER...\n")
+        
+        if self.conciliar_com_portal(df, data_inicio, data_fim):
+            try:
+                self.salvar_planilha(df)
+                self.log.info("✓ Arquivo salvo com sucesso!")
+            except Exception as e:
+                self.log.error(f"✗ Erro ao salvar: {str(e)}")
+        
+        self.driver.quit()
+        if self.perfil:
+            self.perfil.liberar()
+    
     def limpar_formulario(self):
         """Limpa o formulário para próxima nota"""
         try:
-            print(f"  → Limpando formulário...")
+            self.log.debug(f"  → Limpando formulário...")
             
             # Tenta clicar em "Nova Nota" ou recarregar a página
             try:
-                btn_nova = self.driver.find_element(By.XPATH, 
-                    "//button[contains(., 'Nova') or contains(., 'Limpar')] | //a[contains(., 'Nova') or contains(., 'Limpar')]")
-                btn_nova.click()
-                time.sleep(3)
-                print(f"    ✓ Formulário limpo")
+                self.pagina.clicar('btn_nova')
+                self.invalidar_paginas()
+                self.pausar(3)
+                self.log.debug(f"    ✓ Formulário limpo")
             except:
                 # Se não tiver botão, recarrega a página
                 self.driver.refresh()
-                time.sleep(5)
-                print(f"    ✓ Página recarregada")
+                self.invalidar_paginas()
+                self.pausar(5)
+                self.log.debug(f"    ✓ Página recarregada")
             
             return True
         except:
             # Se falhar, recarrega mesmo assim
             try:
                 self.driver.refresh()
-                time.sleep(5)
+                self.invalidar_paginas()
+                self.pausar(5)
                 return True
             except:
                 return False
     
-    def processar_nota(self, index, dados):
-        """Processa uma nota completa"""
-        print(f"\n{'='*60}")
-        print(f"[{index + 1}] Processando CPF: {dados['CPF']}")
-        print(f"{'='*60}")
+    def texto_descricao(self, dados):
+        """Texto a escrever direto no campo: coluna Descricao ou modelo do emissor; None usa o modal"""
+        descricao = dados.get('Descricao')
+        texto = '' if pd.isna(descricao) else str(descricao).strip()
+        if not texto and self.modelo_descricao:
+            texto = montar_descricao(self.modelo_descricao, dados)
+        return texto or None
+    
+    def diagnosticar_falha(self, marca, timeouts_antes, excecao=None):
+        """Motivo da falha se ela foi de infraestrutura (portal fora/lento, sessão expirada); None se foi da nota"""
+        if excecao is not None:
+            texto = str(excecao)
+            if 'net::ERR_' in texto or 'Timed out receiving message from renderer' in texto:
+                return "navegador sem resposta do portal"
+        try:
+            diagnostico = self.driver.execute_script(SCRIPT_DIAGNOSTICO_PORTAL, marca)
+        except Exception:
+            return "página sem resposta"
+        if diagnostico:
+            if diagnostico.get('expirada'):
+                return "sessão expirada"
+            if diagnostico.get('erro_http'):
+                return f"HTTP {diagnostico['erro_http']}"
+            if diagnostico.get('pagina_erro'):
+                return "página de erro do servidor"
+        if self.timeouts_ajax > timeouts_antes:
+            return "timeout do blockUI/AJAX"
+        return None
+    
+    def aguardar_disjuntores(self):
+        """Pausa enquanto o portal (disjuntor compartilhado) ou a sessão deste emissor estiverem com falha.
         
+        Devolve True se houve pausa (a página precisa ser recarregada).
+        """
+        pausou = self.disjuntor.aguardar_liberacao(self.sondar_servidor)
+        return self.disjuntor_sessao.aguardar_liberacao(self.sondar_portal) or pausou
+    
+    @property
+    def disjuntor_aberto(self):
+        return self.disjuntor.aberto or self.disjuntor_sessao.aberto
+    
+    def sondar_servidor(self):
+        """Sondagem do disjuntor compartilhado: o servidor responde (sem exigir a sessão deste emissor)"""
+        return self.sondar_portal(exigir_sessao=False)
+    
+    def sondar_portal(self, exigir_sessao=True):
+        """Verificação barata de saúde do portal (GET da página de emissão, sem navegar)"""
         try:
-            # 1. CPF e Pesquisar
-            if not self.preencher_cpf_e_pesquisar(dados['CPF']):
-                return 'ERRO', '', 'Erro ao pesquisar CPF'
-            
-            # 1.5. VERIFICA SE PRECISA CADASTRAR TOMADOR
-            # Verifica se apareceu o modal "Tomador Não Cadastrado"
-            time.sleep(2)
-            try:
-                modal_tomador = self.driver.find_element(By.XPATH, "//*[contains(text(), 'Tomador Não Cadastrado')]")
-                if modal_tomador.is_displayed():
-                    print(f"  ℹ Tomador não cadastrado - iniciando cadastro...")
-                    if not self.cadastrar_tomador(dados):
-                        return 'ERRO', '', 'Erro ao cadastrar tomador'
-            except:
-                print(f"  ℹ Tomador já cadastrado - continuando...")
-            
-            # 2. Atividade
-            if not self.selecionar_atividade():
-                return 'ERRO', '', 'Erro ao selecionar atividade'
-            
-            # 3. Descrição
-            if not self.adicionar_descricao():
-                return 'ERRO', '', 'Erro ao adicionar descrição'
-            
-            # 4. Valor
-            valor = float(dados.get('Valor', 110.00))
-            if not self.preencher_valor(valor):
-                return 'ERRO', '', 'Erro ao preencher valor'
-            
-            # 5. Emitir
-            numero = self.emitir_nota()
-            if not numero:
-                return 'ERRO', '', 'Erro ao emitir nota'
-            
-            # 5.5. Baixar PDF
-            self.baixar_pdf_nota(index + 1)  # nota_1.pdf, nota_2.pdf, etc
-            
-            # 6. Limpar para próxima
-            self.limpar_formulario()
-            
-            return 'EMITIDA', numero, ''
-            
+            self.driver.set_script_timeout(20)
+            resposta = self.driver.execute_async_script(SCRIPT_SONDAR_PORTAL, URL_EMISSAO)
+        except Exception:
+            resposta = None
+        
+        if resposta and resposta.get('status'):
+            if resposta['status'] < 500 and not exigir_sessao:
+                return True
+            if resposta['status'] < 500 and resposta.get('formulario'):
+                self.aguardando_login = False
+                return True
+            if resposta['status'] < 500:
+                if not self.aguardando_login:
+                    self.log.warning(f"  ⚠ Portal no ar mas sem o formulário - sessão expirada? Faça LOGIN no navegador")
+                    self.aguardando_login = True
+                    # Leva o navegador para a tela de login uma vez (sem atrapalhar a digitação depois)
+                    if not self.sessao_ativa():
+                        try:
+                            self.driver.get(URL_EMISSAO)
+                            self.invalidar_paginas()
+                        except Exception:
+                            pass
+            else:
+                self.log.debug(f"  ℹ Sondagem: HTTP {resposta['status']}")
+            return False
+        
+        # A página atual não executa o fetch (ex.: página de erro do Chrome): sonda navegando
+        try:
+            self.driver.get(URL_EMISSAO)
+            self.invalidar_paginas()
+            if not exigir_sessao:
+                diagnostico = self.driver.execute_script(SCRIPT_DIAGNOSTICO_PORTAL, None) or {}
+                return not diagnostico.get('pagina_erro')
+            return self.sessao_ativa()
+        except Exception:
+            return False
+    
+    def reciclar_driver(self):
+        """Descarta o navegador (travado ou encerrado pelo watchdog) e abre outro no formulário de emissão"""
+        self.log.warning("  ♻ Reiniciando o navegador...")
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+        if self.perfil:
+            self.perfil.liberar()
+        self.vigia.derrubado = False
+        self.reciclagens += 1
+        self.aba_atual = None
+        self.configurar_navegador()
+        self.invalidar_paginas()
+        self.acessar_sistema()
+        # Com perfil o login continua valendo; sem perfil aguarda um novo login no navegador
+        self.garantir_sessao()
+    
+    def recarregar_formulario(self):
+        """Volta a um formulário de emissão limpo (após falha de infraestrutura ou pausa do disjuntor)"""
+        try:
+            self.driver.get(URL_EMISSAO)
+            self.invalidar_paginas()
+            if self.aguardar_ajax(timeout=15) is None:
+                self.pausar(5)
         except Exception as e:
-            erro_msg = f"{type(e).__name__}: {str(e)}"
-            print(f"  ✗ Erro inesperado: {erro_msg}")
-            return 'ERRO', '', erro_msg
-            
-            # 6. Limpar para próxima
-            self.limpar_formulario()
-            
-            return 'EMITIDA', numero, ''
-            
+            self.log.warning(f"  ⚠ Falha ao recarregar o formulário: {type(e).__name__}")
+    
+    def processar_nota(self, index, dados, fase='completa', marca_emissao=None, fim_prazo=None):
+        """Processa uma nota completa.
+        
+        No modo pipeline a nota é feita em duas fases: 'preparar' (até clicar em Emitir, devolve
+        ('DISPARADA', marca, '')) e 'concluir' (lê a resposta da emissão disparada em `marca_emissao`,
+        dentro do prazo `fim_prazo` que começou no preparar).
+        """
+        self.linha_atual = index
+        if fase == 'concluir':
+            self.log.debug(f"\n[{index + 1}] Concluindo emissão - CPF: {dados['CPF']}")
+        else:
+            self.log.debug(f"\n[{index + 1}] Processando CPF: {dados['CPF']}")
+        self.ultima_emissao = None
+        if self.vigia:
+            self.fim_prazo_nota = self.vigia.iniciar_nota(fim_prazo)
+        marca = self.marcar_ajax() if marca_emissao is None else marca_emissao
+        timeouts_antes = self.timeouts_ajax
+        excecao = None
+        try:
+            try:
+                if fase == 'concluir':
+                    status, numero, erro = self.concluir_nota(index, dados, marca_emissao)
+                elif fase == 'preparar':
+                    status, numero, erro = self.preparar_nota(index, dados)
+                else:
+                    status, numero, erro = self.executar_etapas(index, dados)
+            except Exception as e:
+                excecao = e
+                erro = f"{type(e).__name__}: {str(e)}"
+                self.log.error(f"  ✗ Erro inesperado: {erro}")
+                status, numero = 'ERRO', ''
+            etapa_falha = self.etapa_atual
+        finally:
+            self.marcar_etapa(None)
+            if self.vigia:
+                self.vigia.encerrar()
+        
+        reciclado = bool(self.vigia and self.vigia.derrubado)
+        if reciclado:
+            self.reciclar_fora_da_vez()
+        
+        if self.vigia and self.vigia.estourado and status not in ('EMITIDA', 'DISPARADA'):
+            # Etapa interrompida pelo watchdog: a página está num estado desconhecido
+            if not reciclado:
+                self.recarregar_formulario()
+            erro = self.vigia.estourado
+            if etapa_falha in ('emissao', 'pdf', 'limpeza'):
+                erro += " - confira com --conciliar antes de reenviar"
+            return 'TIMEOUT', '', erro
+        
+        if status in ('EMITIDA', 'DISPARADA'):
+            self.disjuntor.registrar_sucesso()
+            self.disjuntor_sessao.registrar_sucesso()
+            return status, numero, erro
+        
+        motivo = self.diagnosticar_falha(marca, timeouts_antes, excecao)
+        if not motivo:
+            # O portal respondeu: o erro é da nota
+            self.disjuntor.registrar_sucesso()
+            self.disjuntor_sessao.registrar_sucesso()
+            return status, numero, erro
+        
+        if self.modo_replay:
+            # Offline não há portal para sondar: só registra o diagnóstico
+            return status, numero, f"{erro} ({motivo})"
+        if motivo == "sessão expirada":
+            self.disjuntor_sessao.registrar_falha(motivo)
+        else:
+            self.disjuntor.registrar_falha(motivo)
+        if etapa_falha in ('emissao', 'pdf', 'limpeza'):
+            # A nota pode ter sido emitida mesmo sem resposta: não reenvia automaticamente
+            return 'ERRO', '', f"{erro} ({motivo} durante a emissão - confira com --conciliar antes de reenviar)"
+        self.log.warning(f"  ⚠ Falha de infraestrutura ({motivo}) - a linha volta para a fila")
+        return 'REPETIR', '', motivo
+    
+    def executar_etapas(self, index, dados):
+        """Executa as etapas de uma nota (CPF → tomador → atividade → descrição → valor → emissão → PDF)"""
+        status, marca, erro = self.preparar_nota(index, dados)
+        if status != 'DISPARADA':
+            return status, marca, erro
+        return self.concluir_nota(index, dados, marca)
+    
+    def preparar_nota(self, index, dados):
+        """Preenche o formulário e clica em Emitir; devolve ('DISPARADA', marca do AJAX, '') sem esperar a resposta"""
+        # 1. CPF e Pesquisar
+        self.marcar_etapa('cpf')
+        if not self.preencher_cpf_e_pesquisar(dados['CPF']):
+            return 'ERRO', '', 'Erro ao pesquisar CPF'
+        
+        # 1.5. VERIFICA SE PRECISA CADASTRAR TOMADOR
+        # Verifica se apareceu o modal "Tomador Não Cadastrado"
+        self.marcar_etapa('tomador')
+        if self.tomadores.get(_somente_digitos(dados['CPF'])):
+            self.log.debug(f"  ℹ Tomador já cadastrado (prefetch) - continuando...")
+        else:
+            self.pausar(2)
+            if self.tomador_nao_cadastrado():
+                self.log.debug(f"  ℹ Tomador não cadastrado - iniciando cadastro...")
+                if not self.cadastrar_tomador(dados):
+                    return 'ERRO', '', 'Erro ao cadastrar tomador'
+            else:
+                self.log.debug(f"  ℹ Tomador já cadastrado - continuando...")
+        
+        # 2. Atividade
+        self.marcar_etapa('atividade')
+        if not self.selecionar_atividade():
+            return 'ERRO', '', 'Erro ao selecionar atividade'
+        
+        # 3. Descrição
+        self.marcar_etapa('descricao')
+        if self.adicionar_descricao(self.texto_descricao(dados)) is None:
+            return 'ERRO', '', 'Erro ao adicionar descrição'
+        
+        # 4. Valor
+        self.marcar_etapa('valor')
+        valor = float(dados.get('Valor', 110.00))
+        if not self.preencher_valor(valor):
+            return 'ERRO', '', 'Erro ao preencher valor'
+        
+        # 5. Emitir (a resposta é lida em concluir_nota)
+        self.marcar_etapa('emissao')
+        marca = self.disparar_emissao()
+        if marca is False:
+            return 'ERRO', '', 'Erro ao emitir nota'
+        return 'DISPARADA', marca, ''
+    
+    def concluir_nota(self, index, dados, marca):
+        """Lê o resultado da emissão disparada em `marca`, baixa o PDF e limpa o formulário"""
+        if self.escalonador:
+            self.escalonador.contar_nota(self.emissor)
+        self.marcar_etapa('emissao')
+        numero = self.concluir_emissao(marca)
+        if not numero:
+            return 'ERRO', '', 'Erro ao emitir nota'
+        
+        # 5.5. Baixar PDF
+        self.marcar_etapa('pdf')
+        self.baixar_pdf_nota(index, dados, numero)
+        
+        # 6. Limpar para próxima
+        self.marcar_etapa('limpeza')
+        self.limpar_formulario()
+        
+        return 'EMITIDA', numero, ''
+    
+    def abrir_escritor(self):
+        """Prepara a gravação célula a célula na planilha de saída (.xlsx); sem ela, salva o DataFrame inteiro"""
+        self.escritor = None
+        if not self.caminho_saida.lower().endswith('.xlsx'):
+            return None
+        try:
+            if not os.path.exists(self.caminho_saida) and self.caminho_excel.lower().endswith('.xlsx'):
+                # Saída separada (ex.: replay): parte de uma cópia da planilha original
+                shutil.copyfile(self.caminho_excel, self.caminho_saida)
+            self.escritor = EscritorPlanilha(self.caminho_saida)
         except Exception as e:
-            erro_msg = f"{type(e).__name__}: {str(e)}"
-            print(f"  ✗ Erro inesperado: {erro_msg}")
-            return 'ERRO', '', erro_msg
+            self.log.warning(f"⚠ Gravação célula a célula indisponível ({type(e).__name__}) - salvando a planilha inteira")
+        return self.escritor
     
-    def executar(self):
-        """Executa o processo completo"""
-        print("\n" + "="*60)
-        print("  AUTOMAÇÃO NFS-E BELÉM - VERSÃO OTIMIZADA")
-        print("="*60 + "\n")
+    def registrar_resultado(self, df, index, valores):
+        """Atualiza as colunas de controle de uma linha no DataFrame e nas células da planilha"""
+        for coluna, valor in valores.items():
+            df.at[index, coluna] = valor
+        if self.escritor:
+            self.escritor.atualizar(index, valores)
+    
+    def salvar_planilha(self, df, caminho=None, parcial=False):
+        """Grava a planilha de resultado (só as células alteradas no .xlsx de saída; senão o DataFrame inteiro).
         
-        # Carrega dados
-        df = self.carregar_dados()
+        `parcial`: salvamento de progresso, sem esperar o Excel liberar o arquivo.
+        """
+        if self.escritor and caminho in (None, self.caminho_saida):
+            self.escritor.salvar(tentativas=1 if parcial else None)
+            return
+        caminho = caminho or self.caminho_saida
+        if caminho.lower().endswith('.csv'):
+            df.to_csv(caminho, index=False, sep=self.separador_csv, encoding='utf-8-sig')
+        else:
+            df.to_excel(caminho, index=False)
+    
+    def garantir_sessao(self):
+        """Aguarda (sem input) até o formulário de emissão estar disponível - login feito no navegador"""
+        if self.modo_replay or self.sessao_ativa():
+            return
+        while not self.sondar_portal():
+            time.sleep(15)
+        self.recarregar_formulario()
+        self.log.info("✓ Sessão ativa")
+    
+    def preaquecer_navegador(self):
+        """Abre o Chrome e carrega o portal numa thread enquanto a planilha é lida"""
+        def abrir():
+            try:
+                self.configurar_navegador()
+                self.acessar_sistema()
+            except Exception as e:
+                self._erro_preaquecimento = e
+        self._preaquecimento = threading.Thread(target=abrir, name="preaquecimento", daemon=True)
+        self._preaquecimento.start()
+    
+    def aguardar_navegador(self):
+        """Navegador aberto e portal carregado (espera o preaquecimento, se houver)"""
+        if self._preaquecimento is None:
+            self.configurar_navegador()
+            self.acessar_sistema()
+            return
+        self._preaquecimento.join()
+        self._preaquecimento = None
+        erro, self._erro_preaquecimento = self._erro_preaquecimento, None
+        if erro:
+            raise erro
+    
+    def iniciar_sessao(self, interativo=True):
+        """Abre o navegador, acessa o portal e garante o login (uma vez por execução)"""
+        self.aguardar_navegador()
         
-        # Configura navegador
-        self.configurar_navegador()
+        inicio_login = time.perf_counter()
+        if self.perfil and self.sessao_ativa():
+            self.log.info("✓ Sessão do perfil ainda ativa - login não necessário")
+        elif self.modo_replay:
+            pass
+        elif interativo:
+            esvaziar_log()
+            print("\n" + "⚠"*30)
+            print("  ATENÇÃO: Faça LOGIN no sistema")
+            print("⚠"*30)
+            input("\n➤ Pressione ENTER após fazer login...\n")
+        else:
+            self.log.warning("\n⚠ Faça LOGIN no navegador - a automação continua sozinha quando a sessão estiver ativa")
+            self.garantir_sessao()
+        self.tempo_login += time.perf_counter() - inicio_login
+    
+    def encerrar(self):
+        """Salva trace/gravação, fecha o navegador e libera o perfil"""
+        # Não deixa para trás um Chrome que ainda estava abrindo
+        if self._preaquecimento is not None:
+            try:
+                self.aguardar_navegador()
+            except Exception:
+                pass
         
-        # Acessa sistema
-        self.acessar_sistema()
+        if self.rastreador:
+            self.rastreador.resumo()
+            self.rastreador.exportar_chrome_trace(self.arquivo_rastreamento)
+            self.log.info(f"✓ Trace salvo em: {self.arquivo_rastreamento}")
+        
+        if hasattr(self.driver, 'finalizar_gravacao'):
+            self.driver.finalizar_gravacao()
+            self.log.info(f"✓ Gravação salva em: {self.gravador.pasta}")
+        
+        if self.driver:
+            self.driver.quit()
+        if self.perfil:
+            self.perfil.liberar()
+    
+    def processar_na_vez(self, index, dados, fase='completa', marca_emissao=None, fim_prazo=None):
+        """processar_nota na vez deste emissor (quando há vários em paralelo)"""
+        if self.escalonador:
+            self.escalonador.aguardar_vez(self.emissor)
+            self._na_vez = True
+        try:
+            return self.processar_nota(index, dados, fase, marca_emissao, fim_prazo)
+        finally:
+            if self.escalonador:
+                self._na_vez = False
+                self.escalonador.liberar_vez(self.emissor)
+    
+    def reciclar_fora_da_vez(self):
+        """reciclar_driver sem segurar a vez do rodízio (garantir_sessao pode esperar um login indefinidamente)"""
+        if not self._na_vez:
+            return self.reciclar_driver()
+        self._na_vez = False
+        self.escalonador.liberar_vez(self.emissor)
+        try:
+            self.reciclar_driver()
+        finally:
+            self.escalonador.aguardar_vez(self.emissor)
+            self._na_vez = True
+    
+    def emitir_em_sequencia(self, df, fila):
+        """Uma nota por vez na aba atual; gera (index, status, numero, erro) na ordem da fila"""
+        while fila:
+            index = fila.popleft()
+            if self.aguardar_disjuntores():
+                self.recarregar_formulario()
+            yield (index,) + self.processar_na_vez(index, df.loc[index])
+            
+            # Pequena pausa entre notas
+            if fila:  # Não pausar na última
+                self.pausar(2)
+    
+    def emitir_em_pipeline(self, df, fila):
+        """Várias abas: enquanto a emissão de uma aba está no servidor, a próxima aba preenche a nota seguinte.
+        
+        Só a aba ativa tem AJAX aguardado; as outras ficam com a emissão em andamento em segundo plano
+        e são concluídas na ordem em que foram disparadas.
+        """
+        abas = self.abrir_abas(self.abas)
+        livres = deque(abas)
+        disparadas = deque()
+        reciclagens = self.reciclagens
+        try:
+            while fila or disparadas:
+                if self.reciclagens != reciclagens:
+                    # O watchdog reiniciou o navegador: as abas (e as emissões em andamento nelas) se perderam
+                    for aba in disparadas:
+                        yield (aba.pendente[0], 'ERRO', '',
+                               "Navegador reiniciado com a emissão em andamento - confira com --conciliar antes de reenviar")
+                    abas = self.abrir_abas(self.abas)
+                    livres = deque(abas)
+                    disparadas = deque()
+                    reciclagens = self.reciclagens
+                    continue
+                if fila and livres:
+                    # Preenche a próxima nota em uma aba livre e dispara a emissão
+                    aba = livres.popleft()
+                    self.ativar_aba(aba)
+                    if self.aguardar_disjuntores():
+                        for outra in abas:
+                            outra.recarregar = outra.pendente is None
+                    if aba.recarregar:
+                        self.recarregar_formulario()
+                        aba.recarregar = False
+                    index = fila.popleft()
+                    status, marca, erro = self.processar_na_vez(index, df.loc[index], fase='preparar')
+                    if status == 'DISPARADA':
+                        aba.pendente = (index, marca, self.fim_prazo_nota)
+                        disparadas.append(aba)
+                        continue
+                    livres.append(aba)
+                    yield index, status, '', erro
+                else:
+                    # Todas as abas ocupadas (ou fila vazia): conclui a emissão mais antiga
+                    aba = disparadas.popleft()
+                    self.ativar_aba(aba)
+                    index, marca, fim_prazo = aba.pendente
+                    aba.pendente = None
+                    resultado = self.processar_na_vez(index, df.loc[index], fase='concluir', marca_emissao=marca,
+                                                      fim_prazo=fim_prazo)
+                    livres.append(aba)
+                    yield (index,) + resultado
+        finally:
+            self.fechar_abas(abas)
+    
+    def injetar_monitor_ajax(self):
+        """Registra o monitor de AJAX na aba atual antes de navegar (o script do DevTools vale por aba)"""
+        self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": SCRIPT_MONITOR_AJAX})
+    
+    def abrir_abas(self, quantidade):
+        """Abre abas extras no formulário de emissão, cada uma com sua view JSF, page objects e monitor de AJAX"""
+        principal = AbaEmissao(self.driver.current_window_handle,
+                               (self.pagina, self.dialogo_tomador, self.dialogo_cep, self.dialogo_descricao))
+        self.aba_atual = principal
+        abas = [principal]
+        for _ in range(quantidade - 1):
+            self.driver.switch_to.new_window('tab')
+            self.injetar_monitor_ajax()
+            aba = AbaEmissao(self.driver.current_window_handle,
+                             (PaginaEmissao(self), DialogoTomador(self), DialogoCEP(self), DialogoDescricao(self)))
+            self.ativar_aba(aba, trocar_janela=False)
+            self.recarregar_formulario()
+            abas.append(aba)
+        self.ativar_aba(principal)
+        self.log.info(f"✓ Pipeline com {len(abas)} abas")
+        return abas
+    
+    def ativar_aba(self, aba, trocar_janela=True):
+        """Troca a aba do navegador junto com os page objects que pertencem a ela"""
+        if self.aba_atual is aba:
+            return
+        if trocar_janela:
+            self.driver.switch_to.window(aba.handle)
+        self.aba_atual = aba
+        self.pagina, self.dialogo_tomador, self.dialogo_cep, self.dialogo_descricao = aba.paginas
+    
+    def fechar_abas(self, abas):
+        """Fecha as abas extras e volta para a principal"""
+        for aba in abas[1:]:
+            try:
+                self.ativar_aba(aba)
+                self.driver.close()
+            except Exception:
+                pass
+        self.aba_atual = None
+        self.ativar_aba(abas[0])
+        self.aba_atual = None
+    
+    def informar_progresso(self, feitas, total, sucesso, erros, nesta_execucao, inicio_lote):
+        """Linha de progresso (concluídas, falhas, ritmo e ETA) reescrita no console a cada nota"""
+        decorrido = time.perf_counter() - inicio_lote
+        ritmo = nesta_execucao / decorrido * 60 if decorrido > 0 else 0.0
+        restantes = total - feitas
+        eta = time.strftime('%H:%M:%S', time.gmtime(restantes / ritmo * 60)) if ritmo and restantes else '--:--:--'
+        self.log.log(PROGRESSO, f"▶ {feitas}/{total}  ✓ {sucesso}  ✗ {erros}  {ritmo:.1f} notas/min  ETA {eta}",
+                     extra={'progresso': True})
+    
+    def processar_planilha(self, df):
+        """Emite as notas pendentes de uma planilha já carregada e salva o resultado em caminho_saida"""
+        inicio_lote = time.perf_counter()
+        self.tempos_etapas = {}
+        self.abrir_escritor()
         
-        print("\n" + "⚠"*30)
-        print("  ATENÇÃO: Faça LOGIN no sistema")
-        print("⚠"*30)
-        input("\n➤ Pressione ENTER após fazer login...\n")
+        if self.prefetch_tomadores and not self.modo_replay:
+            self.pre_cadastrar_tomadores(df)
         
         # Processa notas
         total = len(df)
         sucesso = 0
         erros = 0
         
-        for index, row in df.iterrows():
-            # Pula se já foi processada
-            if str(row.get('Status', '')).upper() == 'EMITIDA':
-                print(f"\n[{index + 1}] ✓ Já processada - PULANDO")
-                sucesso += 1
-                continue
-            
-            # Processa a nota
-            status, numero, erro = self.processar_nota(index, row)
+        # Já processadas são puladas; as pendentes seguem a ordem da planilha
+        ordem = linhas_pendentes(df)
+        ja_processadas = total - len(ordem)
+        if ja_processadas:
+            self.log.info(f"\n✓ {ja_processadas} notas já processadas - PULANDO")
+            sucesso += ja_processadas
+        
+        # Linhas com falha de infraestrutura voltam para o início da fila (não viram ERRO)
+        fila = deque(ordem)
+        repeticoes = {}
+        posicao = 0
+        if self.abas > 1 and len(fila) > 1:
+            resultados = self.emitir_em_pipeline(df, fila)
+        else:
+            resultados = self.emitir_em_sequencia(df, fila)
+        for index, status, numero, erro in resultados:
+            if status == 'REPETIR':
+                repeticoes[index] = repeticoes.get(index, 0) + 1
+                if repeticoes[index] < MAX_REPETICOES_INFRA:
+                    fila.appendleft(index)
+                    # Com o disjuntor aberto a página é recarregada depois da pausa
+                    if not self.disjuntor_aberto:
+                        self.recarregar_formulario()
+                    continue
+                status, erro = 'ERRO', f"Portal instável: {erro}"
+            posicao += 1
+            if self.primeira_nota is None:
+                self.primeira_nota = time.perf_counter() - self.inicio_execucao - self.tempo_login
+                self.log.info(f"\n⏱ Primeira nota em {self.primeira_nota:.1f}s desde a partida"
+                      f"{f' (sem os {self.tempo_login:.0f}s do login)' if self.tempo_login >= 1 else ''}")
             
-            # Atualiza DataFrame
-            df.at[index, 'Status'] = status
-            df.at[index, 'Numero_Nota'] = numero if numero else ''
-            df.at[index, 'Data_Emissao'] = datetime.now().strftime('%d/%m/%Y %H:%M') if status == 'EMITIDA' else ''
-            df.at[index, 'Mensagem_Erro'] = erro if erro else ''
+            # Atualiza DataFrame (Data_Tentativa de toda linha tentada: referência da conciliação)
+            agora = datetime.now().strftime('%d/%m/%Y %H:%M')
+            self.registrar_resultado(df, index, {
+                'Status': status,
+                'Numero_Nota': numero if numero else '',
+                'Codigo_Verificacao': (self.ultima_emissao or {}).get('codigo_verificacao', '') if status == 'EMITIDA' else '',
+                'Data_Emissao': agora if status == 'EMITIDA' else '',
+                'Data_Tentativa': agora,
+                'Mensagem_Erro': erro if erro else '',
+            })
             
             # Contabiliza
             if status == 'EMITIDA':
                 sucesso += 1
-                print(f"\n  ✓✓✓ SUCESSO! ({sucesso}/{total})")
             else:
                 erros += 1
-                print(f"\n  ✗✗✗ ERRO: {erro}")
-                print(f"  ({erros} erros até agora)")
+                self.log.error(f"✗ {status}: {erro}")
+            self.informar_progresso(ja_processadas + posicao, total, sucesso, erros, posicao, inicio_lote)
             
             # Salva progresso a cada 3 notas
-            if (index + 1) % 3 == 0:
+            if posicao % 3 == 0:
                 try:
-                    df.to_excel(self.caminho_excel, index=False)
-                    print(f"\n  💾 Progresso salvo ({index + 1}/{total})")
+                    self.salvar_planilha(df, parcial=True)
+                    self.log.debug(f"\n  💾 Progresso salvo ({ja_processadas + posicao}/{total})")
+                except PermissionError:
+                    self.log.warning(f"\n  ⚠ Planilha em uso - o progresso fica para o próximo salvamento")
                 except Exception as e:
-                    print(f"\n  ⚠ Erro ao salvar: {str(e)}")
-                    print(f"  (Certifique-se de que o Excel está fechado)")
-            
-            # Pequena pausa entre notas
-            if index < total - 1:  # Não pausar na última
-                time.sleep(2)
+                    self.log.warning(f"\n  ⚠ Erro ao salvar: {str(e)} (certifique-se de que o Excel está fechado)")
         
         # Salva resultado final
-        print(f"\n{'='*60}")
-        print("  SALVANDO RESULTADO FINAL...")
-        print(f"{'='*60}")
+        self.log.info("\n→ Salvando resultado final...")
         
         try:
-            df.to_excel(self.caminho_excel, index=False)
-            print("✓ Arquivo salvo com sucesso!")
+            self.salvar_planilha(df)
+            self.log.info("✓ Arquivo salvo com sucesso!")
         except Exception as e:
-            print(f"✗ Erro ao salvar: {str(e)}")
-            print("⚠ FECHE O EXCEL e tente salvar manualmente!")
-            backup = f"resultado_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+            self.log.error(f"✗ Erro ao salvar: {str(e)}")
+            self.log.warning("⚠ FECHE O EXCEL e tente salvar manualmente!")
+            extensao = os.path.splitext(self.caminho_saida)[1] or '.xlsx'
+            backup = f"resultado_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}{extensao}"
             try:
-                df.to_excel(backup, index=False)
-                print(f"✓ Backup salvo em: {backup}")
+                self.salvar_planilha(df, backup)
+                self.log.info(f"✓ Backup salvo em: {backup}")
             except:
-                print("✗ Não foi possível salvar backup")
+                self.log.error("✗ Não foi possível salvar backup")
+        
+        # Confere os PDFs baixados com a planilha
+        if not self.modo_replay:
+            try:
+                self.conferir_pdfs(df)
+            except Exception as e:
+                self.log.warning(f"⚠ Erro na conferência dos PDFs: {type(e).__name__} - {str(e)[:100]}")
         
         # Relatório final
+        esvaziar_log()
         print(f"\n{'='*60}")
         print("  RELATÓRIO FINAL")
         print(f"{'='*60}")
         print(f"  Total de registros: {total}")
         print(f"  ✓ Emitidas: {sucesso}")
         print(f"  ✗ Erros: {erros}")
-        print(f"  Taxa de sucesso: {(sucesso/total)*100:.1f}%")
+        print(f"  Taxa de sucesso: {(sucesso/total)*100 if total else 0:.1f}%")
+        print(f"  Tempo do lote: {time.perf_counter() - inicio_lote:.1f}s")
+        if self.primeira_nota is not None:
+            print(f"  Tempo até a primeira nota: {self.primeira_nota:.1f}s (sem o login)")
+        if self.disjuntor.aberturas:
+            print(f"  ⚠ Pausas por instabilidade do portal: {self.disjuntor.aberturas} ({self.disjuntor.tempo_pausado:.0f}s)")
+        if self.disjuntor_sessao.aberturas:
+            print(f"  ⚠ Pausas por sessão expirada: {self.disjuntor_sessao.aberturas} "
+                  f"({self.disjuntor_sessao.tempo_pausado:.0f}s)")
+        for etapa, tempos in self.tempos_etapas.items():
+            print(f"    {etapa:<10} {sum(tempos):8.2f}s  ({len(tempos)}x, média {sum(tempos)/len(tempos):.2f}s)")
         print(f"{'='*60}\n")
+        return sucesso, erros
+    
+    def executar(self):
+        """Executa o processo completo"""
+        print("\n" + "="*60)
+        print("  AUTOMAÇÃO NFS-E BELÉM - VERSÃO OTIMIZADA")
+        print("="*60 + "\n")
         
-        input("➤ Pressione ENTER para fechar o navegador...")
-        self.driver.quit()
+        # Chrome e portal abrem em segundo plano enquanto a planilha é carregada
+        self.preaquecer_navegador()
+        try:
+            df = self.carregar_dados()
+        except Exception:
+            self.encerrar()
+            raise
+        if self.gravador:
+            self.gravador.copiar_planilha(self.caminho_excel)
+        
+        # Navegador pronto: faz login
+        self.iniciar_sessao()
+        
+        self.processar_planilha(df)
+        
+        if not self.modo_replay:
+            esvaziar_log()
+            input("➤ Pressione ENTER para fechar o navegador...")
+        self.encerrar()
         print("\n✓ Processo finalizado!")
+    
+    def executar_daemon(self, pasta_entrada):
+        """Modo daemon: um único navegador (e login) processa cada planilha que chega na pasta de entrada"""
+        print("\n" + "="*60)
+        print("  AUTOMAÇÃO NFS-E BELÉM - MODO DAEMON")
+        print("="*60 + "\n")
+        
+        caixa = CaixaEntrada(pasta_entrada)
+        self.iniciar_sessao(interativo=False)
+        fila = caixa.interrompidas()
+        if fila:
+            self.log.info(f"ℹ Retomando {len(fila)} planilha(s) interrompida(s)")
+        try:
+            while True:
+                if not fila:
+                    self.log.info(f"\n👀 Aguardando planilhas em: {caixa.pasta}  (Ctrl+C para encerrar)")
+                caminho = fila.pop(0) if fila else caixa.proximo()
+                self.log.info(f"\n📥 Planilha: {os.path.basename(caminho)}")
+                
+                # Resultado gravado no próprio arquivo (em_processamento/ → processados/)
+                self.caminho_excel = self.caminho_saida = caminho
+                try:
+                    df = self.carregar_dados()
+                    self.garantir_sessao()
+                    self.processar_planilha(df)
+                except Exception as e:
+                    self.log.error(f"✗ Erro na planilha {os.path.basename(caminho)}: {type(e).__name__} - {str(e)[:100]}")
+                    destino = caixa.finalizar(caminho, erro=True)
+                else:
+                    destino = caixa.finalizar(caminho)
+                self.log.info(f"✓ Resultado em: {destino}")
+        finally:
+            caixa.parar()
+            self.encerrar()
+
+
+class ExecutorMultiEmissor:
+    """Processa vários emissores (contas do portal) em paralelo, cada um com navegador, perfil e pasta de PDFs próprios.
+    
+    Manifesto JSON:
+        {"simultaneas": 2,
+         "emissores": [{"nome": "academia_centro", "planilha": "centro.xlsx", "perfil": "perfis/centro",
+                        "atividade": "931310000", "descricao": "Mensalidade de academia",
+                        "modelo_descricao": "Mensalidade {mes_extenso}/{ano} - {nome}"}, ...]}
+    
+    Caminhos relativos são resolvidos a partir da pasta do manifesto. O login de cada emissor fica no
+    perfil do Chrome dele (sessões isoladas); sem "perfil" é usado <pasta do manifesto>/emissores/<nome>/perfil.
+    """
+
+    def __init__(self, caminho_manifesto, simultaneas=None):
+        with open(caminho_manifesto, encoding='utf-8') as f:
+            manifesto = json.load(f)
+        if isinstance(manifesto, list):
+            manifesto = {'emissores': manifesto}
+        self.pasta_base = os.path.dirname(os.path.abspath(caminho_manifesto))
+        self.emissores = manifesto['emissores']
+        nomes = [e['nome'] for e in self.emissores]
+        if len(set(nomes)) != len(nomes):
+            raise ValueError("Nomes de emissor repetidos no manifesto")
+        for emissor in self.emissores:
+            if emissor.get('modelo_descricao'):
+                validar_modelo_descricao(emissor['modelo_descricao'])
+        self.escalonador = EscalonadorRodizio(simultaneas or manifesto.get('simultaneas') or len(self.emissores))
+        # Instabilidade do portal pausa todos os emissores juntos (uma sondagem só)
+        self.disjuntor = DisjuntorPortal()
+        self.estatisticas = {}
+
+    def _caminho(self, caminho):
+        return caminho if os.path.isabs(caminho) else os.path.join(self.pasta_base, caminho)
+
+    def criar_automacao(self, emissor):
+        pasta = os.path.join(self.pasta_base, "emissores", emissor['nome'])
+        return AutomacaoNotaFiscal(
+            self._caminho(emissor['planilha']),
+            pasta_perfis=self._caminho(emissor['perfil']) if emissor.get('perfil') else os.path.join(pasta, "perfil"),
+            pasta_pdfs=os.path.join(pasta, "notas_pdf"),
+            codigo_atividade=str(emissor.get('atividade') or ATIVIDADE_PADRAO),
+            descricao_favorita=emissor.get('descricao'),
+            modelo_descricao=emissor.get('modelo_descricao'),
+            prefetch_tomadores=bool(emissor.get('prefetch_tomadores')),
+            abas=int(emissor.get('abas') or 1),
+            prazo_nota=int(emissor.get('prazo_nota', PRAZO_NOTA)),
+            prazos_etapas=emissor.get('prazos_etapas'),
+            emissor=emissor['nome'],
+            escalonador=self.escalonador,
+            disjuntor=self.disjuntor,
+        )
+
+    def executar_emissor(self, emissor):
+        """Thread de um emissor: login (pelo perfil), planilha inteira e estatísticas"""
+        nome = emissor['nome']
+        estatistica = self.estatisticas[nome] = {'emitidas': 0, 'erros': 0, 'tempo': 0.0, 'falha': None}
+        automacao = self.criar_automacao(emissor)
+        try:
+            automacao.preaquecer_navegador()
+            df = automacao.carregar_dados()
+            ja_emitidas = int((df['Status'].str.upper() == 'EMITIDA').sum())
+            automacao.iniciar_sessao(interativo=False)
+            inicio = time.perf_counter()
+            sucesso, erros = automacao.processar_planilha(df)
+            estatistica.update(emitidas=sucesso - ja_emitidas, erros=erros, tempo=time.perf_counter() - inicio)
+            automacao.log.info(f"\n✓ Concluído: {estatistica['emitidas']} emitidas, {erros} erros")
+        except Exception as e:
+            estatistica['falha'] = f"{type(e).__name__}: {str(e)[:100]}"
+            automacao.log.error(f"\n✗ Interrompido: {estatistica['falha']}")
+        finally:
+            try:
+                automacao.encerrar()
+            except Exception:
+                pass
+
+    def executar(self):
+        print("\n" + "="*60)
+        print(f"  AUTOMAÇÃO NFS-E BELÉM - {len(self.emissores)} EMISSORES")
+        print("="*60 + "\n")
+        print(f"ℹ Até {self.escalonador.simultaneas} notas em andamento ao mesmo tempo (rodízio entre emissores)")
+        
+        threads = [threading.Thread(target=self.executar_emissor, args=(emissor,), name=f"emissor-{emissor['nome']}",
+                                    daemon=True)
+                   for emissor in self.emissores]
+        inicio = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # join com timeout para o Ctrl+C chegar à thread principal
+            while thread.is_alive():
+                thread.join(1)
+        self.relatorio(time.perf_counter() - inicio)
+        return self.estatisticas
+
+    def relatorio(self, tempo_total):
+        esvaziar_log()
+        print(f"\n{'='*60}")
+        print("  RELATÓRIO POR EMISSOR")
+        print(f"{'='*60}")
+        print(f"  {'Emissor':<20} {'Emitidas':>8} {'Erros':>6} {'Notas/min':>10} {'Espera':>8}")
+        for emissor in self.emissores:
+            nome = emissor['nome']
+            estatistica = self.estatisticas.get(nome, {})
+            tempo = estatistica.get('tempo') or 0.0
+            por_minuto = estatistica.get('emitidas', 0) / (tempo / 60) if tempo else 0.0
+            print(f"  {nome[:20]:<20} {estatistica.get('emitidas', 0):>8} {estatistica.get('erros', 0):>6} "
+                  f"{por_minuto:>10.1f} {self.escalonador.espera.get(nome, 0.0):>7.0f}s")
+            if estatistica.get('falha'):
+                print(f"    ✗ {estatistica['falha']}")
+        total = sum(e.get('emitidas', 0) for e in self.estatisticas.values())
+        print(f"  Total: {total} notas em {tempo_total:.0f}s ({total / (tempo_total / 60) if tempo_total else 0:.1f}/min)")
+        print(f"{'='*60}\n")
 
 
 if __name__ == "__main__":
-    import sys
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Automação de emissão de NFS-e - SEFIN Belém")
+    parser.add_argument("planilha", nargs="?", help="Arquivo Excel com as notas")
+    parser.add_argument("--gravar", metavar="PASTA", help="Grava a sessão (DOM + AJAX de cada etapa) nesta pasta")
+    parser.add_argument("--replay", metavar="PASTA", help="Reproduz offline uma sessão gravada com --gravar")
+    parser.add_argument("--perfil", metavar="PASTA", help="Usa perfis persistentes do Chrome (cache e login) nesta pasta")
+    parser.add_argument("--conferir-pdfs", action="store_true", help="Só confere os PDFs já baixados com a planilha (sem navegador)")
+    parser.add_argument("--rastrear", metavar="ARQUIVO.json",
+                        help="Registra cada comando WebDriver e salva um trace (formato chrome://tracing)")
+    parser.add_argument("--prefetch-tomadores", action="store_true",
+                        help="Verifica/cadastra todos os tomadores antes de começar a emitir")
+    parser.add_argument("--conciliar", metavar="DD/MM/AAAA:DD/MM/AAAA",
+                        help="Concilia a planilha com as notas emitidas no portal nesse período")
+    parser.add_argument("--daemon", metavar="PASTA",
+                        help="Fica rodando: emite cada planilha (.xlsx/.csv) colocada nesta pasta com o mesmo navegador")
+    parser.add_argument("--abas", type=int, default=1, metavar="N",
+                        help="Pipeline: N abas (2 ou 3) - uma preenche a próxima nota enquanto outra aguarda a emissão")
+    parser.add_argument("--prazo-nota", type=int, default=PRAZO_NOTA, metavar="SEG",
+                        help=f"Tempo máximo de uma nota antes de ser interrompida (padrão: {PRAZO_NOTA}s, 0 desliga)")
+    parser.add_argument("--prazo-etapa", action="append", default=[], metavar="ETAPA=SEG",
+                        help="Tempo máximo de uma etapa (cpf, tomador, atividade, descricao, valor, emissao, pdf, limpeza)")
+    parser.add_argument("--modelo-descricao", metavar="TEXTO",
+                        help="Descrição escrita direto no campo quando a linha não tem a coluna Descricao "
+                             "(ex.: \"Mensalidade {mes_extenso}/{ano} - {nome}\"); sem ela usa o modal de favoritas")
+    parser.add_argument("--emissores", metavar="MANIFESTO.json",
+                        help="Emite para vários emissores em paralelo (planilha, perfil, atividade e descrição de cada um)")
+    parser.add_argument("--simultaneas", type=int, metavar="N",
+                        help="Com --emissores: máximo de notas em andamento ao mesmo tempo (padrão: uma por emissor)")
+    verbosidade = parser.add_mutually_exclusive_group()
+    verbosidade.add_argument("--detalhado", action="store_true",
+                             help="Mostra cada passo de cada nota (como as versões anteriores)")
+    verbosidade.add_argument("--silencioso", action="store_true",
+                             help="Só a linha de progresso, avisos e erros")
+    parser.add_argument("--log", default=ARQUIVO_LOG, metavar="ARQUIVO",
+                        help=f"Log estruturado (JSONL, rotativo) - padrão: {ARQUIVO_LOG}; vazio desliga")
+    parser.add_argument("--buscar-nota", metavar="NUMERO_OU_CPF", help="Procura PDFs no arquivo pelo número da nota ou CPF/CNPJ")
+    args = parser.parse_args()
+    if args.modelo_descricao:
+        try:
+            validar_modelo_descricao(args.modelo_descricao)
+        except ValueError as e:
+            parser.error(str(e))
+    configurar_log(logging.DEBUG if args.detalhado else PROGRESSO if args.silencioso else logging.INFO, args.log)
+    prazos_etapas = {}
+    for item in args.prazo_etapa:
+        etapa, _, segundos = item.partition("=")
+        if etapa not in PRAZOS_ETAPAS or not segundos.isdigit():
+            parser.error(f"--prazo-etapa inválido: {item}")
+        prazos_etapas[etapa] = int(segundos)
+    
+    if args.buscar_nota:
+        arquivo = ArquivoNotas(os.path.join(os.getcwd(), "notas_pdf"))
+        notas = arquivo.buscar(numero=args.buscar_nota) or arquivo.buscar(cpf_cnpj=args.buscar_nota)
+        for nota in notas:
+            print(f"  Nota {nota['numero'] or '-'} | {nota['cpf_cnpj'] or '-'} | {nota['data_emissao']} | "
+                  f"{os.path.basename(nota['planilha'] or '-')} linha {nota['linha']}")
+            print(f"    {nota['caminho']}")
+        print(f"\n✓ {len(notas)} nota(s) encontrada(s)")
+        sys.exit(0)
+    
+    if args.emissores:
+        try:
+            ExecutorMultiEmissor(args.emissores, simultaneas=args.simultaneas).executar()
+        except KeyboardInterrupt:
+            print("\n\n⚠ Processo interrompido pelo usuário")
+            print("✓ Dados foram salvos até o último checkpoint de cada emissor")
+        sys.exit(0)
+    
+    if args.daemon:
+        automacao = AutomacaoNotaFiscal(None, pasta_perfis=args.perfil, prefetch_tomadores=args.prefetch_tomadores,
+                                       arquivo_rastreamento=args.rastrear, abas=args.abas,
+                                       prazo_nota=args.prazo_nota, prazos_etapas=prazos_etapas,
+                                       modelo_descricao=args.modelo_descricao)
+        try:
+            automacao.executar_daemon(args.daemon)
+        except KeyboardInterrupt:
+            print("\n\n⚠ Daemon encerrado pelo usuário")
+            print("✓ Planilhas em andamento continuam em em_processamento/ e são retomadas na próxima execução")
+        sys.exit(0)
     
     print("\n" + "="*60)
     print("  BEM-VINDO AO SISTEMA DE AUTOMAÇÃO NFS-E")
     print("="*60 + "\n")
     
-    caminho = input("📁 Arquivo Excel (ou ENTER para 'notas_fiscais.xlsx'): ").strip()
+    caminho = args.planilha
+    if not caminho and args.replay:
+        caminho = next((os.path.join(args.replay, f) for f in os.listdir(args.replay) if f.startswith("planilha.")), None)
+    if not caminho:
+        caminho = input("📁 Arquivo Excel (ou ENTER para 'notas_fiscais.xlsx'): ").strip()
     if not caminho:
         caminho = "notas_fiscais.xlsx"
     
@@ -1116,8 +4268,18 @@ if __name__ == "__main__":
     print(f"\n✓ Arquivo encontrado: {caminho}\n")
     
     try:
-        automacao = AutomacaoNotaFiscal(caminho)
-        automacao.executar()
+        automacao = AutomacaoNotaFiscal(caminho, pasta_gravacao=args.gravar, pasta_replay=args.replay,
+                                       pasta_perfis=args.perfil, prefetch_tomadores=args.prefetch_tomadores,
+                                       arquivo_rastreamento=args.rastrear, abas=args.abas,
+                                       prazo_nota=args.prazo_nota, prazos_etapas=prazos_etapas,
+                                       modelo_descricao=args.modelo_descricao)
+        if args.conferir_pdfs:
+            automacao.conferir_pdfs(automacao.carregar_dados())
+        elif args.conciliar:
+            data_inicio, _, data_fim = args.conciliar.partition(":")
+            automacao.executar_conciliacao(data_inicio, data_fim or data_inicio)
+        else:
+            automacao.executar()
     except KeyboardInterrupt:
         print("\n\n⚠ Processo interrompido pelo usuário")
         print("✓ Dados foram salvos até o último checkpoint")
@@ -0,0 +1 @@
+# Raiz do repositório no sys.path: os testes importam automacao_nfse também com `pytest` puro
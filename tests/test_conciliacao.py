@@ -0,0 +1,88 @@
+from datetime import datetime
+
+import pandas as pd
+
+from automacao_nfse import conciliar_notas, interpretar_notas_portal
+
+
+def planilha(*linhas):
+    colunas = {'CPF': '', 'Valor': 110.0, 'Status': 'nan', 'Numero_Nota': 'nan',
+               'Data_Emissao': 'nan', 'Data_Tentativa': 'nan'}
+    return pd.DataFrame([{**colunas, **linha} for linha in linhas])
+
+
+def nota(numero, data, cpf='12345678900', valor=110.0, com_hora=True):
+    return {'numero': numero, 'cpf_cnpj': cpf, 'valor': valor, 'data': data, 'com_hora': com_hora}
+
+
+def numeros(associacoes):
+    return {index: n['numero'] for index, n in associacoes}
+
+
+def test_erro_casa_com_a_nota_do_mes_da_tentativa():
+    df = planilha({'CPF': '123.456.789-00', 'Status': 'ERRO', 'Data_Tentativa': '15/10/2026 09:30'})
+    notas = [nota('100', datetime(2026, 9, 15, 9, 31)), nota('200', datetime(2026, 10, 15, 9, 31))]
+    assert numeros(conciliar_notas(df, notas)) == {0: '200'}
+
+
+def test_linha_nunca_tentada_nao_e_tocada():
+    df = planilha({'CPF': '12345678900'}, {'CPF': '12345678900', 'Status': ''})
+    notas = [nota('200', datetime(2026, 10, 15, 9, 31))]
+    assert conciliar_notas(df, notas) == []
+
+
+def test_tentativa_sem_horario_registrado_nao_e_tocada():
+    df = planilha({'CPF': '12345678900', 'Status': 'ERRO'})
+    notas = [nota('200', datetime(2026, 10, 15, 9, 31))]
+    assert conciliar_notas(df, notas) == []
+
+
+def test_nota_fora_da_janela_nao_casa():
+    df = planilha({'CPF': '12345678900', 'Status': 'TIMEOUT', 'Data_Tentativa': '15/10/2026 09:30'})
+    notas = [nota('200', datetime(2026, 10, 15, 12, 0))]
+    assert conciliar_notas(df, notas) == []
+    assert numeros(conciliar_notas(df, notas, janela=180)) == {0: '200'}
+
+
+def test_nota_so_com_data_casa_no_mesmo_dia():
+    df = planilha({'CPF': '12345678900', 'Status': 'ERRO', 'Data_Tentativa': '15/10/2026 09:30'})
+    assert numeros(conciliar_notas(df, [nota('200', datetime(2026, 10, 15), com_hora=False)])) == {0: '200'}
+    assert conciliar_notas(df, [nota('100', datetime(2026, 10, 14), com_hora=False)]) == []
+
+
+def test_emitida_sem_numero_usa_data_emissao():
+    df = planilha({'CPF': '12345678900', 'Status': 'EMITIDA', 'Data_Emissao': '15/10/2026 09:30'})
+    notas = [nota('100', datetime(2026, 9, 15, 9, 30)), nota('200', datetime(2026, 10, 15, 9, 32))]
+    assert numeros(conciliar_notas(df, notas)) == {0: '200'}
+
+
+def test_valor_diferente_nao_casa():
+    df = planilha({'CPF': '12345678900', 'Status': 'ERRO', 'Data_Tentativa': '15/10/2026 09:30', 'Valor': 120.0})
+    assert conciliar_notas(df, [nota('200', datetime(2026, 10, 15, 9, 31))]) == []
+
+
+def test_nota_ja_na_planilha_e_nota_usada_uma_vez():
+    df = planilha(
+        {'CPF': '12345678900', 'Status': 'EMITIDA', 'Numero_Nota': '200', 'Data_Emissao': '15/10/2026 09:30'},
+        {'CPF': '12345678900', 'Status': 'ERRO', 'Data_Tentativa': '15/10/2026 09:35'},
+        {'CPF': '12345678900', 'Status': 'ERRO', 'Data_Tentativa': '15/10/2026 09:40'},
+    )
+    notas = [nota('200', datetime(2026, 10, 15, 9, 31)), nota('201', datetime(2026, 10, 15, 9, 41))]
+    assert numeros(conciliar_notas(df, notas)) == {2: '201'}
+
+
+CABECALHOS = ['Número', 'Emissão', 'CPF/CNPJ Tomador', 'Valor', 'Situação']
+
+
+def test_documento_vem_da_coluna_do_tomador_e_nao_do_numero():
+    linhas = [['202600000001234', '15/10/2026 09:31', '123.456.789-00', '110,00', 'Normal']]
+    notas = interpretar_notas_portal(CABECALHOS, linhas)
+    assert [(n['numero'], n['cpf_cnpj']) for n in notas] == [('202600000001234', '12345678900')]
+
+
+def test_documento_sem_formatacao_e_aceito():
+    linhas = [['1234', '15/10/2026 09:31', '12345678900', '110,00', 'Normal'],
+              ['1235', '15/10/2026 09:32', '12345678000199', '110,00', 'Normal'],
+              ['1236', '15/10/2026 09:33', '1234567', '110,00', 'Normal']]
+    notas = interpretar_notas_portal(CABECALHOS, linhas)
+    assert [(n['numero'], n['cpf_cnpj']) for n in notas] == [('1234', '12345678900'), ('1235', '12345678000199')]